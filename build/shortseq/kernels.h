@@ -0,0 +1,322 @@
+/*
+ * Encoding, decoding, and bit manipulation kernels, built in several variants so that
+ * a single binary runs on any x86-64 CPU (or other architecture) and uses the fastest
+ * instructions that the CPU supports. Variants are compiled with per-function target
+ * attributes rather than global -m flags, and shortseq.util selects one at import.
+ *
+ *   portable   Scalar, one base at a time. Runs anywhere.
+ *   swar       8 bases at a time in 64-bit registers, with shifts instead of pext.
+ *   sse4.2     16 bases at a time with SSE shuffle/multiply-add, and hardware popcnt.
+ *   avx2       32 bases at a time with AVX2 shuffle/multiply-add, hardware popcnt, and
+ *              pext (BMI2) where it isn't microcoded.
+ *
+ * Every variant accepts exactly the characters accepted by the bloom filter in util.pyx
+ * (those whose low 6 bits are 1, 3, 7, or 20, i.e. A, C, G, T) and encodes each
+ * character as bits 1-2 of its ASCII value, so all variants produce identical blocks.
+ */
+
+#ifndef SHORTSEQ_KERNELS_H
+#define SHORTSEQ_KERNELS_H
+
+#include <stdint.h>
+#include <stddef.h>
+#include <string.h>
+
+#if defined(__x86_64__) || defined(__i386__)
+#define SS_X86 1
+#include <immintrin.h>
+#include <cpuid.h>
+#else
+#define SS_X86 0
+#endif
+
+/* Encodes n_blocks full blocks of 32 bases. Returns the index of the first block that
+   holds an unsupported character, or n_blocks if every block was encoded. */
+typedef size_t (*ss_encode_kernel)(uint64_t* dst, uint8_t* src, size_t n_blocks);
+
+/* Decodes length bases to ASCII. */
+typedef void (*ss_decode_kernel)(char* dst, uint64_t* blocks, size_t length);
+
+static const uint64_t SS_BASE_BITS = 0x000000000010008AULL;      /* ~bloom: bits 1, 3, 7, and 20 */
+static const uint64_t SS_LANES = 0x5555555555555555ULL;
+
+
+/* === Bit manipulation ============================================================= */
+
+/* Zeroes the bits at and above index n. Portable equivalent of BMI2 bzhi. */
+static inline uint64_t ss_bzhi_u64(uint64_t x, uint32_t n) {
+    return n >= 64 ? x : x & ((1ULL << n) - 1);
+}
+
+static inline uint64_t ss_popcnt64_sw(uint64_t x) {
+    x = x - ((x >> 1) & 0x5555555555555555ULL);
+    x = (x & 0x3333333333333333ULL) + ((x >> 2) & 0x3333333333333333ULL);
+    x = (x + (x >> 4)) & 0x0F0F0F0F0F0F0F0FULL;
+    return (x * 0x0101010101010101ULL) >> 56;
+}
+
+/* Only called once popcnt support has been confirmed at runtime */
+static inline uint64_t ss_popcnt64_hw(uint64_t x) {
+#if SS_X86 && defined(__x86_64__)
+    uint64_t r;
+    __asm__ ("popcntq %1, %0" : "=r" (r) : "rm" (x) : "cc");
+    return r;
+#else
+    return __builtin_popcountll(x);
+#endif
+}
+
+/* Only called once BMI2 support has been confirmed at runtime */
+static inline uint64_t ss_pext_u64_hw(uint64_t x, uint64_t mask) {
+#if SS_X86 && defined(__x86_64__)
+    uint64_t r;
+    __asm__ ("pextq %2, %1, %0" : "=r" (r) : "r" (x), "rm" (mask));
+    return r;
+#else
+    (void) mask;
+    return x;
+#endif
+}
+
+/* Gathers the low bit of each 2-bit lane into the low 32 bits, i.e. pext(x, SS_LANES) */
+static inline uint64_t ss_compress_lanes(uint64_t x) {
+    x &= SS_LANES;
+    x = (x | (x >> 1)) & 0x3333333333333333ULL;
+    x = (x | (x >> 2)) & 0x0F0F0F0F0F0F0F0FULL;
+    x = (x | (x >> 4)) & 0x00FF00FF00FF00FFULL;
+    x = (x | (x >> 8)) & 0x0000FFFF0000FFFFULL;
+    return (x | (x >> 16)) & 0x00000000FFFFFFFFULL;
+}
+
+/* Returns nonzero if each of the 8 characters is a supported base */
+static inline int ss_bloom_64(uint64_t chunk) {
+    uint64_t query = 0;
+    int i;
+
+    for (i = 0; i < 64; i += 8)
+        query |= 1ULL << ((chunk >> i) & 0x3F);
+    return (query & ~SS_BASE_BITS) == 0;
+}
+
+/* Gathers bits 1-2 of each of the 8 characters into 16 bits, first character lowest */
+static inline uint64_t ss_gather_chars(uint64_t chunk) {
+    uint64_t x = (chunk >> 1) & 0x0303030303030303ULL;
+    x = (x | (x >> 6)) & 0x000F000F000F000FULL;
+    x = (x | (x >> 12)) & 0x000000FF000000FFULL;
+    return (x | (x >> 24)) & 0xFFFFULL;
+}
+
+
+/* === Portable ===================================================================== */
+
+static inline size_t ss_encode_portable(uint64_t* dst, uint8_t* src, size_t n_blocks) {
+    size_t i;
+    int j;
+
+    for (i = 0; i < n_blocks; i++, src += 32) {
+        uint64_t block = 0;
+        for (j = 31; j >= 0; j--) {
+            if (!((SS_BASE_BITS >> (src[j] & 0x3F)) & 1)) return i;
+            block = (block << 2) | ((src[j] >> 1) & 3);
+        }
+        dst[i] = block;
+    }
+
+    return n_blocks;
+}
+
+static inline void ss_decode_portable(char* dst, uint64_t* blocks, size_t length) {
+    static const char charmap[4] = {'A', 'C', 'T', 'G'};
+    size_t i;
+
+    for (i = 0; i < length; i++)
+        dst[i] = charmap[(blocks[i / 32] >> ((i % 32) * 2)) & 3];
+}
+
+
+/* === SWAR (pext-free) ============================================================= */
+
+static inline size_t ss_encode_swar(uint64_t* dst, uint8_t* src, size_t n_blocks) {
+    uint64_t chunk, block;
+    size_t i;
+    int j;
+
+    for (i = 0; i < n_blocks; i++, src += 32) {
+        block = 0;
+        for (j = 3; j >= 0; j--) {
+            memcpy(&chunk, src + 8 * j, 8);
+            if (!ss_bloom_64(chunk)) return i;
+            block = (block << 16) | ss_gather_chars(chunk);
+        }
+        dst[i] = block;
+    }
+
+    return n_blocks;
+}
+
+
+#if SS_X86
+
+/* === SSE4.2 (shuffle/multiply) ==================================================== */
+
+/* Validates and encodes 16 characters into 32 bits. Each character is masked to its low 6
+   bits and compared with those of A, C, G, and T. The 2-bit codes are then combined in
+   pairs and quads by multiply-add, and the low byte of each quad is gathered by shuffle. */
+__attribute__((target("sse4.2")))
+static inline int ss_encode_16_sse(const uint8_t* src, uint32_t* out) {
+    const __m128i low6 = _mm_set1_epi8(0x3F);
+    const __m128i x = _mm_loadu_si128((const __m128i*) src);
+    const __m128i m = _mm_and_si128(x, low6);
+    __m128i ok, v;
+
+    ok = _mm_or_si128(_mm_or_si128(_mm_cmpeq_epi8(m, _mm_set1_epi8(1)), _mm_cmpeq_epi8(m, _mm_set1_epi8(3))),
+                      _mm_or_si128(_mm_cmpeq_epi8(m, _mm_set1_epi8(7)), _mm_cmpeq_epi8(m, _mm_set1_epi8(20))));
+    if (_mm_movemask_epi8(ok) != 0xFFFF) return 0;
+
+    v = _mm_and_si128(_mm_srli_epi16(x, 1), _mm_set1_epi8(3));
+    v = _mm_maddubs_epi16(v, _mm_set1_epi16(0x0401));                 /* v0 + 4*v1 */
+    v = _mm_madd_epi16(v, _mm_set1_epi32(0x00100001));                /* p0 + 16*p1 */
+    v = _mm_shuffle_epi8(v, _mm_setr_epi8(0, 4, 8, 12, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1));
+    *out = (uint32_t) _mm_cvtsi128_si32(v);
+    return 1;
+}
+
+__attribute__((target("sse4.2")))
+static inline size_t ss_encode_sse42(uint64_t* dst, uint8_t* src, size_t n_blocks) {
+    uint32_t lo, hi;
+    size_t i;
+
+    for (i = 0; i < n_blocks; i++, src += 32) {
+        if (!ss_encode_16_sse(src, &lo) || !ss_encode_16_sse(src + 16, &hi)) return i;
+        dst[i] = lo | ((uint64_t) hi << 32);
+    }
+
+    return n_blocks;
+}
+
+/* Expands 16 bases at a time. Each byte of packed input is copied to four lanes, and each
+   lane keeps its own base (or four times its base) as an index into a 16-entry table. */
+__attribute__((target("sse4.2")))
+static inline void ss_decode_sse42(char* dst, uint64_t* blocks, size_t length) {
+    const __m128i table = _mm_setr_epi8('A', 'C', 'T', 'G', 'C', 0, 0, 0, 'T', 0, 0, 0, 'G', 0, 0, 0);
+    const __m128i spread = _mm_setr_epi8(0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3);
+    const __m128i low = _mm_setr_epi8(3, 12, 0, 0, 3, 12, 0, 0, 3, 12, 0, 0, 3, 12, 0, 0);
+    const __m128i high = _mm_setr_epi8(0, 0, 3, 12, 0, 0, 3, 12, 0, 0, 3, 12, 0, 0, 3, 12);
+    const uint8_t* src = (const uint8_t*) blocks;
+    size_t i, n_groups = length / 16;
+    uint32_t word;
+    __m128i x, idx;
+
+    for (i = 0; i < n_groups; i++) {
+        memcpy(&word, src + 4 * i, 4);
+        x = _mm_shuffle_epi8(_mm_cvtsi32_si128((int) word), spread);
+        idx = _mm_or_si128(_mm_and_si128(x, low), _mm_and_si128(_mm_srli_epi16(x, 4), high));
+        _mm_storeu_si128((__m128i*) (dst + 16 * i), _mm_shuffle_epi8(table, idx));
+    }
+
+    for (i = n_groups * 16; i < length; i++)
+        dst[i] = "ACTG"[(blocks[i / 32] >> ((i % 32) * 2)) & 3];
+}
+
+
+/* === AVX2 (shuffle/multiply) ====================================================== */
+
+/* Validates and encodes a full block of 32 characters. Characters are validated with a pair
+   of nibble lookups: a character is supported if the bits for its low and high nibbles (of
+   its low 6 bits) share a class, which is the case only for A, C, G, and T. Codes are then
+   combined as in ss_encode_16_sse, and the low byte of each quad is gathered by shuffle and
+   a cross-lane permute. */
+__attribute__((target("avx2")))
+static inline size_t ss_encode_avx2(uint64_t* dst, uint8_t* src, size_t n_blocks) {
+    const __m256i low4 = _mm256_set1_epi8(0x0F);
+    const __m256i lo_class = _mm256_setr_epi8(0, 1, 0, 1, 2, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0,
+                                              0, 1, 0, 1, 2, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0);
+    const __m256i hi_class = _mm256_setr_epi8(1, 2, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+                                              1, 2, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0);
+    const __m256i gather = _mm256_setr_epi8(0, 4, 8, 12, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1,
+                                            0, 4, 8, 12, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1);
+    const __m256i lanes = _mm256_setr_epi32(0, 4, 1, 1, 1, 1, 1, 1);
+    __m256i x, lo, hi, bad, v;
+    size_t i;
+
+    for (i = 0; i < n_blocks; i++, src += 32) {
+        x = _mm256_loadu_si256((const __m256i*) src);
+        lo = _mm256_shuffle_epi8(lo_class, _mm256_and_si256(x, low4));
+        hi = _mm256_shuffle_epi8(hi_class, _mm256_and_si256(_mm256_srli_epi16(x, 4), _mm256_set1_epi8(0x03)));
+        bad = _mm256_cmpeq_epi8(_mm256_and_si256(lo, hi), _mm256_setzero_si256());
+        if (_mm256_movemask_epi8(bad)) return i;
+
+        v = _mm256_and_si256(_mm256_srli_epi16(x, 1), _mm256_set1_epi8(3));
+        v = _mm256_maddubs_epi16(v, _mm256_set1_epi16(0x0401));
+        v = _mm256_madd_epi16(v, _mm256_set1_epi32(0x00100001));
+        v = _mm256_permutevar8x32_epi32(_mm256_shuffle_epi8(v, gather), lanes);
+        dst[i] = (uint64_t) _mm_cvtsi128_si64(_mm256_castsi256_si128(v));
+    }
+
+    return n_blocks;
+}
+
+/* Expands a full block of 32 bases at a time, as in ss_decode_sse42 with one packed
+   byte per 4 lanes. The remaining bases are decoded by ss_decode_sse42. */
+__attribute__((target("avx2")))
+static inline void ss_decode_avx2(char* dst, uint64_t* blocks, size_t length) {
+    const __m256i table = _mm256_setr_epi8('A', 'C', 'T', 'G', 'C', 0, 0, 0, 'T', 0, 0, 0, 'G', 0, 0, 0,
+                                           'A', 'C', 'T', 'G', 'C', 0, 0, 0, 'T', 0, 0, 0, 'G', 0, 0, 0);
+    const __m256i spread = _mm256_setr_epi8(0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3,
+                                            4, 4, 4, 4, 5, 5, 5, 5, 6, 6, 6, 6, 7, 7, 7, 7);
+    const __m256i low = _mm256_set1_epi32(0x00000C03);
+    const __m256i high = _mm256_set1_epi32(0x0C030000);
+    size_t i, n_blocks = length / 32;
+    __m256i x, idx;
+
+    for (i = 0; i < n_blocks; i++) {
+        x = _mm256_shuffle_epi8(_mm256_set1_epi64x((long long) blocks[i]), spread);
+        idx = _mm256_or_si256(_mm256_and_si256(x, low), _mm256_and_si256(_mm256_srli_epi16(x, 4), high));
+        _mm256_storeu_si256((__m256i*) (dst + 32 * i), _mm256_shuffle_epi8(table, idx));
+    }
+
+    ss_decode_sse42(dst + 32 * n_blocks, blocks + n_blocks, length - 32 * n_blocks);
+}
+
+#else
+
+/* Never selected on other architectures, but referenced by the variant table */
+#define ss_encode_avx2 ss_encode_swar
+#define ss_decode_avx2 ss_decode_portable
+#define ss_encode_sse42 ss_encode_swar
+#define ss_decode_sse42 ss_decode_portable
+
+#endif  /* SS_X86 */
+
+
+/* === CPU features ================================================================= */
+
+enum {
+    SS_CPU_SSE42 = 1,
+    SS_CPU_POPCNT = 2,
+    SS_CPU_AVX2 = 4,
+    SS_CPU_BMI2 = 8,
+    SS_CPU_SLOW_PEXT = 16,         /* pext is microcoded (AMD before Zen 3) */
+};
+
+static inline int ss_cpu_features(void) {
+    int features = 0;
+#if SS_X86
+    unsigned int eax, ebx, ecx, edx, family;
+
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("sse4.2") && __builtin_cpu_supports("ssse3")) features |= SS_CPU_SSE42;
+    if (__builtin_cpu_supports("popcnt")) features |= SS_CPU_POPCNT;
+    if (__builtin_cpu_supports("avx2")) features |= SS_CPU_AVX2;
+    if (__builtin_cpu_supports("bmi2")) features |= SS_CPU_BMI2;
+
+    if (__builtin_cpu_is("amd") && __get_cpuid(1, &eax, &ebx, &ecx, &edx)) {
+        family = (eax >> 8) & 0xF;
+        if (family == 0xF) family += (eax >> 20) & 0xFF;
+        if (family < 0x19) features |= SS_CPU_SLOW_PEXT;
+    }
+#endif
+    return features;
+}
+
+#endif  /* SHORTSEQ_KERNELS_H */
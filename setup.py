@@ -16,12 +16,18 @@ define_macros = []
 short_seq_common_compile_args = [
     '-std=c++20',
     "-O3",
-    "-mbmi2",
-    "-mpopcnt",
-    "-mtune=native",
-    '-march=native',
+    '-pthread',
 ]
 
+# Kernels that need instructions beyond the x86-64 baseline are compiled with per-function
+# target attributes and selected at runtime (see shortseq/kernels.h), so binaries are portable.
+# SHORTSEQ_NATIVE=1 additionally tunes the remaining code for the build machine.
+if os.environ.get("SHORTSEQ_NATIVE") == '1':
+    short_seq_common_compile_args += ['-march=native', '-mtune=native']
+
+short_seq_common_link_args = ['-pthread']
+short_seq_common_libraries = ['z']
+
 cython_implementations = [
     "shortseq/short_seq.pyx",
     "shortseq/short_seq_var.pyx",
@@ -29,6 +35,10 @@ cython_implementations = [
     "shortseq/short_seq_64.pyx",
     "shortseq/fast_read.pyx",
     "shortseq/counter.pyx",
+    "shortseq/short_seq_array.pyx",
+    "shortseq/distance.pyx",
+    "shortseq/kmer.pyx",
+    "shortseq/decode.pyx",
     "shortseq/util.pyx",
     "shortseq/umi/umi.pyx",
 ]
@@ -41,6 +51,9 @@ extensions = [
         pyx.replace("/", ".").replace(".pyx", ""),
         sources=[pyx],
         extra_compile_args=short_seq_common_compile_args,
+        extra_link_args=short_seq_common_link_args,
+        libraries=short_seq_common_libraries,
+        include_dirs=['shortseq'],
         define_macros=define_macros,
         language='c++',
     )
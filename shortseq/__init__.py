@@ -1,13 +1,22 @@
 from .short_seq import (
     pack,
     from_str,
-    from_bytes
+    from_bytes,
+    InternPool,
+    set_intern_pool,
+    get_intern_pool
 )
 
 from .short_seq_var import ShortSeqVar, get_domain_var
 from .short_seq_192 import ShortSeq192, get_domain_192
 from .short_seq_64 import ShortSeq64, get_domain_64
-from .counter import ShortSeqCounter, read_and_count_fastq
+from .short_seq_array import ShortSeqArray
+from .distance import hamming_many, hamming_matrix, within, edit_distance, edit_distance_many, HammingIndex
+from .counter import ShortSeqCounter, PackedCounter, ShardedCounter, read_and_count_fastq, read_and_count
+from .fast_read import open_reader, detect_format, ReadFilter
+from .kmer import kmers, kmers_from_file, count_kmers, decode_kmer, KmerCounter
+from .decode import to_strings, write_fasta, write_tsv
+from .util import KERNEL_VARIANTS, available_kernels, get_kernels, set_kernels, cpu_features
 
 MIN_VAR_NT, MAX_VAR_NT = get_domain_var()
 MIN_192_NT, MAX_192_NT = get_domain_192()
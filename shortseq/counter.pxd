@@ -1,28 +1,138 @@
-from cpython.dict cimport PyDict_GetItem, PyDict_SetItem
+from cpython.dict cimport PyDict_GetItem, PyDict_SetItem, PyDict_Next
 from cpython.exc cimport PyErr_Occurred
 from cpython.list cimport PyList_GET_ITEM
 from cpython.long cimport PyLong_FromSize_t
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_Check
+from cpython.mem cimport PyMem_RawMalloc, PyMem_RawCalloc, PyMem_RawRealloc, PyMem_RawFree
+from libc.string cimport memcmp, memcpy, memset
+from libc.stdlib cimport malloc, calloc, free
+from libc.stdint cimport uint16_t
 
-from libcpp.vector cimport vector
-
-from .short_seq cimport _from_chars, _from_py_bytes
-from .short_seq_64 cimport ShortSeq64
+from .short_seq cimport pack, _new, _from_chars, _from_py_bytes, _from_packed, _packed_blocks, _canonical
+from .short_seq_64 cimport ShortSeq64, MAX_64_NT
 from .short_seq_192 cimport ShortSeq192
-from .short_seq_var cimport ShortSeqVar
+from .short_seq_var cimport ShortSeqVar, MAX_VAR_NT
 from .fast_read cimport *
+from .decode cimport _DecodeBatch, _batch_of_counts
 from .util cimport *
 
 # Singleton Values
 cdef object one
 
 cdef class ShortSeqCounter(dict):
-    cdef _count_short_seq_vector(self, vector[PyObject *])
-    cdef _count_chars_vector(self, vector[char*] it)
+    cdef readonly bint canonical
+
+    cdef _count_reads(self, SeqReader reader)
+    cdef _count_pack_jobs(self, _PackJob* jobs, size_t n_jobs)
     cdef _count_py_bytes_list(self, list it)
     cdef _count_sequence(self, object seq)
+    cdef int _add_count(self, object seq, object count, Py_hash_t seqhash) except -1
+    cdef _merge(self, object other)
+
+
+"""
+PackedCounter is an open-addressing hash table keyed directly on packed blocks.
+Keys up to 32 bases are held inline in their slot, and longer keys are stored in
+an arena of blocks. Counts are held inline as uint32 values; the rare count that
+exceeds this range is kept in a dict instead. A count of zero marks an empty slot.
+"""
+
+ctypedef struct _Slot:                 # 16 bytes
+    uint64_t key                       # The packed block (<= 32 nt), or an arena offset
+    uint32_t count                     # COUNT_OVERFLOW if the count is held in _big_counts
+    uint16_t length
+    uint16_t tag                       # Upper hash bits, to reject mismatches without a memcmp
+
+cdef enum:
+    COUNT_OVERFLOW = 0xFFFFFFFF
+
+cdef class PackedCounter:
+    cdef _Slot* _slots
+    cdef size_t _capacity              # Always a power of two
+    cdef size_t _size
+    cdef uint64_t* _arena
+    cdef size_t _arena_size
+    cdef size_t _arena_cap
+    cdef dict _big_counts
+    cdef readonly bint canonical
+
+    cdef _Slot* _find(self, uint64_t* blocks, size_t length, Py_hash_t seqhash) noexcept nogil
+    cdef int _add(self, uint64_t* blocks, size_t length, uint64_t count) except -1
+    cdef int _add_hashed(self, uint64_t* blocks, size_t length, uint64_t count, Py_hash_t seqhash) except -1
+    cdef int _insert(self, uint64_t* blocks, size_t length, uint64_t count, Py_hash_t seqhash,
+                     _Slot** found) noexcept nogil
+    cdef int _add_chars(self, char* sequence, size_t length) except -1
+    cdef int _add_overflow(self, _Slot* slot, uint64_t count) except -1
+    cdef int _grow(self) noexcept nogil
+    cdef object _count_of(self, _Slot* slot)
+    cdef object _key_of(self, _Slot* slot)
+    cdef _merge(self, object other)
+    cdef _count_reads(self, SeqReader reader)
+    cdef _count_pack_jobs(self, _PackJob* jobs, size_t n_jobs)
+
+
+"""
+ShardedCounter partitions keys among independent counters by their hash. When native
+shards are counted in parallel, each worker first hashes the reads of one pack job,
+then adds the reads of the whole round that belong to its share of the shards.
+"""
+
+ctypedef struct _ShardJob:
+    _PackJob* pack_jobs                # The round of packed reads
+    size_t n_pack_jobs
+    Py_hash_t* hashes                  # Hash of each read in the round
+    PyObject** shards                  # Borrowed references to the PackedCounter shards
+    size_t n_shards
+    size_t worker                      # Adds the keys of shards where index % n_workers == worker
+    size_t n_workers
+    bint canonical
+    bint no_memory
+    bint running
+    pthread_t thread
+
+cdef class ShardedCounter:
+    cdef PyObject** _refs              # Borrowed references to the shards, for worker threads
+    cdef readonly tuple shards
+    cdef readonly bint native
+    cdef readonly bint canonical
+
+    cdef int _set_shards(self, list shards) except -1
+    cdef int _add_seq(self, object seq, object count) except -1
+    cdef _count_reads(self, SeqReader reader)
+    cdef _count_pack_jobs(self, _PackJob* jobs, size_t n_jobs)
+
+
+"""
+Binary format for saving counts. All integers are uint64 unless noted, in the byte order
+of the machine that wrote the file, and every section is 8-byte aligned so that the file can
+be used in place via mmap. The version field also serves as a byte order mark: files written
+on a machine with the other byte order are recognized by it and rejected.
+
+    Header (32 bytes):      magic "SHORTSEQ", version (uint32), flags (uint32),
+                            number of entries, number of length buckets
+    Flags:                  bit 0 is set if the keys are canonical (see canonical counting),
+                            and bits 8-15 hold k for a KmerCounter (otherwise 0)
+    Bucket table:           per bucket (32 bytes): sequence length, number of entries,
+                            offset of packed blocks, offset of counts
+    Bucket data:            per bucket: the packed blocks of each sequence, concatenated,
+                            followed by the count of each sequence
+"""
+
+cdef enum:
+    DUMP_VERSION = 1
+    DUMP_HEADER_BYTES = 32
+    DUMP_BUCKET_BYTES = 32
+    DUMP_CANONICAL = 1
+    DUMP_K_SHIFT = 8
+
+cdef _dump_counts(object counts, object filename)
+cdef _load_counts(object counts, object filename)
 
 
-cpdef ShortSeqCounter read_and_count_fastq(object filename)
+cpdef object read_and_count_fastq(object filename, size_t threads=*, bint native=*, bint mmap=*, bint canonical=*,
+                                  ReadFilter read_filter=*)
+cpdef object read_and_count(object filename, str format=*, size_t threads=*, bint native=*, bint mmap=*, bint canonical=*,
+                            size_t shards=*, ReadFilter read_filter=*)
 
 """
 Private dictionary fast-path methods not currently offered by the Cython wrapper
@@ -1,15 +1,24 @@
 import cython
+import mmap
 import time
 
-from cython.operator cimport dereference as deref
+from .fast_read import open_reader
+from .decode import write_fasta, write_tsv
+
+import numpy as np
 
 # Singleton Values
 one = PyLong_FromSize_t(1)
 
 
 cdef class ShortSeqCounter(dict):
-    def __init__(self, source=None):
+    """A dict of ShortSeq counts. If canonical is True, counting is strand-collapsed:
+    each sequence is counted under whichever of it and its reverse complement comes
+    first alphabetically (see ShortSeq.canonical())."""
+
+    def __init__(self, source=None, bint canonical=False):
         super().__init__()
+        self.canonical = canonical
 
         if type(source) is list:
             self._count_py_bytes_list(source)
@@ -19,6 +28,82 @@ cdef class ShortSeqCounter(dict):
             raise TypeError(f"{self.__class__} does not support {type(key)} keys")
         PyDict_SetItem(self, key, val)
 
+    def __reduce__(self):
+        return self.__class__, (None, self.canonical), None, None, iter(self.items())
+
+    def merge(self, *others):
+        """Adds the counts of each of others, which may be ShortSeqCounters, PackedCounters,
+        ShardedCounters, or mappings of sequences to counts, and returns self. Each key's
+        hash is computed from its packed blocks and passed to the dict, so merging never
+        calls __hash__."""
+
+        for other in others:
+            self._merge(other)
+        return self
+
+    def __add__(self, other):
+        return type(self)(canonical=self.canonical).merge(self, other)
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def dump(self, filename):
+        """Saves the counts to a binary file that can be read with load(). Sequences
+        are stored as packed blocks, grouped by length, with uint64 counts."""
+
+        _dump_counts(self, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Reads counts that were saved with dump(). The file is memory mapped
+        rather than read into an intermediate buffer."""
+
+        counts = cls()
+        _load_counts(counts, filename)
+        return counts
+
+    def to_tsv(self, filename, bint sort=False, size_t threads=1):
+        """Writes "{sequence}\\t{count}" lines. Sequences are decoded from their packed blocks
+        straight into a large output buffer, in parallel with the specified number of threads.
+        If sort is True, lines are written in descending order of count."""
+
+        write_tsv(self, filename, threads, sort)
+
+    def to_fasta(self, filename, bint sort=False, size_t threads=1):
+        """Writes a FASTA record for each sequence, with the header ">{index}_count={count}".
+        See to_tsv() for the remaining arguments."""
+
+        write_fasta(self, filename, threads, sort)
+
+    def to_numpy(self, bint sort=False):
+        """Returns three NumPy arrays: the packed blocks of every sequence, concatenated
+        (uint64, each sequence starting on a new block), the length of each sequence (uint16),
+        and each count (uint64). If sort is True, sequences are in descending order of count."""
+
+        cdef:
+            _DecodeBatch batch = _batch_of_counts(self, sort)
+            uint64_t[::1] words_view, counts_view
+            uint16_t[::1] lengths_view
+            size_t n_blocks = 0, i
+
+        for i in range(batch.size):
+            n_blocks += _nt_len_to_block_num(batch.lengths[i])
+
+        words = np.empty(n_blocks, dtype=np.uint64)
+        lengths = np.empty(batch.size, dtype=np.uint16)
+        counts = np.empty(batch.size, dtype=np.uint64)
+        words_view, lengths_view, counts_view = words, lengths, counts
+
+        n_blocks = 0
+        for i in range(batch.size):
+            if batch.lengths[i]:
+                memcpy(&words_view[n_blocks], batch.srcs[i], _nt_len_to_block_num(batch.lengths[i]) * sizeof(uint64_t))
+                n_blocks += _nt_len_to_block_num(batch.lengths[i])
+            lengths_view[i] = batch.lengths[i]
+            counts_view[i] = batch.counts[i]
+
+        return words, lengths, counts
+
     @cython.boundscheck(False)
     cdef _count_py_bytes_list(self, list it):
         cdef bytes seqbytes
@@ -28,44 +113,999 @@ cdef class ShortSeqCounter(dict):
             seq = _from_py_bytes(seqbytes)
             self._count_sequence(seq)
 
-    cdef _count_short_seq_vector(self, vector[PyObject *] &short_seqs):
-        for seq in short_seqs:
-            self._count_sequence(<object>seq)
+    cdef _count_reads(self, SeqReader reader):
+        cdef char* seqchars
+        cdef size_t length
 
-    @cython.boundscheck(False)
-    cdef _count_chars_vector(self, vector[char *] &raw_lines):
-        for seqchars in raw_lines:
-            seq = _from_chars(seqchars)
+        while reader.next_seq(&seqchars, &length):
+            seq = _new(seqchars, length)
             self._count_sequence(seq)
 
+    cdef _count_pack_jobs(self, _PackJob* jobs, size_t n_jobs):
+        cdef:
+            _PackJob* job
+            uint64_t* words
+            size_t length, i, j
+
+        for j in range(n_jobs):
+            job = &jobs[j]
+            if job.no_memory:
+                raise MemoryError("Error while allocating packed blocks.")
+
+            words = job.words
+            for i in range(job.n_reads):
+                length = job.starts[i + 1] - job.starts[i]
+                if i == job.n_bad:
+                    # Repack with the GIL to raise the appropriate exception for this read
+                    _new(job.text + job.starts[i], length)
+                    raise Exception("Something went wrong while packing a sequence.")
+
+                seq = _from_packed(words, length)
+                self._count_sequence(seq)
+                words += _nt_len_to_block_num(length)
+
     cdef inline _count_sequence(self, object seq):
-        cdef PyObject *oldval
+        if self.canonical:
+            seq = _canonical(seq)
 
-        seqhash = deref(<ShortSeqGeneric*>seq)._packed
-        oldval = _PyDict_GetItem_KnownHash(self, seq, seqhash)
+        self._add_count(seq, one, _hash_short_seq(seq))
+
+    cdef inline int _add_count(self, object seq, object count, Py_hash_t seqhash) except -1:
+        cdef PyObject *oldval = _PyDict_GetItem_KnownHash(self, seq, seqhash)
 
         if oldval == NULL:
             if PyErr_Occurred():
                 raise Exception("Something went wrong while retrieving sequence count.")
-            if _PyDict_SetItem_KnownHash(self, seq, one, seqhash) < 0:
+            if _PyDict_SetItem_KnownHash(self, seq, count, seqhash) < 0:
                 raise Exception("Something went wrong while setting a new sequence count.")
         else:
-            if _PyDict_SetItem_KnownHash(self, seq, <object>oldval + 1, seqhash) < 0:
+            if _PyDict_SetItem_KnownHash(self, seq, <object>oldval + count, seqhash) < 0:
                 raise Exception("Something went wrong while setting an incremented sequence count.")
 
+        return 0
+
+    cdef _merge(self, object other):
+        cdef:
+            bint canon = self.canonical and not getattr(other, "canonical", False)
+            PackedCounter packed
+            PyObject* key
+            PyObject* val
+            Py_ssize_t pos = 0
+            _Slot* slot
+            size_t i
+
+        if other is self:
+            other = dict(self)
+
+        if isinstance(other, PackedCounter):
+            packed = <PackedCounter> other
+            for i in range(packed._capacity):
+                slot = &packed._slots[i]
+                if not slot.count: continue
+                seq = packed._key_of(slot)
+                if canon:
+                    seq = _canonical(seq)
+                    self._add_count(seq, packed._count_of(slot), _hash_short_seq(seq))
+                else:
+                    self._add_count(seq, packed._count_of(slot), _hash_key(_slot_blocks(packed, slot), slot.length))
+        elif isinstance(other, dict):
+            while PyDict_Next(other, &pos, &key, &val):
+                seq = <object> key
+                if type(seq) not in (ShortSeq64, ShortSeq192, ShortSeqVar):
+                    seq = pack(seq)
+                if canon:
+                    seq = _canonical(seq)
+                self._add_count(seq, <object> val, _hash_short_seq(seq))
+        elif hasattr(other, "items"):
+            for seq, count in other.items():
+                seq = _canonical(pack(seq)) if canon else pack(seq)
+                self._add_count(seq, count, _hash_short_seq(seq))
+        else:
+            raise TypeError(f"Cannot merge counts from {type(other)}")
+
+
+cdef class PackedCounter:
+    """A counter of sequences that stores each unique sequence as packed blocks in a
+    native open-addressing hash table, with its count held inline. No Python objects are
+    allocated while counting. ShortSeq keys are materialized lazily upon iteration.
+
+    PackedCounter offers a read-only dict-like view: len(), indexing, `in`, get(),
+    keys(), values(), and items(). Keys may be given as ShortSeqs, str, or bytes.
+    If canonical is True, every key is added as its canonical (strand-collapsed) form.
+    """
+
+    def __cinit__(self):
+        self._capacity = 16
+        self._arena_cap = 64
+        self._big_counts = {}
+        self._slots = <_Slot *> PyMem_RawCalloc(self._capacity, sizeof(_Slot))
+        self._arena = <uint64_t *> PyMem_RawMalloc(self._arena_cap * sizeof(uint64_t))
+
+        if self._slots is NULL or self._arena is NULL:
+            raise MemoryError("Error while allocating a PackedCounter.")
+
+    def __init__(self, source=None, bint canonical=False):
+        self.canonical = canonical
+        if source is not None:
+            self.update(source)
+
+    def update(self, source):
+        """Counts each sequence in source, which may be an iterable of sequences
+        (str, bytes, or ShortSeq) or a mapping of sequences to counts."""
+
+        cdef uint64_t* blocks
+        cdef size_t length
+
+        if hasattr(source, "items"):
+            for key, count in source.items():
+                seq = pack(key)
+                blocks = _packed_blocks(seq, &length)
+                self._add(blocks, length, count)
+        else:
+            for key in source:
+                if PyBytes_Check(key):
+                    self._add_chars(PyBytes_AS_STRING(key), Py_SIZE(key))
+                else:
+                    seq = pack(key)
+                    blocks = _packed_blocks(seq, &length)
+                    self._add(blocks, length, 1)
+
+    def merge(self, *others):
+        """Adds the counts of each of others and returns self. Keys of other PackedCounters
+        are added straight from their packed blocks; see ShortSeqCounter.merge()."""
+
+        for other in others:
+            self._merge(other)
+        return self
+
+    def total(self):
+        """Returns the sum of all counts."""
+
+        return sum(self.values())
+
+    def to_counter(self):
+        """Returns the counts as a ShortSeqCounter."""
+
+        return ShortSeqCounter(canonical=self.canonical).merge(self)
+
+    def keys(self):
+        for seq, _ in self.items():
+            yield seq
+
+    def values(self):
+        cdef size_t i
+
+        for i in range(self._capacity):
+            if self._slots[i].count:
+                yield self._count_of(&self._slots[i])
+
+    def items(self):
+        cdef size_t size = self._size
+        cdef size_t i = 0
+
+        while i < self._capacity:
+            if self._slots[i].count:
+                yield self._key_of(&self._slots[i]), self._count_of(&self._slots[i])
+                if self._size != size:
+                    raise RuntimeError("PackedCounter changed size during iteration")
+            i += 1
+
+    def get(self, key, default=None):
+        cdef uint64_t* blocks
+        cdef size_t length
+        cdef _Slot* slot
+
+        seq = pack(key)
+        blocks = _packed_blocks(seq, &length)
+        slot = self._find(blocks, length, _hash_key(blocks, length))
+        return self._count_of(slot) if slot.count else default
+
+    def __getitem__(self, key):
+        count = self.get(key)
+        if count is None:
+            raise KeyError(key)
+        return count
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        return self._size
+
+    def __eq__(self, other):
+        if not hasattr(other, "items") or len(self) != len(other):
+            return False
+        return all(self.get(seq) == count for seq, count in other.items())
+
+    def __repr__(self):
+        return f"<PackedCounter: {self._size} unique sequences>"
+
+    def __reduce__(self):
+        return PackedCounter, (dict(self.items()), self.canonical)
+
+    def dump(self, filename):
+        """Saves the counts in the same binary format as ShortSeqCounter.dump()."""
+
+        _dump_counts(self, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Reads counts that were saved with ShortSeqCounter.dump() or PackedCounter.dump().
+        Keys are added straight from the memory mapped file without creating ShortSeqs."""
+
+        counts = cls()
+        _load_counts(counts, filename)
+        return counts
+
+    def __sizeof__(self):
+        return sizeof(PackedCounter) + \
+               self._capacity * sizeof(_Slot) + \
+               self._arena_cap * sizeof(uint64_t)
+
+    def __dealloc__(self):
+        PyMem_RawFree(self._slots)
+        PyMem_RawFree(self._arena)
+
+    cdef _Slot* _find(self, uint64_t* blocks, size_t length, Py_hash_t seqhash) noexcept nogil:
+        """Returns the slot holding the key, or the empty slot where it belongs."""
+
+        cdef:
+            size_t mask = self._capacity - 1
+            size_t i = <size_t> seqhash & mask
+            uint16_t tag = <uint16_t> (<uint64_t> seqhash >> 48)
+            size_t n_bytes = _nt_len_to_block_num(length) * sizeof(uint64_t)
+            uint64_t inline_key = blocks[0] if length else 0
+            _Slot* slot
+
+        while True:
+            slot = &self._slots[i]
+            if slot.count == 0:
+                return slot
+            if slot.tag == tag and slot.length == length:
+                if length <= MAX_64_NT:
+                    if slot.key == inline_key: return slot
+                elif memcmp(self._arena + slot.key, blocks, n_bytes) == 0:
+                    return slot
+            i = (i + 1) & mask
+
+    cdef int _add(self, uint64_t* blocks, size_t length, uint64_t count) except -1:
+        cdef uint64_t rc[32]           # Enough for MAX_VAR_NT bases
+
+        if self.canonical:
+            blocks = _canonical_blocks(blocks, length, rc)
+
+        return self._add_hashed(blocks, length, count, _hash_key(blocks, length))
+
+    cdef int _add_hashed(self, uint64_t* blocks, size_t length, uint64_t count, Py_hash_t seqhash) except -1:
+        """Adds a key that has already been canonicalized (if applicable) and hashed."""
+
+        cdef _Slot* slot
+        cdef int status = self._insert(blocks, length, count, seqhash, &slot)
+
+        if status < 0:
+            raise MemoryError("Error while growing a PackedCounter.")
+        if status > 0:
+            self._add_overflow(slot, count)
+
+        return 0
+
+    cdef int _insert(self, uint64_t* blocks, size_t length, uint64_t count, Py_hash_t seqhash,
+                     _Slot** found) noexcept nogil:
+        """Finds or inserts the key's slot and adds count to it. Returns -1 if memory couldn't
+        be allocated, or 1 if the count no longer fits in the slot, in which case the caller
+        must add it with _add_overflow(). Safe to call without the GIL."""
+
+        cdef:
+            size_t n_blocks = _nt_len_to_block_num(length)
+            _Slot* slot
+            uint64_t* grown
+
+        if count == 0:
+            return 0
+
+        slot = self._find(blocks, length, seqhash)
+
+        if slot.count == 0:
+            # Keep the load factor at or below 0.7
+            if (self._size + 1) * 10 > self._capacity * 7:
+                if self._grow() < 0:
+                    return -1
+                slot = self._find(blocks, length, seqhash)
+
+            if length <= MAX_64_NT:
+                slot.key = blocks[0] if length else 0
+            else:
+                if self._arena_size + n_blocks > self._arena_cap:
+                    grown = <uint64_t *> PyMem_RawRealloc(self._arena, self._arena_cap * 2 * sizeof(uint64_t))
+                    if grown is NULL:
+                        return -1
+                    self._arena = grown
+                    self._arena_cap *= 2
+
+                memcpy(self._arena + self._arena_size, blocks, n_blocks * sizeof(uint64_t))
+                slot.key = self._arena_size
+                self._arena_size += n_blocks
+
+            slot.length = <uint16_t> length
+            slot.tag = <uint16_t> (<uint64_t> seqhash >> 48)
+            self._size += 1
+
+        found[0] = slot
+        if slot.count != COUNT_OVERFLOW and slot.count + count < COUNT_OVERFLOW:
+            slot.count += count
+            return 0
+
+        return 1
+
+    cdef int _add_overflow(self, _Slot* slot, uint64_t count) except -1:
+        """Moves or adds to a count that no longer fits in its slot."""
+
+        key = self._key_of(slot)
+        self._big_counts[key] = self._count_of(slot) + count
+        slot.count = COUNT_OVERFLOW
+        return 0
+
+    cdef int _add_chars(self, char* sequence, size_t length) except -1:
+        """Packs the sequence onto the stack and counts it without constructing a ShortSeq."""
+
+        cdef uint64_t blocks[32]       # Enough for MAX_VAR_NT bases
+
+        if length > MAX_VAR_NT or not _pack_bytes_array(blocks, <uint8_t *> sequence, length):
+            # Repeat with the regular constructor to raise the appropriate exception
+            _new(sequence, length)
+            raise Exception("Something went wrong while packing a sequence.")
+
+        return self._add(blocks, length, 1)
+
+    cdef int _grow(self) noexcept nogil:
+        """Doubles the table's capacity. Returns -1 if memory couldn't be allocated."""
+
+        cdef:
+            size_t capacity = self._capacity * 2
+            size_t mask = capacity - 1
+            _Slot* slots = <_Slot *> PyMem_RawCalloc(capacity, sizeof(_Slot))
+            _Slot* slot
+            size_t i, j
+
+        if slots is NULL:
+            return -1
+
+        for i in range(self._capacity):
+            slot = &self._slots[i]
+            if slot.count:
+                j = <size_t> _hash_key(_slot_blocks(self, slot), slot.length) & mask
+                while slots[j].count:
+                    j = (j + 1) & mask
+                slots[j] = slot[0]
+
+        PyMem_RawFree(self._slots)
+        self._slots = slots
+        self._capacity = capacity
+        return 0
+
+    cdef object _count_of(self, _Slot* slot):
+        if slot.count == COUNT_OVERFLOW:
+            return self._big_counts[self._key_of(slot)]
+        return slot.count
+
+    cdef object _key_of(self, _Slot* slot):
+        return _from_packed(_slot_blocks(self, slot), slot.length)
+
+    cdef _merge(self, object other):
+        cdef PackedCounter packed
+        cdef _Slot* slot
+        cdef size_t i
+
+        if isinstance(other, PackedCounter):
+            packed = <PackedCounter> other
+            for i in range(packed._capacity):
+                slot = &packed._slots[i]
+                if slot.count:
+                    self._add(_slot_blocks(packed, slot), slot.length,
+                              slot.count if slot.count != COUNT_OVERFLOW else packed._count_of(slot))
+        elif hasattr(other, "items"):
+            self.update(other)
+        else:
+            raise TypeError(f"Cannot merge counts from {type(other)}")
+
+    cdef _count_reads(self, SeqReader reader):
+        cdef char* seqchars
+        cdef size_t length
+
+        while reader.next_seq(&seqchars, &length):
+            self._add_chars(seqchars, length)
+
+    cdef _count_pack_jobs(self, _PackJob* jobs, size_t n_jobs):
+        cdef:
+            _PackJob* job
+            uint64_t* words
+            size_t length, i, j
+
+        for j in range(n_jobs):
+            job = &jobs[j]
+            if job.no_memory:
+                raise MemoryError("Error while allocating packed blocks.")
+
+            words = job.words
+            for i in range(job.n_reads):
+                length = job.starts[i + 1] - job.starts[i]
+                if i == job.n_bad:
+                    self._add_chars(job.text + job.starts[i], length)
+
+                self._add(words, length, 1)
+                words += _nt_len_to_block_num(length)
+
+
+cdef class ShardedCounter:
+    """Counts sequences in n_shards independent counters (shards), each holding the keys
+    whose hash falls in its partition. Since a key always belongs to the same shard, shards
+    can be filled concurrently without locking, and ShardedCounters with the same number
+    of shards are merged shard by shard. For example, the lanes of a flowcell can be counted
+    in separate processes with read_and_count(..., shards=n) and then merged.
+
+    Shards are PackedCounters if native is True, otherwise ShortSeqCounters. ShardedCounter
+    offers a read-only dict-like view of all shards: len(), indexing, `in`, get(), keys(),
+    values(), and items().
+    """
+
+    def __init__(self, size_t n_shards=16, bint native=False, bint canonical=False):
+        if n_shards == 0:
+            raise Exception("A ShardedCounter must have at least one shard.")
+
+        self.native = native
+        self.canonical = canonical
+        self._set_shards([PackedCounter(canonical=canonical) if native else ShortSeqCounter(canonical=canonical)
+                          for _ in range(n_shards)])
+
+    def shard_of(self, key):
+        """Returns the index of the shard that holds (or would hold) the key."""
 
-cpdef ShortSeqCounter read_and_count_fastq(object filename):
-    cdef ShortSeqCounter counts = ShortSeqCounter()
-    cdef vector[PyObject *] seqs
-    # cdef vector[char *] seqs
+        seq = _canonical(pack(key)) if self.canonical else pack(key)
+        return _shard_of(_hash_short_seq(seq), len(self.shards))
+
+    def update(self, source):
+        """Counts each sequence in source, which may be an iterable of sequences
+        (str, bytes, or ShortSeq) or a mapping of sequences to counts."""
+
+        if hasattr(source, "items"):
+            for key, count in source.items():
+                self._add_seq(pack(key), count)
+        else:
+            for key in source:
+                self._add_seq(pack(key), one)
+
+    def merge(self, *others):
+        """Adds the counts of each of others and returns self. A ShardedCounter with the same
+        number of shards is merged shard by shard; other counts are partitioned by key."""
+
+        cdef ShardedCounter sharded
+        cdef size_t i
+
+        for other in others:
+            if other is self:
+                other = self.to_counter()
+
+            if (isinstance(other, ShardedCounter) and len(other.shards) == len(self.shards) and
+                    (other.canonical or not self.canonical)):
+                sharded = <ShardedCounter> other
+                for i in range(len(self.shards)):
+                    self.shards[i].merge(sharded.shards[i])
+            elif hasattr(other, "items"):
+                self.update(other)
+            else:
+                raise TypeError(f"Cannot merge counts from {type(other)}")
+
+        return self
+
+    def total(self):
+        """Returns the sum of all counts."""
+
+        return sum(self.values())
+
+    def to_counter(self):
+        """Returns the counts of all shards as a single ShortSeqCounter."""
+
+        return ShortSeqCounter(canonical=self.canonical).merge(*self.shards)
+
+    def keys(self):
+        for shard in self.shards:
+            yield from shard.keys()
+
+    def values(self):
+        for shard in self.shards:
+            yield from shard.values()
+
+    def items(self):
+        for shard in self.shards:
+            yield from shard.items()
+
+    def get(self, key, default=None):
+        return self.shards[self.shard_of(key)].get(pack(key), default)
+
+    def __getitem__(self, key):
+        count = self.get(key)
+        if count is None:
+            raise KeyError(key)
+        return count
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __eq__(self, other):
+        if not hasattr(other, "items") or len(self) != len(other):
+            return False
+        return all(self.get(seq) == count for seq, count in other.items())
+
+    def __repr__(self):
+        return f"<ShardedCounter: {len(self)} unique sequences in {len(self.shards)} shards>"
+
+    def __reduce__(self):
+        return ShardedCounter, (len(self.shards), self.native, self.canonical), list(self.shards)
+
+    def __setstate__(self, shards):
+        self._set_shards(shards)
+
+    def __dealloc__(self):
+        free(self._refs)
+
+    cdef int _set_shards(self, list shards) except -1:
+        cdef size_t i
+
+        refs = <PyObject **> calloc(len(shards), sizeof(PyObject *))
+        if refs is NULL:
+            raise MemoryError("Error while allocating shards.")
+
+        free(self._refs)
+        self._refs = refs
+        self.shards = tuple(shards)
+        for i in range(len(shards)):
+            self._refs[i] = <PyObject *> self.shards[i]
+
+        return 0
+
+    cdef int _add_seq(self, object seq, object count) except -1:
+        cdef uint64_t* blocks
+        cdef size_t length
+        cdef Py_hash_t seqhash
+
+        if self.canonical:
+            seq = _canonical(seq)
+
+        seqhash = _hash_short_seq(seq)
+        if self.native:
+            blocks = _packed_blocks(seq, &length)
+            return (<PackedCounter> self._refs[_shard_of(seqhash, len(self.shards))])._add_hashed(blocks, length, count, seqhash)
+        return (<ShortSeqCounter> self._refs[_shard_of(seqhash, len(self.shards))])._add_count(seq, count, seqhash)
+
+    cdef _count_reads(self, SeqReader reader):
+        cdef:
+            uint64_t blocks[32]        # Enough for MAX_VAR_NT bases
+            uint64_t rc[32]
+            uint64_t* key
+            char* seqchars
+            size_t length
+            Py_hash_t seqhash
+
+        while reader.next_seq(&seqchars, &length):
+            if not self.native:
+                self._add_seq(_new(seqchars, length), one)
+                continue
+
+            if length > MAX_VAR_NT or not _pack_bytes_array(blocks, <uint8_t *> seqchars, length):
+                # Repeat with the regular constructor to raise the appropriate exception
+                _new(seqchars, length)
+                raise Exception("Something went wrong while packing a sequence.")
+
+            key = _canonical_blocks(blocks, length, rc) if self.canonical else blocks
+            seqhash = _hash_key(key, length)
+            (<PackedCounter> self._refs[_shard_of(seqhash, len(self.shards))])._add_hashed(key, length, 1, seqhash)
+
+    cdef _count_pack_jobs(self, _PackJob* jobs, size_t n_jobs):
+        """Counts a round of packed reads. Native shards are filled by one worker thread
+        per pack job: each worker hashes the reads of its pack job, then, once all reads
+        are hashed, adds the reads that belong to its share of the shards."""
+
+        cdef:
+            size_t n_shards = len(self.shards)
+            size_t n_workers = min(n_jobs, n_shards)
+            size_t n_reads = 0
+            _ShardJob* workers
+            Py_hash_t* hashes
+            _PackJob* job
+            uint64_t* words
+            size_t length, i, j
+
+        for j in range(n_jobs):
+            job = &jobs[j]
+            if job.no_memory:
+                raise MemoryError("Error while allocating packed blocks.")
+            if job.n_bad < job.n_reads:
+                # Repack with the GIL to raise the appropriate exception for this read
+                _new(job.text + job.starts[job.n_bad], job.starts[job.n_bad + 1] - job.starts[job.n_bad])
+                raise Exception("Something went wrong while packing a sequence.")
+            n_reads += job.n_reads
+
+        if not self.native:
+            for j in range(n_jobs):
+                words = jobs[j].words
+                for i in range(jobs[j].n_reads):
+                    length = jobs[j].starts[i + 1] - jobs[j].starts[i]
+                    self._add_seq(_from_packed(words, length), one)
+                    words += _nt_len_to_block_num(length)
+            return
+
+        if n_jobs == 0:
+            return
+
+        workers = <_ShardJob *> calloc(n_workers, sizeof(_ShardJob))
+        hashes = <Py_hash_t *> malloc(max(n_reads, 1) * sizeof(Py_hash_t))
+        if workers is NULL or hashes is NULL:
+            free(workers)
+            free(hashes)
+            raise MemoryError("Error while allocating shard jobs.")
+
+        for i in range(n_workers):
+            workers[i].pack_jobs = jobs
+            workers[i].n_pack_jobs = n_jobs
+            workers[i].hashes = hashes
+            workers[i].shards = self._refs
+            workers[i].n_shards = n_shards
+            workers[i].worker = i
+            workers[i].n_workers = n_workers
+            workers[i].canonical = self.canonical
+
+        try:
+            with nogil:
+                _run_shard_jobs(workers, n_workers, _hash_shard_main)
+                _run_shard_jobs(workers, n_workers, _count_shard_main)
+
+            for i in range(n_workers):
+                if workers[i].no_memory:
+                    raise MemoryError("Error while growing a PackedCounter.")
+        finally:
+            free(workers)
+            free(hashes)
+
+
+cdef void _run_shard_jobs(_ShardJob* jobs, size_t n_jobs, void* (*main)(void*) noexcept nogil) noexcept nogil:
+    cdef size_t i
+
+    for i in range(n_jobs):
+        jobs[i].running = n_jobs > 1 and pthread_create(&jobs[i].thread, NULL, main, &jobs[i]) == 0
+        if not jobs[i].running:
+            main(&jobs[i])
+
+    for i in range(n_jobs):
+        if jobs[i].running:
+            pthread_join(jobs[i].thread, NULL)
+
+
+cdef void* _hash_shard_main(void* arg) noexcept nogil:
+    """Canonicalizes (if applicable) and hashes the reads of every n_workers-th pack job.
+    Canonical forms replace the packed reads in place."""
+
+    cdef:
+        _ShardJob* job = <_ShardJob *> arg
+        Py_hash_t* hashes = job.hashes
+        uint64_t rc[32]                # Enough for MAX_VAR_NT bases
+        uint64_t* words
+        uint64_t* key
+        size_t length, n_blocks, i, j
+
+    for j in range(job.n_pack_jobs):
+        if j % job.n_workers == job.worker:
+            words = job.pack_jobs[j].words
+            for i in range(job.pack_jobs[j].n_reads):
+                length = job.pack_jobs[j].starts[i + 1] - job.pack_jobs[j].starts[i]
+                n_blocks = _nt_len_to_block_num(length)
+                if job.canonical:
+                    key = _canonical_blocks(words, length, rc)
+                    if key != words:
+                        memcpy(words, key, n_blocks * sizeof(uint64_t))
+                hashes[i] = _hash_key(words, length)
+                words += n_blocks
+        hashes += job.pack_jobs[j].n_reads
+
+    return NULL
+
+
+cdef void* _count_shard_main(void* arg) noexcept nogil:
+    """Adds every read that belongs to a shard whose index % n_workers == worker."""
+
+    cdef:
+        _ShardJob* job = <_ShardJob *> arg
+        Py_hash_t* hashes = job.hashes
+        uint64_t* words
+        size_t length, shard, i, j
+        _Slot* slot
+        int status
+
+    for j in range(job.n_pack_jobs):
+        words = job.pack_jobs[j].words
+        for i in range(job.pack_jobs[j].n_reads):
+            length = job.pack_jobs[j].starts[i + 1] - job.pack_jobs[j].starts[i]
+            shard = _shard_of(hashes[i], job.n_shards)
+            if shard % job.n_workers == job.worker:
+                status = (<PackedCounter> job.shards[shard])._insert(words, length, 1, hashes[i], &slot)
+                if status > 0:
+                    with gil:
+                        try:
+                            (<PackedCounter> job.shards[shard])._add_overflow(slot, 1)
+                        except MemoryError:
+                            status = -1
+                if status < 0:
+                    job.no_memory = True
+                    return NULL
+            words += _nt_len_to_block_num(length)
+        hashes += job.pack_jobs[j].n_reads
+
+    return NULL
+
+
+cdef _count_reads_parallel(object counts, SeqReader reader, size_t n_threads):
+    """Reads are packed by n_threads workers in rounds. While one round is being
+    packed, the previous round's packed reads are counted."""
+
+    _pack_reads_parallel(reader, n_threads, counts, _count_pack_jobs)
+
+
+cdef _count_pack_jobs(object counts, _PackJob* jobs, size_t n_jobs):
+    if isinstance(counts, PackedCounter):
+        (<PackedCounter> counts)._count_pack_jobs(jobs, n_jobs)
+    elif isinstance(counts, ShardedCounter):
+        (<ShardedCounter> counts)._count_pack_jobs(jobs, n_jobs)
+    else:
+        (<ShortSeqCounter> counts)._count_pack_jobs(jobs, n_jobs)
+
+
+cdef inline uint64_t* _slot_blocks(PackedCounter counts, _Slot* slot) noexcept nogil:
+    """Returns the packed blocks of the slot's key, whether held inline or in the arena."""
+
+    return &slot.key if slot.length <= MAX_64_NT else counts._arena + slot.key
+
+
+cdef inline size_t _shard_of(Py_hash_t seqhash, size_t n_shards) noexcept nogil:
+    """Partitions keys by the middle bits of their hash. The low bits are left to probing
+    within each shard, and the high bits to PackedCounter's slot tags."""
+
+    return (<uint64_t> seqhash >> 32) % n_shards
+
+
+cdef inline Py_hash_t _hash_key(uint64_t* blocks, size_t length) noexcept nogil:
+    """Hashes packed blocks exactly as the ShortSeq of the same length would be hashed."""
+
+    cdef uint64_t inline_key
+
+    if length <= MAX_64_NT:
+        inline_key = blocks[0] if length else 0
+        return _hash_blocks(&inline_key, 1, length)
+    return _hash_blocks(blocks, _nt_len_to_block_num(length), length)
+
+
+cdef inline Py_hash_t _hash_short_seq(object seq):
+    """Equivalent to hash(seq) for ShortSeqs, but without the tp_hash call overhead."""
+
+    cdef size_t length
+
+    if type(seq) is ShortSeq64:
+        return _hash_blocks(&(<ShortSeq64> seq)._packed, 1, (<ShortSeq64> seq)._length)
+    elif type(seq) is ShortSeq192:
+        length = (<ShortSeq192> seq)._length
+        return _hash_blocks((<ShortSeq192> seq)._packed, _nt_len_to_block_num(length), length)
+    else:
+        length = (<ShortSeqVar> seq)._length
+        return _hash_blocks((<ShortSeqVar> seq)._packed, _nt_len_to_block_num(length), length)
+
+
+cpdef object read_and_count_fastq(object filename, size_t threads=1, bint native=False, bint mmap=False,
+                                  bint canonical=False, ReadFilter read_filter=None):
+    """Counts the sequences in a FASTQ file in a single pass. Each read is packed
+    and counted as soon as it is read, so only unique sequences are held in memory.
+
+    Args:
+        filename: The path to a plain, gzip, or BGZF compressed FASTQ file.
+        threads: The number of threads to use for inflating BGZF blocks and for
+            packing reads. With more than one thread, reads are packed in parallel
+            and only the final conversion to ShortSeqs and counting holds the GIL.
+        native: If True, counts are returned in a PackedCounter rather than a
+            ShortSeqCounter, and no Python objects are allocated while counting.
+        mmap: If True, an uncompressed file is memory mapped and scanned in place
+            rather than streamed through a read buffer.
+        canonical: If True, each read is counted under its canonical form, so that
+            a sequence and its reverse complement share a single count.
+        read_filter: A ReadFilter that trims and filters reads before they are
+            counted. Its stats() afterwards report how many reads each stage removed.
+            Filtering takes place on the reading thread, in the same pass as counting.
+    """
+
+    return read_and_count(filename, "fastq", threads, native, mmap, canonical, 0, read_filter)
+
+
+cpdef object read_and_count(object filename, str format=None, size_t threads=1, bint native=False, bint mmap=False,
+                            bint canonical=False, size_t shards=0, ReadFilter read_filter=None):
+    """Counts the sequences in a FASTQ, FASTA, SAM, or one-sequence-per-line text file
+    in a single pass. The format is detected from the file's content unless specified.
+    See read_and_count_fastq() for the remaining arguments.
+
+    Args:
+        filename: The path to a plain, gzip, or BGZF compressed sequence file.
+        format: One of "fastq", "fasta", "sam", or "text", or None to detect it.
+        shards: If nonzero, counts are returned in a ShardedCounter with this many
+            shards. With native=True and more than one thread, shards are filled
+            concurrently by worker threads that don't hold the GIL.
+    """
+
+    cdef object counts
+    cdef SeqReader reader = open_reader(filename, format, threads, mmap, read_filter)
+
+    if shards:
+        counts = ShardedCounter(shards, native, canonical)
+    elif native:
+        counts = PackedCounter(canonical=canonical)
+    else:
+        counts = ShortSeqCounter(canonical=canonical)
 
     t1 = time.time()
-    _read_fastq_short_seqs(filename.encode('utf-8'), seqs)
-    # _read_fastq_chars(filename.encode('utf-8'), seqs)
+    if threads > 1:
+        _count_reads_parallel(counts, reader, threads)
+    elif shards:
+        (<ShardedCounter> counts)._count_reads(reader)
+    elif native:
+        (<PackedCounter> counts)._count_reads(reader)
+    else:
+        (<ShortSeqCounter> counts)._count_reads(reader)
     t2 = time.time()
-    counts._count_short_seq_vector(seqs)
-    # counts._count_chars_vector(seqs)
-    t3 = time.time()
 
-    print(f"{t2-t1:.2f}s to read {seqs.size()} total seqs, and {t3 - t2:.2f}s to count {len(counts)} unique sequences")
-    return counts
\ No newline at end of file
+    print(f"{t2-t1:.2f}s to read and count {reader.n_reads} total seqs ({len(counts)} unique sequences)")
+    return counts
+
+
+cdef _dump_counts(object counts, object filename):
+    """Writes counts, a mapping of ShortSeqs to counts, in the binary format described in
+    counter.pxd. The output file is sized up front and filled through a memory map."""
+
+    cdef:
+        size_t n_lengths = MAX_VAR_NT + 1
+        size_t* n_per_len = <size_t *> calloc(4 * n_lengths, sizeof(size_t))
+        size_t* fill = n_per_len + n_lengths
+        size_t* blocks_at = fill + n_lengths
+        size_t* counts_at = blocks_at + n_lengths
+        size_t n_buckets = 0, offset, length, n_blocks, i
+        uint8_t[::1] view
+        uint64_t* bucket
+        uint64_t* blocks
+
+    if n_per_len is NULL:
+        raise MemoryError("Error while allocating the counts file index.")
+
+    try:
+        for seq in counts.keys():
+            _packed_blocks(seq, &length)
+            n_per_len[length] += 1
+
+        offset = DUMP_HEADER_BYTES
+        for length in range(n_lengths):
+            if n_per_len[length]:
+                n_buckets += 1
+                offset += DUMP_BUCKET_BYTES
+
+        for length in range(n_lengths):
+            if not n_per_len[length]: continue
+            blocks_at[length] = offset
+            offset += n_per_len[length] * _nt_len_to_block_num(length) * sizeof(uint64_t)
+            counts_at[length] = offset
+            offset += n_per_len[length] * sizeof(uint64_t)
+
+        with open(filename, "w+b") as f:
+            f.truncate(offset)
+            mm = mmap.mmap(f.fileno(), offset)
+
+        try:
+            view = mm
+            memcpy(&view[0], <char *> b"SHORTSEQ", 8)
+            (<uint32_t *> &view[8])[0] = DUMP_VERSION
+            (<uint32_t *> &view[12])[0] = (DUMP_CANONICAL if getattr(counts, "canonical", False) else 0) | \
+                                          (getattr(counts, "k", 0) << DUMP_K_SHIFT)
+            (<uint64_t *> &view[16])[0] = len(counts)
+            (<uint64_t *> &view[24])[0] = n_buckets
+
+            bucket = <uint64_t *> &view[0] + DUMP_HEADER_BYTES // sizeof(uint64_t)
+            for length in range(n_lengths):
+                if not n_per_len[length]: continue
+                bucket[0] = length
+                bucket[1] = n_per_len[length]
+                bucket[2] = blocks_at[length]
+                bucket[3] = counts_at[length]
+                bucket += 4
+
+            for seq, count in counts.items():
+                blocks = _packed_blocks(seq, &length)
+                n_blocks = _nt_len_to_block_num(length)
+                i = fill[length]
+                fill[length] += 1
+
+                memcpy(&view[blocks_at[length]] + i * n_blocks * sizeof(uint64_t), blocks, n_blocks * sizeof(uint64_t))
+                (<uint64_t *> &view[counts_at[length]])[i] = count
+
+            mm.flush()
+        finally:
+            view = None
+            mm.close()
+    finally:
+        free(n_per_len)
+
+
+cdef _load_counts(object counts, object filename):
+    """Adds the counts of a file written by _dump_counts() to counts, which must be an
+    empty ShortSeqCounter or PackedCounter, and restores its canonical flag. Every offset
+    is validated before use. Returns the k recorded for a KmerCounter, or 0."""
+
+    cdef:
+        const uint8_t[::1] view
+        uint32_t flags
+        size_t size, n_entries, n_buckets, length, n_seqs, n_blocks, at_blocks, at_counts, b, i
+        uint64_t* bucket
+        uint64_t* blocks
+        uint64_t* seq_counts
+        bint native = isinstance(counts, PackedCounter)
+
+    with open(filename, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        view = mm
+        size = view.shape[0]
+        if size < DUMP_HEADER_BYTES or memcmp(&view[0], b"SHORTSEQ", 8) != 0:
+            raise Exception(f"{filename} is not a ShortSeq counts file.")
+        if (<uint32_t *> &view[8])[0] == __builtin_bswap32(DUMP_VERSION):
+            raise Exception(f"{filename} was written on a machine with a different byte order.")
+        if (<uint32_t *> &view[8])[0] != DUMP_VERSION:
+            raise Exception(f"Unsupported counts file version: {(<uint32_t *> &view[8])[0]}")
+
+        flags = (<uint32_t *> &view[12])[0]
+        if native:
+            (<PackedCounter> counts).canonical = flags & DUMP_CANONICAL
+        else:
+            (<ShortSeqCounter> counts).canonical = flags & DUMP_CANONICAL
+
+        n_entries = (<uint64_t *> &view[16])[0]
+        n_buckets = (<uint64_t *> &view[24])[0]
+        if n_buckets > MAX_VAR_NT + 1 or DUMP_HEADER_BYTES + n_buckets * DUMP_BUCKET_BYTES > size:
+            raise Exception(f"{filename} is truncated or corrupt.")
+
+        for b in range(n_buckets):
+            bucket = <uint64_t *> &view[DUMP_HEADER_BYTES + b * DUMP_BUCKET_BYTES]
+            length, n_seqs, at_blocks, at_counts = bucket[0], bucket[1], bucket[2], bucket[3]
+            n_blocks = _nt_len_to_block_num(length) if length <= MAX_VAR_NT else 0
+
+            if (length > MAX_VAR_NT or n_seqs > size or at_blocks % 8 or at_counts % 8 or
+                    at_blocks + n_seqs * n_blocks * sizeof(uint64_t) > size or
+                    at_counts + n_seqs * sizeof(uint64_t) > size):
+                raise Exception(f"{filename} is truncated or corrupt.")
+
+            blocks = <uint64_t *> &view[at_blocks] if n_blocks and n_seqs else NULL
+            seq_counts = <uint64_t *> &view[at_counts] if n_seqs else NULL
+
+            if native:
+                for i in range(n_seqs):
+                    (<PackedCounter> counts)._add(blocks + i * n_blocks, length, seq_counts[i])
+            else:
+                for i in range(n_seqs):
+                    PyDict_SetItem(counts, _from_packed(blocks + i * n_blocks, length), seq_counts[i])
+
+        if len(counts) != n_entries:
+            raise Exception(f"{filename} is truncated or corrupt.")
+
+        return (flags >> DUMP_K_SHIFT) & 0xFF
+    finally:
+        view = None
+        mm.close()
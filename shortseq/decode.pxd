@@ -0,0 +1,49 @@
+from libc.stdlib cimport calloc, free, qsort
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_FromStringAndSize
+from cpython.dict cimport PyDict_Next
+from cpython.list cimport PyList_New, PyList_SET_ITEM
+from cpython.long cimport PyLong_AsUnsignedLongLong
+from cpython.ref cimport Py_INCREF
+
+from .short_seq cimport pack, _packed_blocks
+from .short_seq_array cimport ShortSeqArray
+from .util cimport *
+
+"""
+Bulk decoding. Output strings (or the output buffer) are allocated up front while
+holding the GIL, then the sequences are decoded into them by threads that don't.
+"""
+
+ctypedef struct _DecodeJob:
+    uint64_t** srcs                    # Blocks of each sequence
+    size_t* lengths
+    char** dsts                        # Where each sequence is to be decoded
+    size_t start
+    size_t stop
+    bint running
+    pthread_t thread
+
+ctypedef struct _CountOrder:           # For sorting by count
+    uint64_t count
+    size_t index
+
+cdef enum:
+    WRITE_BATCH = 65536                # Records written per output buffer
+
+cdef enum RecordFormat:
+    FMT_FASTA = 0
+    FMT_TSV = 1
+
+cdef class _DecodeBatch:
+    cdef uint64_t** srcs
+    cdef size_t* lengths
+    cdef char** dsts
+    cdef uint64_t* counts              # NULL unless built from a mapping of counts
+    cdef size_t size
+    cdef list _refs                    # Keeps the sequences that srcs point into alive
+
+    cdef int _alloc(self, size_t size, bint with_counts) except -1
+    cdef int _sort_by_count(self) except -1
+    cdef int _run(self, size_t start, size_t stop, size_t n_threads) except -1
+
+cdef _DecodeBatch _batch_of_counts(object counts, bint sort)
@@ -0,0 +1,299 @@
+# cython: language_level = 3, language=c++, profile=False, linetrace=False
+
+import numpy as np
+
+
+def to_strings(object seqs, size_t threads=1):
+    """Decodes many sequences at once.
+
+    Args:
+        seqs: A ShortSeqArray, or an iterable of sequences.
+        threads: The number of threads to divide the sequences among.
+
+    Returns:
+        A list of str, in the order of seqs.
+    """
+
+    cdef _DecodeBatch batch = _DecodeBatch(seqs)
+    cdef list out = PyList_New(batch.size)
+    cdef unicode s
+    cdef size_t i
+
+    for i in range(batch.size):
+        s = PyUnicode_New(batch.lengths[i], 127)
+        Py_INCREF(s)                                         # PyList_SET_ITEM steals a reference
+        PyList_SET_ITEM(out, i, s)
+        batch.dsts[i] = <char *> PyUnicode_DATA(s)
+
+    batch._run(0, batch.size, threads)
+    return out
+
+
+def write_fasta(object seqs, object filename, size_t threads=1, bint sort=False):
+    """Writes sequences to a FASTA file, decoding them in parallel.
+
+    If seqs is a mapping of sequences to counts (e.g. a ShortSeqCounter), each record's
+    header is ">{index}_count={count}". Otherwise it is ">{index}". Records are
+    numbered from 0 in the order they are written.
+
+    Args:
+        seqs: A mapping of sequences to counts, a ShortSeqArray, or an iterable of sequences.
+        filename: The path of the output file.
+        threads: The number of threads to decode each batch of records with.
+        sort: Write counts in descending order, rather than in iteration order.
+    """
+
+    cdef _DecodeBatch batch
+
+    if hasattr(seqs, "items"):
+        batch = _batch_of_counts(seqs, sort)
+    else:
+        batch = _DecodeBatch(seqs)
+
+    with open(filename, "wb") as f:
+        _write_records(f, batch, FMT_FASTA, threads)
+
+
+def write_tsv(object counts, object filename, size_t threads=1, bint sort=False):
+    """Writes a mapping of sequences to counts as tab-separated "{sequence}\\t{count}" lines,
+    decoding the sequences in parallel. See write_fasta() for the remaining arguments."""
+
+    cdef _DecodeBatch batch = _batch_of_counts(counts, sort)
+
+    with open(filename, "wb") as f:
+        _write_records(f, batch, FMT_TSV, threads)
+
+
+cdef _write_records(object f, _DecodeBatch batch, RecordFormat fmt, size_t n_threads):
+    """Writes records in batches. Each batch's records are sized, their headers (or counts)
+    are written to a single output buffer, then their sequences are decoded into it."""
+
+    cdef:
+        bint fasta = fmt == FMT_FASTA
+        size_t start, stop, size, i
+        bytes buf
+        char* pos
+
+    for start in range(0, batch.size, WRITE_BATCH):
+        stop = min(start + WRITE_BATCH, batch.size)
+
+        size = 0
+        for i in range(start, stop):
+            size += batch.lengths[i] + 1                                 # Sequence and its newline
+            if fasta:
+                size += 2 + _uint_digits(i)                              # '>' and the header's newline
+                if batch.counts is not NULL:
+                    size += 7 + _uint_digits(batch.counts[i])            # "_count="
+            else:
+                size += 1 + _uint_digits(batch.counts[i])                # Tab
+
+        buf = PyBytes_FromStringAndSize(NULL, size)
+        pos = PyBytes_AS_STRING(buf)
+
+        for i in range(start, stop):
+            if fasta:
+                pos[0] = b'>'
+                pos = _write_uint(pos + 1, i)
+                if batch.counts is not NULL:
+                    memcpy(pos, <char *> b"_count=", 7)
+                    pos = _write_uint(pos + 7, batch.counts[i])
+                pos[0] = b'\n'
+                pos += 1
+
+            batch.dsts[i] = pos
+            pos += batch.lengths[i]
+
+            if not fasta:
+                pos[0] = b'\t'
+                pos = _write_uint(pos + 1, batch.counts[i])
+            pos[0] = b'\n'
+            pos += 1
+
+        batch._run(start, stop, n_threads)
+        f.write(buf)
+
+
+cdef class _DecodeBatch:
+    """Locates the packed blocks of each sequence to be decoded. Callers fill in dsts."""
+
+    def __cinit__(self, object seqs=None):
+        cdef ShortSeqArray arr
+        cdef size_t i
+
+        if seqs is None:
+            self._refs = []                                  # Filled by _batch_of_counts()
+            return
+
+        if isinstance(seqs, ShortSeqArray):
+            arr = <ShortSeqArray> seqs
+            arr._exports += 1                                # The array can't be reallocated while in use
+            self._refs = [arr]
+            self._alloc(arr._size, False)
+            for i in range(self.size):
+                self.srcs[i] = arr._blocks + arr._offsets[i]
+                self.lengths[i] = arr._lengths[i]
+        else:
+            self._refs = [pack(seq) for seq in seqs]
+            self._alloc(len(self._refs), False)
+            for i in range(self.size):
+                self.srcs[i] = _packed_blocks(self._refs[i], &self.lengths[i])
+
+    cdef int _alloc(self, size_t size, bint with_counts) except -1:
+        self.size = size
+        self.srcs = <uint64_t **> calloc(max(size, 1), sizeof(uint64_t *))
+        self.lengths = <size_t *> calloc(max(size, 1), sizeof(size_t))
+        self.dsts = <char **> calloc(max(size, 1), sizeof(char *))
+        if with_counts:
+            self.counts = <uint64_t *> calloc(max(size, 1), sizeof(uint64_t))
+
+        if self.srcs is NULL or self.lengths is NULL or self.dsts is NULL or (with_counts and self.counts is NULL):
+            raise MemoryError("Error while allocating decoding jobs.")
+        return 0
+
+    cdef int _sort_by_count(self) except -1:
+        """Reorders the sequences by descending count. Ties keep their original order."""
+
+        cdef:
+            _CountOrder* order = <_CountOrder *> calloc(max(self.size, 1), sizeof(_CountOrder))
+            uint64_t** srcs = <uint64_t **> calloc(max(self.size, 1), sizeof(uint64_t *))
+            size_t* lengths = <size_t *> calloc(max(self.size, 1), sizeof(size_t))
+            size_t i
+
+        if order is NULL or srcs is NULL or lengths is NULL:
+            free(order); free(srcs); free(lengths)
+            raise MemoryError("Error while sorting counts.")
+
+        with nogil:
+            for i in range(self.size):
+                order[i].count = self.counts[i]
+                order[i].index = i
+
+            qsort(order, self.size, sizeof(_CountOrder), _cmp_count_desc)
+
+            for i in range(self.size):
+                srcs[i] = self.srcs[order[i].index]
+                lengths[i] = self.lengths[order[i].index]
+                self.counts[i] = order[i].count
+
+        free(self.srcs)
+        free(self.lengths)
+        free(order)
+        self.srcs = srcs
+        self.lengths = lengths
+        return 0
+
+    cdef int _run(self, size_t start, size_t stop, size_t n_threads) except -1:
+        """Decodes sequences [start, stop) to their dsts, dividing them into contiguous
+        ranges among up to n_threads threads."""
+
+        cdef:
+            size_t size = stop - start
+            size_t n_jobs = max(1, min(n_threads, size))
+            _DecodeJob* jobs = <_DecodeJob *> calloc(n_jobs, sizeof(_DecodeJob))
+            size_t i
+
+        if jobs is NULL:
+            raise MemoryError("Error while allocating decoding jobs.")
+
+        with nogil:
+            for i in range(n_jobs):
+                jobs[i].srcs = self.srcs
+                jobs[i].lengths = self.lengths
+                jobs[i].dsts = self.dsts
+                jobs[i].start = start + size * i // n_jobs
+                jobs[i].stop = start + size * (i + 1) // n_jobs
+
+                jobs[i].running = n_jobs > 1 and pthread_create(&jobs[i].thread, NULL, _decode_main, &jobs[i]) == 0
+                if not jobs[i].running:
+                    _decode_main(&jobs[i])
+
+            for i in range(n_jobs):
+                if jobs[i].running:
+                    pthread_join(jobs[i].thread, NULL)
+
+        free(jobs)
+        return 0
+
+    def __dealloc__(self):
+        if self._refs and isinstance(self._refs[0], ShortSeqArray):
+            (<ShortSeqArray> self._refs[0])._exports -= 1
+        free(self.srcs)
+        free(self.lengths)
+        free(self.dsts)
+        free(self.counts)
+
+
+cdef _DecodeBatch _batch_of_counts(object counts, bint sort):
+    """Gathers the keys and counts of a mapping, e.g. a ShortSeqCounter. Dicts are
+    walked with PyDict_Next rather than through items() views."""
+
+    cdef:
+        _DecodeBatch batch = _DecodeBatch()
+        Py_ssize_t pos = 0
+        PyObject* key
+        PyObject* value
+        size_t i = 0
+
+    batch._alloc(len(counts), True)
+
+    if isinstance(counts, dict):
+        while PyDict_Next(counts, &pos, &key, &value):
+            seq = pack(<object> key)
+            batch._refs.append(seq)
+            batch.srcs[i] = _packed_blocks(seq, &batch.lengths[i])
+            batch.counts[i] = PyLong_AsUnsignedLongLong(<object> value)
+            i += 1
+    else:
+        for seq, count in counts.items():
+            seq = pack(seq)
+            batch._refs.append(seq)
+            batch.srcs[i] = _packed_blocks(seq, &batch.lengths[i])
+            batch.counts[i] = PyLong_AsUnsignedLongLong(count)
+            i += 1
+
+    if sort:
+        batch._sort_by_count()
+    return batch
+
+
+cdef int _cmp_count_desc(const void* a, const void* b) noexcept nogil:
+    cdef _CountOrder* x = <_CountOrder *> a
+    cdef _CountOrder* y = <_CountOrder *> b
+
+    if x.count != y.count:
+        return -1 if x.count > y.count else 1
+    return -1 if x.index < y.index else (x.index > y.index)
+
+
+cdef void* _decode_main(void* arg) noexcept nogil:
+    cdef _DecodeJob* job = <_DecodeJob *> arg
+    cdef size_t i
+
+    for i in range(job.start, job.stop):
+        if job.lengths[i]:
+            _unmarshall_blocks(job.dsts[i], job.srcs[i], job.lengths[i])
+
+    return NULL
+
+
+cdef inline size_t _uint_digits(uint64_t value) noexcept nogil:
+    cdef size_t n = 1
+
+    while value >= 10:
+        value //= 10
+        n += 1
+
+    return n
+
+
+cdef inline char* _write_uint(char* dst, uint64_t value) noexcept nogil:
+    """Writes the decimal digits of value to dst and returns the position after them."""
+
+    cdef size_t n = _uint_digits(value)
+    cdef size_t i
+
+    for i in reversed(range(n)):
+        dst[i] = <char> (c'0' + value % 10)
+        value //= 10
+
+    return dst + n
@@ -0,0 +1,84 @@
+from libc.stdlib cimport calloc, free
+from cpython.mem cimport PyMem_Malloc, PyMem_Calloc, PyMem_Free
+from libc.stdint cimport uint16_t, int64_t
+from libc.string cimport memcpy
+
+from .short_seq cimport pack, _packed_blocks
+from .short_seq_64 cimport ShortSeq64, MAX_64_NT
+from .short_seq_var cimport MAX_VAR_NT
+from .short_seq_array cimport ShortSeqArray
+from .util cimport *
+
+"""
+Bulk distance kernels. Sequences are read from a ShortSeqArray's contiguous buffer,
+the work is divided among threads that don't hold the GIL, and each thread writes
+its results directly into the output array.
+"""
+
+ctypedef struct _DistanceJob:
+    uint64_t* query                    # Blocks of the query, or NULL for all-vs-all
+    size_t length                      # Length that every sequence must have
+    uint64_t* blocks
+    uint64_t* offsets
+    uint16_t* lengths
+    size_t size
+    size_t start                       # First sequence (or row) handled by this job
+    size_t step                        # Distance between consecutive rows handled by this job
+    size_t stop
+    uint16_t* out
+    size_t n_bad                       # Index of the first sequence with a mismatched length, else size
+    size_t max_dist                    # Band for edit distance; larger distances are reported as max_dist + 1
+    bint running
+    pthread_t thread
+
+ctypedef void* (*_job_main_t)(void*) noexcept nogil
+
+
+"""
+Edit distance is computed with Myers' bit-parallel algorithm in Hyyrö's banded,
+multi-word form. Each 64-bit word holds the vertical deltas of 64 rows of the
+dynamic programming matrix, so up to 16 words cover a 1024 nt pattern.
+"""
+
+cdef enum:
+    MYERS_MAX_WORDS = 16
+
+ctypedef struct _Peq:
+    uint64_t bits[4][MYERS_MAX_WORDS]  # Per base code: the pattern positions holding that base
+    size_t length
+    size_t n_words
+
+cdef void _myers_peq(_Peq* peq, uint64_t* pattern, size_t length) noexcept nogil
+cdef size_t _myers_distance(_Peq* peq, uint64_t* text, size_t length, size_t max_dist) noexcept nogil
+
+cdef ShortSeqArray _as_array(object seqs)
+cdef size_t _run_jobs(_DistanceJob* job, size_t n_threads, _job_main_t main, bint interleave) except? 0
+
+
+"""
+HammingIndex finds whitelist entries within a small Hamming distance of a query without
+scanning the whole whitelist. By the pigeonhole principle, two sequences that differ at
+no more than d bases must agree exactly on at least one of d + 1 disjoint segments. Each
+segment therefore has its own hash table of whitelist entries keyed by that segment's
+bits, and only the entries that share a segment with the query are compared in full.
+"""
+
+cdef enum:
+    MAX_INDEX_DIST = 7
+
+cdef class HammingIndex:
+    cdef uint64_t* _keys               # Packed whitelist entries
+    cdef size_t _size
+    cdef readonly size_t length
+    cdef readonly size_t max_dist
+    cdef size_t _n_segments
+    cdef uint64_t _masks[MAX_INDEX_DIST + 1]
+    cdef size_t _bucket_bits
+    cdef uint32_t* _starts             # Per segment: the start of each bucket in _members
+    cdef uint32_t* _members            # Per segment: whitelist indices grouped by bucket
+
+    cdef size_t _bucket(self, uint64_t segment) noexcept nogil
+    cdef size_t _query(self, uint64_t query, size_t max_dist, uint32_t* hits, uint8_t* dists, Py_ssize_t* nearest) noexcept nogil
+    cdef size_t _check_dist(self, object max_dist) except? 0
+    cdef ShortSeq64 _entry(self, size_t j)
+    cdef uint64_t _packed_query(self, object seq, bint* ok)
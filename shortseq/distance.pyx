@@ -0,0 +1,632 @@
+# cython: language_level = 3, language=c++, profile=False, linetrace=False
+
+import numpy as np
+
+from .counter import ShortSeqCounter
+
+
+def hamming_many(object query, object seqs, size_t threads=1):
+    """Computes the Hamming distance between the query and each sequence.
+
+    Args:
+        query: A str, bytes, or ShortSeq.
+        seqs: A ShortSeqArray, or an iterable of sequences with the query's length.
+        threads: The number of threads to divide the sequences among.
+
+    Returns:
+        A NumPy uint16 array of distances, in the order of seqs.
+    """
+
+    cdef ShortSeqArray arr = _as_array(seqs)
+    cdef _DistanceJob job
+
+    out = np.empty(len(arr), dtype=np.uint16)
+    query = pack(query)
+    _init_job(&job, arr, query, out)
+    _run_jobs(&job, threads, _many_main, False)
+    return out
+
+
+def hamming_matrix(object seqs, size_t threads=1):
+    """Computes the Hamming distance between every pair of sequences.
+
+    Args:
+        seqs: A ShortSeqArray, or an iterable of sequences that all share the same length.
+        threads: The number of threads to divide the rows among.
+
+    Returns:
+        A symmetric NumPy uint16 array of shape (n, n) with zeros on the diagonal.
+    """
+
+    cdef ShortSeqArray arr = _as_array(seqs)
+    cdef _DistanceJob job
+
+    out = np.zeros((len(arr), len(arr)), dtype=np.uint16)
+    _init_job(&job, arr, None, out)
+    _run_jobs(&job, threads, _matrix_main, True)
+    return out
+
+
+def within(object query, object seqs, size_t max_dist, size_t threads=1):
+    """Finds the sequences that are within max_dist mismatches of the query.
+
+    Args:
+        query: A str, bytes, or ShortSeq.
+        seqs: A ShortSeqArray, or an iterable of sequences with the query's length.
+        max_dist: The maximum Hamming distance, inclusive.
+        threads: The number of threads to divide the sequences among.
+
+    Returns:
+        A NumPy int64 array of the indices of matching sequences, in ascending order.
+    """
+
+    cdef ShortSeqArray arr = _as_array(seqs)
+    cdef size_t size = len(arr)
+    cdef uint16_t[::1] dists
+    cdef int64_t[::1] hits
+    cdef size_t i, n_hits = 0
+    cdef _DistanceJob job
+
+    distances = np.empty(size, dtype=np.uint16)
+    indices = np.empty(size, dtype=np.int64)
+    query = pack(query)
+    _init_job(&job, arr, query, distances)
+    _run_jobs(&job, threads, _many_main, False)
+
+    dists, hits = distances, indices
+    with nogil:
+        for i in range(size):
+            if dists[i] <= max_dist:
+                hits[n_hits] = i
+                n_hits += 1
+
+    return indices[:n_hits].copy()
+
+
+
+def edit_distance(object a, object b, object max_dist=None):
+    """Computes the Levenshtein distance between two sequences of any length
+    directly from their packed blocks.
+
+    Args:
+        a, b: A str, bytes, or ShortSeq.
+        max_dist: If given, only distances up to max_dist are computed exactly,
+            and larger distances are reported as max_dist + 1. This limits the
+            work to a diagonal band of the alignment matrix.
+    """
+
+    cdef uint64_t* pattern
+    cdef uint64_t* text
+    cdef size_t len_a, len_b, band
+    cdef _Peq peq
+
+    a, b = pack(a), pack(b)
+    pattern = _packed_blocks(a, &len_a)
+    text = _packed_blocks(b, &len_b)
+    band = len_a + len_b if max_dist is None else max_dist
+
+    _myers_peq(&peq, pattern, len_a)
+    return _myers_distance(&peq, text, len_b, band)
+
+
+def edit_distance_many(object query, object seqs, object max_dist=None, size_t threads=1):
+    """Computes the Levenshtein distance between the query and each sequence.
+
+    Args:
+        query: A str, bytes, or ShortSeq.
+        seqs: A ShortSeqArray, or an iterable of sequences of any length.
+        max_dist: If given, distances greater than max_dist are reported as max_dist + 1.
+        threads: The number of threads to divide the sequences among.
+
+    Returns:
+        A NumPy uint16 array of distances, in the order of seqs.
+    """
+
+    cdef ShortSeqArray arr = _as_array(seqs)
+    cdef _DistanceJob job
+
+    out = np.empty(len(arr), dtype=np.uint16)
+    query = pack(query)
+    _init_job(&job, arr, query, out)
+    job.max_dist = MAX_VAR_NT * 2 if max_dist is None else min(<size_t> max_dist, MAX_VAR_NT * 2)
+    _run_jobs(&job, threads, _edit_many_main, False)
+    return out
+
+cdef ShortSeqArray _as_array(object seqs):
+    if isinstance(seqs, ShortSeqArray):
+        return <ShortSeqArray> seqs
+    return ShortSeqArray(seqs)
+
+
+cdef int _init_job(_DistanceJob* job, ShortSeqArray arr, object query, object out) except -1:
+    """Describes the whole task in job. The buffers of arr, query (a ShortSeq, or None for
+    all-vs-all), and out must outlive it."""
+
+    cdef uint16_t[::1] out_view = out.reshape(-1)
+    cdef size_t length
+
+    job.blocks = arr._blocks
+    job.offsets = arr._offsets
+    job.lengths = arr._lengths
+    job.size = arr._size
+    job.out = &out_view[0] if out_view.shape[0] else NULL
+
+    if query is not None:
+        job.query = _packed_blocks(query, &length)
+        job.length = length
+    else:
+        job.query = NULL
+        job.length = arr._lengths[0] if arr._size else 0
+
+    return 0
+
+
+cdef size_t _run_jobs(_DistanceJob* job, size_t n_threads, _job_main_t main, bint interleave) except? 0:
+    """Divides the task described by job among n_threads jobs and runs them to completion.
+    Sequences are divided into contiguous ranges, or rows are interleaved so that
+    each job receives a similar share of the triangular all-vs-all workload."""
+
+    cdef:
+        size_t n_jobs = max(1, min(n_threads, job.size))
+        _DistanceJob* jobs = <_DistanceJob *> calloc(n_jobs, sizeof(_DistanceJob))
+        size_t n_bad = job.size
+        size_t i
+
+    if jobs is NULL:
+        raise MemoryError("Error while allocating distance jobs.")
+
+    with nogil:
+        for i in range(n_jobs):
+            jobs[i] = job[0]
+            if interleave:
+                jobs[i].start = i
+                jobs[i].step = n_jobs
+                jobs[i].stop = job.size
+            else:
+                jobs[i].start = job.size * i // n_jobs
+                jobs[i].step = 1
+                jobs[i].stop = job.size * (i + 1) // n_jobs
+
+            jobs[i].running = n_jobs > 1 and pthread_create(&jobs[i].thread, NULL, main, &jobs[i]) == 0
+            if not jobs[i].running:
+                main(&jobs[i])
+
+        for i in range(n_jobs):
+            if jobs[i].running:
+                pthread_join(jobs[i].thread, NULL)
+            n_bad = min(n_bad, jobs[i].n_bad)
+
+    free(jobs)
+
+    if n_bad < job.size:
+        raise Exception(f"Hamming distance requires sequences of equal length "
+                        f"(sequence {n_bad} has length {job.lengths[n_bad]}, expected {job.length})")
+
+    return job.size
+
+
+cdef void* _many_main(void* arg) noexcept nogil:
+    cdef:
+        _DistanceJob* job = <_DistanceJob *> arg
+        size_t n_blocks = _nt_len_to_block_num(job.length)
+        size_t i
+
+    job.n_bad = job.size
+    for i in range(job.start, job.stop):
+        if job.lengths[i] != job.length:
+            job.n_bad = i
+            break
+
+        job.out[i] = <uint16_t> _hamming_blocks(job.query, job.blocks + job.offsets[i], n_blocks)
+
+    return NULL
+
+
+cdef void* _edit_many_main(void* arg) noexcept nogil:
+    cdef:
+        _DistanceJob* job = <_DistanceJob *> arg
+        _Peq peq
+        size_t i
+
+    _myers_peq(&peq, job.query, job.length)
+    for i in range(job.start, job.stop):
+        job.out[i] = <uint16_t> _myers_distance(&peq, job.blocks + job.offsets[i], job.lengths[i], job.max_dist)
+
+    job.n_bad = job.size
+    return NULL
+
+
+cdef void* _matrix_main(void* arg) noexcept nogil:
+    """Fills the upper triangle of each row handled by the job and mirrors it below."""
+
+    cdef:
+        _DistanceJob* job = <_DistanceJob *> arg
+        size_t n_blocks = _nt_len_to_block_num(job.length)
+        size_t n = job.size
+        uint64_t* row
+        uint16_t dist
+        size_t i, j
+
+    job.n_bad = n
+    i = job.start
+    while i < job.stop:
+        if job.lengths[i] != job.length:
+            job.n_bad = i
+            break
+
+        row = job.blocks + job.offsets[i]
+        for j in range(i + 1, n):
+            if job.lengths[j] != job.length:
+                break     # Reported by the job that handles row j
+
+            dist = <uint16_t> _hamming_blocks(row, job.blocks + job.offsets[j], n_blocks)
+            job.out[i * n + j] = dist
+            job.out[j * n + i] = dist
+
+        i += job.step
+
+    return NULL
+
+
+
+cdef void _myers_peq(_Peq* peq, uint64_t* pattern, size_t length) noexcept nogil:
+    """Builds the match bitvector of each base directly from packed blocks. Lanes that
+    hold base c become zero after XOR with c in every lane, and the low bit of each
+    zero lane is gathered with pext (or its pext-free equivalent)."""
+
+    cdef uint64_t lanes = 0x5555555555555555ULL
+    cdef size_t n_blocks = _nt_len_to_block_num(length)
+    cdef uint64_t block, x, lo, hi
+    cdef size_t c, w
+
+    peq.length = length
+    peq.n_words = (length + 63) // 64
+
+    for w in range(peq.n_words):
+        for c in range(4):
+            block = pattern[2 * w]
+            x = block ^ (c * lanes)
+            lo = _compress_lanes(~(x | (x >> 1)))
+
+            hi = 0
+            if 2 * w + 1 < n_blocks:
+                block = pattern[2 * w + 1]
+                x = block ^ (c * lanes)
+                hi = _compress_lanes(~(x | (x >> 1)))
+
+            peq.bits[c][w] = lo | (hi << 32)
+
+
+cdef inline int _myers_block(uint64_t* pv, uint64_t* mv, uint64_t eq, int hin, uint64_t out_bit) noexcept nogil:
+    """Advances one word of vertical deltas by one column. hin is the horizontal delta
+    entering the word's top row, and the delta leaving the row at out_bit is returned."""
+
+    cdef:
+        uint64_t hin_neg = hin < 0
+        uint64_t hin_pos = hin > 0
+        uint64_t xv = eq | mv[0]
+        uint64_t xh, ph, mh
+        int hout = 0
+
+    eq |= hin_neg
+    xh = (((eq & pv[0]) + pv[0]) ^ pv[0]) | eq
+    ph = mv[0] | ~(xh | pv[0])
+    mh = pv[0] & xh
+
+    if ph & out_bit: hout = 1
+    elif mh & out_bit: hout = -1
+
+    ph = (ph << 1) | hin_pos
+    mh = (mh << 1) | hin_neg
+    pv[0] = mh | ~(xv | ph)
+    mv[0] = ph & xv
+    return hout
+
+
+cdef size_t _myers_distance(_Peq* peq, uint64_t* text, size_t length, size_t max_dist) noexcept nogil:
+    """Returns the edit distance between the pattern of peq and the packed text, or
+    max_dist + 1 if it exceeds max_dist. Only the words that overlap the diagonal band
+    of rows within max_dist of each column are computed. A word that enters the band is
+    assumed to increase by one per row, which can only overestimate cells outside it."""
+
+    cdef:
+        size_t m = peq.length
+        size_t n = length
+        size_t n_words = peq.n_words
+        uint64_t pv[MYERS_MAX_WORDS]
+        uint64_t mv[MYERS_MAX_WORDS]
+        size_t score[MYERS_MAX_WORDS]  # The value of each word's bottom row
+        uint64_t last_bit = 1ULL << ((m - 1) & 63)
+        size_t first = 0, last, b, j
+        uint64_t base
+        int hout
+
+    if m == 0 or n == 0:
+        return min(m + n, max_dist + 1)
+    if (m - n if m > n else n - m) > max_dist:
+        return max_dist + 1
+
+    last = min(n_words - 1, max_dist // 64)
+    for b in range(last + 1):
+        pv[b] = ~0ULL
+        mv[b] = 0
+        score[b] = min(64 * (b + 1), m)
+
+    for j in range(1, n + 1):
+        base = (text[(j - 1) >> 5] >> (((j - 1) & 31) * 2)) & 0b11
+        if j > max_dist + 1:
+            first = min(last, (j - max_dist - 1) // 64)
+
+        hout = 1
+        for b in range(first, last + 1):
+            hout = _myers_block(&pv[b], &mv[b], peq.bits[base][b], hout, last_bit if b == n_words - 1 else 1ULL << 63)
+            score[b] += hout
+
+        if last < n_words - 1 and (j + max_dist - 1) // 64 > last:
+            last += 1
+            pv[last] = ~0ULL
+            mv[last] = 0
+            score[last] = score[last - 1] - hout + min(64, m - 64 * last)
+            hout = _myers_block(&pv[last], &mv[last], peq.bits[base][last], hout, last_bit if last == n_words - 1 else 1ULL << 63)
+            score[last] += hout
+
+    return min(score[n_words - 1], max_dist + 1)
+
+cdef class HammingIndex:
+    """An index over a whitelist of equal length sequences (up to 32 nt), such as cell
+    barcodes or UMIs, for finding the entries within a small Hamming distance of a query.
+    Lookups only compare the entries that share at least one segment with the query.
+
+    Args:
+        whitelist: An iterable of str, bytes, or ShortSeq64. Duplicates are ignored.
+        max_dist: The largest distance that will be queried, from 0 to 7. Larger values
+            use shorter segments and therefore examine more candidates per lookup.
+    """
+
+    def __cinit__(self, object whitelist, size_t max_dist=2):
+        cdef:
+            size_t n_buckets, seg, i, b, lo, hi
+            uint32_t* starts
+            uint32_t* members
+            uint32_t* fill
+
+        entries = list(dict.fromkeys(pack(seq) for seq in whitelist))
+        if not entries:
+            raise Exception("HammingIndex requires a non-empty whitelist.")
+        if max_dist > MAX_INDEX_DIST:
+            raise Exception(f"HammingIndex supports distances up to {MAX_INDEX_DIST}.")
+
+        self.length = len(entries[0])
+        self.max_dist = max_dist
+        self._size = len(entries)
+        self._n_segments = max_dist + 1
+
+        if not all(type(seq) is ShortSeq64 and len(seq) == self.length for seq in entries):
+            raise Exception(f"HammingIndex requires whitelist sequences of equal length (up to {MAX_64_NT} nt).")
+        if self.length < self._n_segments:
+            raise Exception(f"Sequences of length {self.length} are too short for max_dist={max_dist}.")
+        if self._size >= 0xFFFFFFFF:
+            raise Exception("HammingIndex supports whitelists of up to 2^32 - 1 sequences.")
+
+        # Divide the sequence into segments whose lengths differ by at most one base
+        for seg in range(self._n_segments):
+            lo = self.length * seg // self._n_segments
+            hi = self.length * (seg + 1) // self._n_segments
+            self._masks[seg] = _bzhi_u64(~0ULL, hi * 2) & ~_bzhi_u64(~0ULL, lo * 2)
+
+        self._bucket_bits = 1
+        while (1ULL << self._bucket_bits) < self._size:
+            self._bucket_bits += 1
+        n_buckets = 1ULL << self._bucket_bits
+
+        self._keys = <uint64_t *> PyMem_Malloc(self._size * sizeof(uint64_t))
+        self._starts = <uint32_t *> PyMem_Calloc(self._n_segments * (n_buckets + 1), sizeof(uint32_t))
+        self._members = <uint32_t *> PyMem_Malloc(self._n_segments * self._size * sizeof(uint32_t))
+        fill = <uint32_t *> PyMem_Malloc((n_buckets + 1) * sizeof(uint32_t))
+
+        if self._keys is NULL or self._starts is NULL or self._members is NULL or fill is NULL:
+            PyMem_Free(fill)
+            raise MemoryError("Error while allocating a HammingIndex.")
+
+        for i in range(self._size):
+            self._keys[i] = (<ShortSeq64> entries[i])._packed
+
+        # Group the whitelist by bucket for each segment (counting sort)
+        with nogil:
+            for seg in range(self._n_segments):
+                starts = self._starts + seg * (n_buckets + 1)
+                members = self._members + seg * self._size
+
+                for i in range(self._size):
+                    starts[self._bucket(self._keys[i] & self._masks[seg]) + 1] += 1
+                for b in range(n_buckets):
+                    starts[b + 1] += starts[b]
+
+                memcpy(fill, starts, (n_buckets + 1) * sizeof(uint32_t))
+                for i in range(self._size):
+                    b = self._bucket(self._keys[i] & self._masks[seg])
+                    members[fill[b]] = <uint32_t> i
+                    fill[b] += 1
+
+        PyMem_Free(fill)
+
+    def neighbors(self, object seq, object max_dist=None):
+        """Returns the whitelist entries within max_dist of seq, nearest first.
+
+        Args:
+            seq: A str, bytes, or ShortSeq64 query.
+            max_dist: The maximum Hamming distance, inclusive. Defaults to the
+                index's max_dist, and may not exceed it.
+        """
+
+        cdef size_t dist = self._check_dist(max_dist)
+        cdef Py_ssize_t j
+        cdef uint32_t* hits
+        cdef uint8_t* dists
+        cdef size_t n_hits, i
+        cdef uint64_t query
+        cdef bint ok
+
+        query = self._packed_query(seq, &ok)
+        if not ok:
+            return []
+
+        hits = <uint32_t *> PyMem_Malloc(self._size * sizeof(uint32_t))
+        dists = <uint8_t *> PyMem_Malloc(self._size * sizeof(uint8_t))
+        if hits is NULL or dists is NULL:
+            PyMem_Free(hits)
+            PyMem_Free(dists)
+            raise MemoryError("Error while allocating HammingIndex results.")
+
+        try:
+            n_hits = self._query(query, dist, hits, dists, &j)
+            found = sorted((dists[i], hits[i]) for i in range(n_hits))
+            return [self._entry(k) for _, k in found]
+        finally:
+            PyMem_Free(hits)
+            PyMem_Free(dists)
+
+    def nearest(self, object seq, object max_dist=None):
+        """Returns the whitelist entry nearest to seq if it is within max_dist and
+        no other entry is equally near, otherwise None."""
+
+        cdef size_t dist = self._check_dist(max_dist)
+        cdef Py_ssize_t j
+        cdef bint ok
+
+        query = self._packed_query(seq, &ok)
+        if not ok:
+            return None
+
+        self._query(query, dist, NULL, NULL, &j)
+        return self._entry(j) if j >= 0 else None
+
+    def correct(self, object counts, object max_dist=None):
+        """Assigns each sequence in a ShortSeqCounter to its nearest whitelist entry.
+
+        Sequences that match a whitelist entry exactly, or are within max_dist of exactly
+        one nearest entry, have their counts added to that entry. All others are
+        uncorrectable, including sequences that are equally near to several entries.
+
+        Returns:
+            A pair of ShortSeqCounters: the corrected counts keyed by whitelist entry,
+            and the counts of the uncorrectable sequences.
+        """
+
+        cdef size_t dist = self._check_dist(max_dist)
+        cdef Py_ssize_t j
+        cdef uint64_t query
+        cdef bint ok
+
+        corrected, uncorrectable = ShortSeqCounter(), ShortSeqCounter()
+        for seq, count in counts.items():
+            query = self._packed_query(seq, &ok)
+            j = -1
+            if ok:
+                self._query(query, dist, NULL, NULL, &j)
+            if j >= 0:
+                entry = self._entry(j)
+                corrected[entry] = corrected.get(entry, 0) + count
+            else:
+                uncorrectable[seq] = count
+
+        return corrected, uncorrectable
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        return f"<HammingIndex: {self._size} sequences ({self.length} nt, max_dist={self.max_dist})>"
+
+    def __sizeof__(self):
+        return sizeof(HammingIndex) + \
+               self._size * sizeof(uint64_t) + \
+               self._n_segments * ((1ULL << self._bucket_bits) + 1 + self._size) * sizeof(uint32_t)
+
+    def __dealloc__(self):
+        PyMem_Free(self._keys)
+        PyMem_Free(self._starts)
+        PyMem_Free(self._members)
+
+    cdef size_t _check_dist(self, object max_dist) except? 0:
+        if max_dist is None:
+            return self.max_dist
+        if max_dist > self.max_dist:
+            raise Exception(f"max_dist ({max_dist}) exceeds the max_dist of the index ({self.max_dist}).")
+        return max_dist
+
+    cdef ShortSeq64 _entry(self, size_t j):
+        cdef ShortSeq64 out = ShortSeq64.__new__(ShortSeq64)
+        out._packed = self._keys[j]
+        out._length = <uint8_t> self.length
+        return out
+
+    cdef uint64_t _packed_query(self, object seq, bint* ok):
+        """Packs the query. ok is False if it doesn't have the whitelist's length."""
+
+        seq = pack(seq)
+        ok[0] = len(seq) == self.length
+        return (<ShortSeq64> seq)._packed if ok[0] else 0
+
+    cdef inline size_t _bucket(self, uint64_t segment) noexcept nogil:
+        return (segment * 0x9E3779B97F4A7C15ULL) >> (64 - self._bucket_bits)
+
+    cdef size_t _query(self, uint64_t query, size_t max_dist, uint32_t* hits, uint8_t* dists, Py_ssize_t* nearest) noexcept nogil:
+        """Finds the whitelist entries within max_dist of the query. If hits and dists are
+        given, the entries and their distances are written to them, and each entry is
+        reported only once. nearest receives the index of the unique nearest entry, -1 if
+        there is none, or -2 if several entries are equally near.
+
+        Returns:
+            The number of entries within max_dist.
+        """
+
+        cdef:
+            size_t n_buckets = 1ULL << self._bucket_bits
+            size_t best = MAX_INDEX_DIST + 1
+            size_t n_hits = 0
+            size_t seg, prev, b, k, j
+            uint32_t* starts
+            uint32_t* members
+            uint64_t comp, mask
+            size_t dist
+            bint seen
+
+        nearest[0] = -1
+        for seg in range(self._n_segments):
+            mask = self._masks[seg]
+            starts = self._starts + seg * (n_buckets + 1)
+            members = self._members + seg * self._size
+            b = self._bucket(query & mask)
+
+            for k in range(starts[b], starts[b + 1]):
+                j = members[k]
+                comp = self._keys[j] ^ query
+                if comp & mask:
+                    continue            # Shares a bucket but not the segment
+
+                # Skip entries that were already found via an earlier segment
+                seen = False
+                for prev in range(seg):
+                    if not (comp & self._masks[prev]):
+                        seen = True
+                        break
+                if seen:
+                    continue
+
+                comp = ((comp >> 1) | comp) & 0x5555555555555555ULL
+                dist = _popcnt64(comp)
+                if dist > max_dist:
+                    continue
+
+                if hits is not NULL:
+                    hits[n_hits] = <uint32_t> j
+                    dists[n_hits] = <uint8_t> dist
+                n_hits += 1
+
+                if dist < best:
+                    best, nearest[0] = dist, j
+                elif dist == best:
+                    nearest[0] = -2
+
+        return n_hits
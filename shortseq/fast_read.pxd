@@ -1,21 +1,237 @@
 from cython.operator cimport dereference as deref
-from libcpp.vector cimport vector
 from libc.stdio cimport *
-from libc.string cimport strdup, memchr
+from libc.stdlib cimport malloc, calloc, realloc, free
+from libc.string cimport memchr, memcpy, memmove, memset, strncpy
 
+from cpython.exc cimport PyErr_SetFromErrnoWithFilenameObject
 from cpython.object cimport PyObject
-from cpython.ref cimport Py_XINCREF
 
 from . cimport short_seq as sq
+from .util cimport *
+
+from posix.fcntl cimport open as c_open, O_RDONLY
+from posix.mman cimport mmap as c_mmap, munmap, posix_madvise, PROT_READ, MAP_PRIVATE, MAP_FAILED, POSIX_MADV_SEQUENTIAL
+from posix.stat cimport struct_stat, fstat
+from posix.unistd cimport close
 
 cdef extern from "<fcntl.h>" nogil:
     # There is a performance advantage to notifying the kernel of our intent to use
     # sequential access pattern on Linux (posix_fadvise), but doing the same on
-    # macOS (fnctl) actually seems to hurt performance...
+    # macOS (fnctl) actually seems to hurt performance... Memory mapped input uses
+    # posix_madvise(POSIX_MADV_SEQUENTIAL) instead, which is madvise() on Linux.
 
     int F_RDADVISE
     int F_RDAHEAD
 
+cdef extern from "<zlib.h>" nogil:
+    ctypedef void* gzFile
+
+    gzFile gzopen(const char* path, const char* mode)
+    int gzbuffer(gzFile file, unsigned size)
+    int gzread(gzFile file, void* buf, unsigned len)
+    const char* gzerror(gzFile file, int* errnum)
+    int gzclose(gzFile file)
+
+    ctypedef struct z_stream:
+        unsigned char* next_in
+        unsigned avail_in
+        unsigned char* next_out
+        unsigned avail_out
+        const char* msg
+
+    int inflateInit2(z_stream* strm, int window_bits)
+    int inflateReset(z_stream* strm)
+    int inflate(z_stream* strm, int flush)
+    int inflateEnd(z_stream* strm)
+    unsigned long crc32(unsigned long crc, const unsigned char* buf, unsigned len)
+
+    int Z_OK
+    int Z_STREAM_END
+    int Z_FINISH
+
+
+"""
+Decompression pipeline. A loader thread fills a ring of chunks in file order,
+and for BGZF input a pool of workers inflates the loaded blocks in parallel.
+The consumer takes chunks in order, so decompression overlaps with packing.
+"""
+
+cdef enum StreamFormat:
+    FMT_PLAIN = 0
+    FMT_GZIP = 1
+    FMT_BGZF = 2
+
+cdef enum ChunkState:
+    CHUNK_EMPTY = 0                    # Free for the loader
+    CHUNK_LOADED = 1                   # Holds compressed BGZF blocks awaiting a worker
+    CHUNK_READY = 2                    # Holds decompressed bytes for the consumer
+
+cdef enum:
+    BGZF_MAX_BLOCK = 65536
+    BGZF_BLOCKS_PER_CHUNK = 16
+    STREAM_CHUNK_BYTES = BGZF_MAX_BLOCK * BGZF_BLOCKS_PER_CHUNK
+
+ctypedef struct _Chunk:
+    char* data                         # Decompressed bytes
+    size_t size
+    unsigned char* raw                 # Compressed BGZF blocks
+    size_t n_blocks
+    size_t block_ends[BGZF_BLOCKS_PER_CHUNK]
+    ChunkState state
+    bint last
+
+ctypedef struct _Stream:
+    StreamFormat fmt
+    FILE* cfile
+    gzFile gz
+    _Chunk* chunks
+    size_t n_chunks
+    size_t n_loaded                    # Chunks handed off by the loader
+    size_t n_taken                     # Chunks claimed by inflate workers
+    size_t n_consumed                  # Chunks released by the consumer
+    bint holding                       # The consumer is reading chunk n_consumed
+    bint drained                       # The consumer has released the last chunk
+    bint loader_done
+    bint stop
+    bint failed
+    char errmsg[256]
+    pthread_mutex_t lock
+    pthread_cond_t cond
+    pthread_t loader
+    pthread_t* workers
+    size_t n_workers
+
+
+"""
+Parallel packing. The reader's thread copies sequence lines into jobs, and each job
+is encoded into packed blocks by a worker thread that doesn't hold the GIL.
+"""
+
+cdef enum:
+    PACK_JOB_READS = 16384
+
+ctypedef struct _PackJob:
+    char* text                         # Concatenated sequence lines
+    size_t text_size
+    size_t text_cap
+    size_t* starts                     # Offset of each read in text, plus the end offset
+    size_t n_reads
+    uint64_t* words                    # Packed blocks of each read, concatenated
+    size_t words_cap
+    size_t n_bad                       # Index of the first read that couldn't be packed, else n_reads
+    bint no_memory
+    bint running
+    pthread_t thread
+
+
+"""
+Read filtering. A ReadFilter handles ambiguous bases, trims a 3' adapter from each read,
+and applies length and quality filters as the reader streams it, so rejected reads are
+never packed.
+"""
+
+cdef enum:
+    PHRED_OFFSET = 33
+
+cdef enum AmbiguousPolicy:
+    AMBIG_ERROR = 0                    # Leave ambiguous bases for packing to reject
+    AMBIG_DROP = 1
+    AMBIG_MASK = 2
+    AMBIG_SPLIT = 3
+
+# The state of a read passing through a ReadFilter. Each reader holds its own, so that
+# a filter can be shared between readers and reused after an exception.
+ctypedef struct _FilterState:
+    char* scratch                      # Masked copy of the current read
+    size_t scratch_cap
+    char* split_seq                    # The current split read, as read
+    char* split_qual
+    size_t split_pos                   # Start of its unreturned pieces
+    size_t split_end
+
+cdef class ReadFilter:
+    cdef readonly size_t min_length
+    cdef readonly size_t max_length
+    cdef readonly int min_quality
+    cdef readonly double min_mean_quality
+    cdef readonly str adapter
+    cdef readonly double max_error_rate
+    cdef readonly size_t min_overlap
+    cdef readonly str ambiguous
+    cdef AmbiguousPolicy _policy
+    cdef uint64_t _adapter             # Packed adapter bases
+    cdef size_t _adapter_len
+    cdef size_t _max_errors[33]        # Mismatches allowed by overlap length
+
+    cdef readonly size_t n_reads
+    cdef readonly size_t n_ambiguous
+    cdef readonly size_t n_trimmed
+    cdef readonly size_t n_too_short
+    cdef readonly size_t n_too_long
+    cdef readonly size_t n_low_quality
+    cdef readonly size_t n_low_mean_quality
+    cdef readonly size_t n_passed
+
+    cdef bint _keep(self, _FilterState* st, char** seq, size_t* length, char* qual) except -1
+    cdef bint _next_piece(self, _FilterState* st, char** seq, size_t* length) except -1
+    cdef bint _check(self, char* seq, size_t length, char* qual) except -1
+    cdef int _mask(self, _FilterState* st, char* seq, size_t length) except -1
+    cdef size_t _adapter_start(self, char* seq, size_t length, char* orig) noexcept nogil
+
+
+"""
+Sequence readers. SeqReader holds the buffering shared by every format: input is
+either streamed through the decompression pipeline or memory mapped, and split into
+lines in place. Each format implements _next_record() to find its next sequence.
+"""
+
+cdef class SeqReader:
+    cdef _Stream* _stream
+    cdef char* _buf
+    cdef size_t _cap
+    cdef size_t _pos                   # Start of the next unread line
+    cdef size_t _end                   # End of the buffered bytes
+    cdef size_t _rec_start             # Start of the current record, preserved across refills
+    cdef bint _eof
+    cdef readonly bint mapped          # _buf is a read-only mapping of the whole file
+    cdef readonly object filename
+    cdef readonly str compression
+    cdef readonly size_t n_reads
+    cdef public ReadFilter read_filter
+    cdef _FilterState _filter_state
+
+    cdef bint next_seq(self, char** seq, size_t* length) except -1
+    cdef bint _next_record(self, char** seq, size_t* length, char** qual) except -1    # Abstract
+    cdef bint _next_line(self, size_t* start, size_t* length) except -1
+    cdef int _peek(self) except -2
+    cdef int _refill(self) except -1
+    cdef int _map_file(self, bytes fname) except -1
+
+cdef class FastqReader(SeqReader):
+    pass
+
+cdef class FastaReader(SeqReader):
+    cdef char* _seqbuf                 # Joins the lines of multi-line sequences
+    cdef size_t _seqcap
+
+    cdef int _grow_seqbuf(self, size_t needed) except -1
+
+cdef class LineReader(SeqReader):
+    pass
+
+cdef class SamReader(SeqReader):
+    pass
+
+
+cdef _Stream* _stream_open(char* fname, StreamFormat fmt, size_t n_workers) except NULL
+cdef int _stream_next(_Stream* s, char** data, size_t* size) noexcept nogil
+cdef void _stream_close(_Stream* s) noexcept nogil
+
+# Receives each round of packed reads from _pack_reads_parallel(), e.g. to count or store them
+ctypedef object (*pack_sink)(object sink, _PackJob* jobs, size_t n_jobs)
 
-cdef void _read_fastq_short_seqs(char* fname, vector[PyObject *] &out)
-cdef void _read_fastq_chars(char* fname, vector[char *] &out) nogil
\ No newline at end of file
+cdef _pack_reads_parallel(SeqReader reader, size_t n_threads, object sink, pack_sink add)
+cdef size_t _fill_pack_jobs(SeqReader reader, _PackJob* jobs, size_t n_jobs) except? 0
+cdef void _start_pack_jobs(_PackJob* jobs, size_t n_jobs) noexcept nogil
+cdef void _join_pack_jobs(_PackJob* jobs, size_t n_jobs) noexcept nogil
+cdef void _free_pack_jobs(_PackJob* jobs, size_t n_jobs) noexcept nogil
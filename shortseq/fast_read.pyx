@@ -1,40 +1,1229 @@
+import gzip
+import os
 
+cimport cython
+
+
+cdef class SeqReader:
+    """Streams the sequences of a file one at a time. Subclasses implement _next_record()
+    for each format; this class provides the buffering and line splitting they share.
+
+    Plain, gzip, and BGZF compressed files are supported. Compression is detected
+    from the file's magic bytes, and decompression takes place on background threads
+    so that it overlaps with packing and counting. BGZF blocks are inflated in parallel
+    by the specified number of threads.
+
+    The sequence returned by next_seq() is only valid until the following
+    call, so callers are expected to pack (and count) each read before advancing.
+    This keeps memory usage independent of the number of reads in the file.
+
+    Uncompressed files may instead be memory mapped (mmap=True). Records are then
+    scanned in place, without copying the file through a read buffer, and the kernel
+    is advised of sequential access so that it reads ahead aggressively. The mmap
+    option has no effect on compressed files.
+
+    Reads may be filtered and adapter trimmed as they are streamed by assigning a
+    ReadFilter to read_filter. Rejected reads are skipped by next_seq().
+    """
+
+    def __cinit__(self, object filename, size_t threads=1, bint mmap=False):
+        cdef StreamFormat fmt
+        cdef bytes fname
+
+        if type(self) is SeqReader:
+            raise TypeError("SeqReader can't be instantiated directly. Use open_reader() or a format-specific reader.")
+
+        fmt = _detect_format(filename)
+        fname = os.fsencode(filename)
+        self.filename = filename
+        self.compression = ("none", "gzip", "bgzf")[fmt]
+
+        if mmap and fmt == FMT_PLAIN:
+            self._map_file(fname)
+            if self.mapped: return
+
+        self._stream = _stream_open(fname, fmt, max(threads, 1))
+
+        self._cap = STREAM_CHUNK_BYTES * 2
+        self._buf = <char *> malloc(self._cap)
+        if self._buf is NULL:
+            raise MemoryError("Error while allocating the read buffer.")
+
+    cdef int _map_file(self, bytes fname) except -1:
+        """Maps the whole file as the read buffer. Empty files are left unmapped."""
+
+        cdef struct_stat st
+        cdef void* addr
+        cdef int fd = c_open(fname, O_RDONLY)
+
+        if fd < 0 or fstat(fd, &st) != 0:
+            if fd >= 0: close(fd)
+            PyErr_SetFromErrnoWithFilenameObject(OSError, self.filename)
+
+        if st.st_size == 0:
+            close(fd)
+            return 0
+
+        addr = c_mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0)
+        close(fd)
+        if addr == MAP_FAILED:
+            PyErr_SetFromErrnoWithFilenameObject(OSError, self.filename)
+
+        posix_madvise(addr, st.st_size, POSIX_MADV_SEQUENTIAL)
+        self._buf = <char *> addr
+        self._cap = self._end = st.st_size
+        self._eof = True
+        self.mapped = True
+        return 0
+
+    cdef bint next_seq(self, char** seq, size_t* length) except -1:
+        """Advances to the next record that passes read_filter (if set) and points seq
+        to its sequence, which may have been shortened by adapter trimming.
+
+        Returns:
+            False once the end of the file has been reached, otherwise True.
+        """
+
+        cdef char* qual = NULL
+        cdef ReadFilter rf = self.read_filter
+        cdef _FilterState* st = &self._filter_state
+
+        if rf is None:
+            return self._next_record(seq, length, &qual)
+
+        try:
+            while True:
+                if st.split_pos < st.split_end:                 # Pieces of a split read remain
+                    if rf._next_piece(st, seq, length): return True
+                    continue
+
+                qual = NULL
+                if not self._next_record(seq, length, &qual):
+                    return False
+                if rf._keep(st, seq, length, qual):
+                    return True
+        except:
+            st.split_pos = st.split_end = 0
+            raise
+
+    cdef bint _next_record(self, char** seq, size_t* length, char** qual) except -1:
+        """Advances to the next record and points seq to its sequence. Formats that store
+        base qualities also point qual to them; otherwise it is left untouched.
+
+        Every subclass overrides this method, and SeqReader itself can't be instantiated,
+        so this definition is never called.
+
+        Returns:
+            False once the end of the file has been reached, otherwise True.
+        """
+
+        return False
+
+    cdef bint _next_line(self, size_t* start, size_t* length) except -1:
+        """Finds the next line in the buffer, refilling it as necessary. The line's start
+        is reported relative to the current record, which stays put if a refill occurs."""
+
+        cdef char* line = NULL
+        cdef char* nl = NULL
+        cdef size_t n
+
+        while True:
+            nl = <char *> memchr(self._buf + self._pos, b'\n', self._end - self._pos)
+            if nl is not NULL or self._eof: break
+            self._refill()
+
+        line = self._buf + self._pos
+        if nl is NULL:
+            if self._pos == self._end: return False
+            nl = self._buf + self._end                       # Final line has no terminator
+            self._pos = self._end
+        else:
+            self._pos = nl - self._buf + 1
+
+        n = nl - line
+        if n and line[n - 1] == b'\r':
+            n -= 1
+
+        start[0] = line - self._buf - self._rec_start
+        length[0] = n
+        return True
+
+    cdef int _peek(self) except -2:
+        """Returns the first byte of the next line without consuming it, or -1 at the end of the file."""
+
+        while self._pos == self._end and not self._eof:
+            self._refill()
+
+        if self._pos == self._end: return -1
+        return <unsigned char> self._buf[self._pos]
+
+    cdef int _refill(self) except -1:
+        """Moves the current record to the front of the buffer and appends the next chunk."""
+
+        cdef:
+            size_t keep = self._end - self._rec_start
+            char* data = NULL
+            size_t size = 0
+            char* grown
+            int rc
+
+        if self._rec_start:
+            memmove(self._buf, self._buf + self._rec_start, keep)
+            self._pos -= self._rec_start
+            self._end = keep
+            self._rec_start = 0
+
+        with nogil:
+            rc = _stream_next(self._stream, &data, &size)
+
+        if rc < 0:
+            raise Exception(f"{self.filename}: {(<char *> self._stream.errmsg).decode('utf-8', 'replace')}")
+        if rc == 0:
+            self._eof = True
+            return 0
+
+        if self._end + size > self._cap:
+            grown = <char *> realloc(self._buf, max(self._cap * 2, self._end + size))
+            if grown is NULL:
+                raise MemoryError("Error while growing the read buffer.")
+            self._cap = max(self._cap * 2, self._end + size)
+            self._buf = grown
+
+        memcpy(self._buf + self._end, data, size)
+        self._end += size
+        return 0
+
+    def __dealloc__(self):
+        free(self._filter_state.scratch)
+        if self._stream is not NULL:
+            _stream_close(self._stream)
+        if self.mapped:
+            munmap(self._buf, self._cap)
+        else:
+            free(self._buf)
+
+
+cdef class FastqReader(SeqReader):
+    """Streams the records of a 4-line FASTQ file one at a time."""
+
+    cdef bint _next_record(self, char** seq, size_t* length, char** qual) except -1:
+        """Advances to the next record and points seq to its sequence line, and qual to its quality line.
+
+        Returns:
+            False once the end of the file has been reached, otherwise True.
+        """
+
+        cdef size_t hdr, hdr_len, seq_start, seq_len, sep, sep_len, qual_start, qual_len
+
+        while True:
+            self._rec_start = self._pos
+            if not self._next_line(&hdr, &hdr_len):
+                return False
+            if hdr_len: break                                # Tolerate blank lines between records
+
+        if self._buf[self._rec_start + hdr] != b'@':
+            raise Exception(f"{self.filename}: expected a FASTQ header after read {self.n_reads}.")
+
+        if not (self._next_line(&seq_start, &seq_len) and
+                self._next_line(&sep, &sep_len) and
+                self._next_line(&qual_start, &qual_len)):
+            raise Exception(f"{self.filename}: truncated record after read {self.n_reads}.")
+
+        if sep_len == 0 or self._buf[self._rec_start + sep] != b'+':
+            raise Exception(f"{self.filename}: expected a FASTQ separator line in read {self.n_reads + 1}.")
+
+        if qual_len != seq_len:
+            raise Exception(f"{self.filename}: quality and sequence lengths differ in read {self.n_reads + 1}.")
+
+        seq[0] = self._buf + self._rec_start + seq_start
+        qual[0] = self._buf + self._rec_start + qual_start
+        length[0] = seq_len
+        self.n_reads += 1
+        return True
+
+
+cdef class FastaReader(SeqReader):
+    """Streams the records of a FASTA file one at a time.
+
+    Sequences may be wrapped across any number of lines. Single-line sequences are
+    returned in place; the lines of a wrapped sequence are joined in a scratch buffer.
+    """
+
+    cdef bint _next_record(self, char** seq, size_t* length, char** qual) except -1:
+        cdef size_t hdr, hdr_len, line, line_len, total
+        cdef int nxt
+
+        while True:
+            self._rec_start = self._pos
+            if not self._next_line(&hdr, &hdr_len):
+                return False
+            if hdr_len: break                                # Tolerate blank lines between records
+
+        if self._buf[self._rec_start + hdr] != b'>':
+            raise Exception(f"{self.filename}: expected a FASTA header after read {self.n_reads}.")
+
+        nxt = self._peek()
+        if nxt == -1 or nxt == b'>':                         # Header without a sequence
+            seq[0] = self._buf + self._rec_start
+            length[0] = 0
+            self.n_reads += 1
+            return True
+
+        self._next_line(&line, &line_len)
+        nxt = self._peek()
+        if nxt == -1 or nxt == b'>':                         # Single-line sequence
+            seq[0] = self._buf + self._rec_start + line
+            length[0] = line_len
+            self.n_reads += 1
+            return True
+
+        total = 0
+        while True:
+            if total + line_len > self._seqcap:
+                self._grow_seqbuf(total + line_len)
+            memcpy(self._seqbuf + total, self._buf + self._rec_start + line, line_len)
+            total += line_len
+
+            nxt = self._peek()
+            if nxt == -1 or nxt == b'>': break
+            self._rec_start = self._pos                      # Earlier lines have been copied out
+            self._next_line(&line, &line_len)
+
+        seq[0] = self._seqbuf
+        length[0] = total
+        self.n_reads += 1
+        return True
+
+    cdef int _grow_seqbuf(self, size_t needed) except -1:
+        cdef size_t cap = max(self._seqcap * 2, needed, 1024)
+        cdef char* grown = <char *> realloc(self._seqbuf, cap)
+        if grown is NULL:
+            raise MemoryError("Error while growing the FASTA sequence buffer.")
+        self._seqbuf = grown
+        self._seqcap = cap
+        return 0
+
+    def __dealloc__(self):
+        free(self._seqbuf)
+
+
+cdef class LineReader(SeqReader):
+    """Streams a plain text file that holds one sequence per line. Blank lines are skipped."""
+
+    cdef bint _next_record(self, char** seq, size_t* length, char** qual) except -1:
+        cdef size_t line, line_len
+
+        while True:
+            self._rec_start = self._pos
+            if not self._next_line(&line, &line_len):
+                return False
+            if line_len: break
+
+        seq[0] = self._buf + self._rec_start + line
+        length[0] = line_len
+        self.n_reads += 1
+        return True
+
+
+cdef class SamReader(SeqReader):
+    """Streams the SEQ field of each alignment in a SAM text file.
+
+    Header lines are skipped, as are secondary and supplementary alignments (FLAG 0x100
+    and 0x800) so that each read is seen once, and records whose SEQ is not stored ("*").
+    Sequences are returned as stored, i.e. reverse complemented for reverse strand alignments.
+    Base qualities are passed to read_filter when QUAL is stored.
+    """
+
+    cdef bint _next_record(self, char** seq, size_t* length, char** qual) except -1:
+        cdef size_t line, line_len, field, flag
+        cdef char* text
+        cdef char* end
+        cdef char* tab
+        cdef char* qual_start
+        cdef char* qual_end
+
+        while True:
+            self._rec_start = self._pos
+            if not self._next_line(&line, &line_len):
+                return False
+
+            text = self._buf + self._rec_start + line
+            end = text + line_len
+            if line_len == 0 or text[0] == b'@': continue
+
+            # Skip QNAME, then parse FLAG
+            tab = <char *> memchr(text, b'\t', end - text)
+            flag = 0
+            if tab is not NULL:
+                text = tab + 1
+                while text < end and c'0' <= text[0] <= c'9':
+                    flag = flag * 10 + (text[0] - c'0')
+                    text += 1
+
+            # Advance from FLAG (field 2) to SEQ (field 10)
+            field = 2
+            while tab is not NULL and field < 10:
+                tab = <char *> memchr(text, b'\t', end - text)
+                if tab is not NULL:
+                    text = tab + 1
+                    field += 1
+
+            if tab is NULL:
+                raise Exception(f"{self.filename}: expected 11 tab-separated fields after read {self.n_reads}.")
+            if flag & 0x900: continue
+
+            tab = <char *> memchr(text, b'\t', end - text)
+            if tab is not NULL:
+                # QUAL (field 11) is used if it is stored and spans SEQ
+                qual_start = tab + 1
+                qual_end = <char *> memchr(qual_start, b'\t', end - qual_start)
+                if qual_end is NULL: qual_end = end
+                if qual_end - qual_start == tab - text and not (qual_end - qual_start == 1 and qual_start[0] == b'*'):
+                    qual[0] = qual_start
+                end = tab
+            if end - text == 1 and text[0] == b'*': continue
+            break
+
+        seq[0] = text
+        length[0] = end - text
+        self.n_reads += 1
+        return True
+
+
+cdef class ReadFilter:
+    """Trims a 3' adapter from reads and filters them by length and base quality. Assign
+    one to a reader's read_filter (or pass it to read_and_count()) so that reads are trimmed
+    and filtered as they are streamed, in the same pass that packs and counts them.
+
+    The stages are applied in order, and each read is tallied under the first stage that
+    rejects it (see stats()):
+
+    0. Ambiguous bases. By default, N and lowercase bases are left to the packing step,
+       which raises an exception. Otherwise they are handled by the ambiguous policy:
+       "drop" rejects reads that contain them, "mask" replaces each N (or other non-ACGT
+       character) with A, and "split" splits the read at each run of them, passing each
+       piece through the remaining stages as a separate read. Under "mask" and "split",
+       lowercase bases are converted to uppercase, so soft-masked reads are kept as-is.
+       Reads are checked 8 characters at a time; clean reads are not copied.
+    1. Adapter trimming. The read is cut at the leftmost position where the adapter
+       matches, or where a prefix of at least min_overlap bases of the adapter matches the
+       read's 3' end. A match may have up to max_error_rate mismatches per aligned base
+       (no indels). Reads are packed and compared with the packed adapter 32 bases at a
+       time using XOR and popcount. Under the "mask" and "split" policies, each ambiguous
+       base counts as a mismatch; otherwise, reads with bases other than ACGT are not trimmed.
+    2. Length filters, applied to the trimmed read. A max_length of 0 means no limit.
+    3. Quality filters, applied to the trimmed read's Phred+33 scores. Reads with any
+       base below min_quality, or with a mean below min_mean_quality, are rejected.
+       These require input that stores base qualities (FASTQ or SAM).
+
+    Args:
+        min_length: The minimum length of a read after trimming.
+        max_length: The maximum length of a read after trimming, or 0 for no limit.
+        min_quality: The minimum Phred score of every base.
+        min_mean_quality: The minimum mean Phred score of the read.
+        adapter: The 3' adapter sequence (up to 32 bases), or None.
+        max_error_rate: The fraction of mismatched bases allowed in an adapter match.
+        min_overlap: The minimum number of adapter bases to match at the read's 3' end.
+        ambiguous: The policy for reads with ambiguous or lowercase bases: "error",
+            "drop", "mask", or "split".
+
+    A filter may be shared by several readers, in which case its counters tally the reads
+    of all of them. The state of each read, such as the pieces that remain of a split
+    read, is held by the reader.
+    """
+
+    def __init__(self, size_t min_length=0, size_t max_length=0, int min_quality=0, double min_mean_quality=0,
+                 object adapter=None, double max_error_rate=0.1, size_t min_overlap=3, str ambiguous="error"):
+        cdef uint64_t* blocks
+        cdef size_t length, i
+
+        if max_length and max_length < min_length:
+            raise ValueError("max_length must be 0 or at least min_length.")
+        if not 0 <= max_error_rate < 1:
+            raise ValueError("max_error_rate must be at least 0 and less than 1.")
+        if min_overlap == 0:
+            raise ValueError("min_overlap must be at least 1.")
+        if ambiguous not in AMBIGUOUS_POLICIES:
+            raise ValueError(f"Unsupported ambiguous base policy: {ambiguous!r}. "
+                             f"Expected one of {list(AMBIGUOUS_POLICIES)}.")
+
+        self.min_length = min_length
+        self.max_length = max_length
+        self.min_quality = min_quality
+        self.min_mean_quality = min_mean_quality
+        self.max_error_rate = max_error_rate
+        self.min_overlap = min_overlap
+        self.ambiguous = ambiguous
+        self._policy = AMBIGUOUS_POLICIES[ambiguous]
+
+        if adapter is not None:
+            packed = sq.pack(adapter)
+            blocks = sq._packed_blocks(packed, &length)
+            if length == 0 or length > 32:
+                raise ValueError(f"The adapter must be between 1 and 32 bases long (got {length}).")
+            self.adapter = str(packed)
+            self._adapter = blocks[0]
+            self._adapter_len = length
+            self.min_overlap = min(min_overlap, length)
+            for i in range(length + 1):
+                self._max_errors[i] = <size_t> (max_error_rate * i)
+
+    def stats(self):
+        """Returns the number of reads seen, with ambiguous bases, trimmed, rejected by each
+        filter, and passed. Under the "split" policy, each piece that passes is counted."""
+
+        return {
+            "reads": self.n_reads,
+            "ambiguous": self.n_ambiguous,
+            "trimmed": self.n_trimmed,
+            "too_short": self.n_too_short,
+            "too_long": self.n_too_long,
+            "low_quality": self.n_low_quality,
+            "low_mean_quality": self.n_low_mean_quality,
+            "passed": self.n_passed,
+        }
+
+    def trim(self, object seq):
+        """Returns the sequence (str or bytes) with the adapter trimmed. Counters are not updated."""
+
+        cdef bytes seq_bytes = seq.encode() if isinstance(seq, str) else seq
+        cdef size_t n = len(seq_bytes)
+
+        if self._adapter_len:
+            n = self._adapter_start(seq_bytes, n, NULL)
+        return seq[:n]
+
+    def __repr__(self):
+        return f"<ReadFilter: {self.n_passed} of {self.n_reads} reads passed>"
+
+    cdef bint _keep(self, _FilterState* st, char** seq, size_t* length, char* qual) except -1:
+        """Applies every stage to a newly read record. Masked (or split) reads are redirected to
+        the reader's scratch buffer and trimmed reads are shortened. Returns whether the read,
+        or the first piece of a split read, passes the filters."""
+
+        cdef char* orig = seq[0]
+        cdef char* ambiguous = NULL
+        cdef size_t n
+
+        self.n_reads += 1
+        if self._policy != AMBIG_ERROR and not _all_bases(orig, length[0]):
+            self.n_ambiguous += 1
+            if self._policy == AMBIG_DROP:
+                return False
+            self._mask(st, orig, length[0])
+            seq[0] = ambiguous = st.scratch
+
+        if self._adapter_len:
+            n = self._adapter_start(seq[0], length[0], orig if ambiguous is not NULL else NULL)
+            if n < length[0]:
+                length[0] = n
+                self.n_trimmed += 1
+
+        if self._policy == AMBIG_SPLIT and ambiguous is not NULL:
+            st.split_seq = orig
+            st.split_qual = qual
+            st.split_pos = 0
+            st.split_end = length[0]
+            return self._next_piece(st, seq, length)
+
+        return self._check(seq[0], length[0], qual)
+
+    cdef bint _next_piece(self, _FilterState* st, char** seq, size_t* length) except -1:
+        """Points seq to the next unambiguous piece of a split read, if there is one, and
+        returns whether it passes the length and quality filters."""
+
+        cdef size_t start = st.split_pos, end = st.split_end
+
+        while start < end and not _is_folded_base(st.split_seq[start]):
+            start += 1
+        st.split_pos = start
+        while st.split_pos < end and _is_folded_base(st.split_seq[st.split_pos]):
+            st.split_pos += 1
+
+        if start == end:
+            return False
+
+        seq[0] = st.scratch + start
+        length[0] = st.split_pos - start
+        return self._check(seq[0], length[0], st.split_qual + start if st.split_qual is not NULL else NULL)
+
+    cdef bint _check(self, char* seq, size_t length, char* qual) except -1:
+        """Applies the length and quality filters to a (trimmed) read."""
+
+        cdef size_t i, total = 0
+        cdef uint8_t q, lowest = 255
+
+        if length < self.min_length:
+            self.n_too_short += 1
+            return False
+        if self.max_length and length > self.max_length:
+            self.n_too_long += 1
+            return False
+
+        if self.min_quality > 0 or self.min_mean_quality > 0:
+            if qual is NULL:
+                raise Exception("Quality filters require input with base qualities (FASTQ or SAM).")
+
+            for i in range(length):
+                q = <uint8_t> qual[i]
+                total += q
+                if q < lowest: lowest = q
+
+            if length and <int> lowest - PHRED_OFFSET < self.min_quality:
+                self.n_low_quality += 1
+                return False
+            if length and <double> total / length - PHRED_OFFSET < self.min_mean_quality:
+                self.n_low_mean_quality += 1
+                return False
+
+        self.n_passed += 1
+        return True
+
+    cdef int _mask(self, _FilterState* st, char* seq, size_t length) except -1:
+        """Copies the read to the reader's scratch buffer with lowercase bases converted to
+        uppercase and any other characters replaced with A."""
+
+        cdef size_t cap, i
+        cdef char* grown
+        cdef uint8_t c
+
+        if length > st.scratch_cap:
+            cap = max(st.scratch_cap * 2, length, 1024)
+            grown = <char *> realloc(st.scratch, cap)
+            if grown is NULL:
+                raise MemoryError("Error while growing the read filter's buffer.")
+            st.scratch = grown
+            st.scratch_cap = cap
+
+        for i in range(length):
+            c = _fold_case(seq[i])
+            st.scratch[i] = c if is_base(c) else b'A'
+
+        return 0
+
+    cdef size_t _adapter_start(self, char* seq, size_t length, char* orig) noexcept nogil:
+        """Returns the position of the leftmost adapter match in the read, or length if there is none.
+        If the read was masked, orig is the unmasked read, and its ambiguous bases count as mismatches."""
+
+        cdef:
+            uint64_t blocks[33]            # Enough for MAX_VAR_NT bases, plus a zero block for windows at the end
+            uint64_t masked[33]            # The low bit of each ambiguous base's lane
+            uint64_t diff
+            size_t p, overlap, i
+
+        if length < self.min_overlap or length > sq.MAX_VAR_NT:
+            return length
+
+        blocks[_nt_len_to_block_num(length)] = 0
+        if not _pack_bytes_array(blocks, <uint8_t *> seq, length):
+            return length
+
+        if orig is not NULL:
+            memset(masked, 0, sizeof(masked))
+            for i in range(length):
+                if not _is_folded_base(orig[i]):
+                    masked[i >> 5] |= 1ULL << (2 * (i & 31))
+
+        for p in range(length - self.min_overlap + 1):
+            diff = _window(blocks, p) ^ self._adapter
+            diff = (diff | (diff >> 1)) & 0x5555555555555555ULL
+            if orig is not NULL:
+                diff |= _window(masked, p)
+
+            overlap = min(self._adapter_len, length - p)
+            if _popcnt64(_bzhi_u64(diff, 2 * overlap)) <= self._max_errors[overlap]:
+                return p
+
+        return length
+
+
+AMBIGUOUS_POLICIES = {
+    "error": AMBIG_ERROR,
+    "drop": AMBIG_DROP,
+    "mask": AMBIG_MASK,
+    "split": AMBIG_SPLIT,
+}
+"""ReadFilter policies for reads with ambiguous (non-ACGT) or lowercase bases."""
+
+
+cdef inline bint _all_bases(char* seq, size_t length) noexcept nogil:
+    """Returns whether every character is an uppercase base, checking 8 at a time."""
+
+    cdef uint64_t block
+    cdef size_t i = 0
+
+    while i + 8 <= length:
+        memcpy(&block, seq + i, 8)
+        if not _bloom_filter_64(block): return False
+        i += 8
+    while i < length:
+        if not is_base(seq[i]): return False
+        i += 1
+
+    return True
+
+
+cdef inline uint64_t _window(uint64_t* blocks, size_t p) noexcept nogil:
+    """Returns the 32 bases of packed blocks that start at position p."""
+
+    cdef size_t idx = p >> 5, shift = 2 * (p & 31)
+    cdef uint64_t window = blocks[idx] >> shift
+
+    if shift: window |= blocks[idx + 1] << (64 - shift)
+    return window
+
+
+cdef inline uint8_t _fold_case(char c) noexcept nogil:
+    return c - 32 if c'a' <= c <= c'z' else c
+
+
+cdef inline bint _is_folded_base(char c) noexcept nogil:
+    return is_base(_fold_case(c))
+
+
+READERS = {
+    "fastq": FastqReader,
+    "fasta": FastaReader,
+    "sam": SamReader,
+    "text": LineReader,
+}
+"""Reader classes by format name. Other SeqReader subclasses may be registered here."""
+
+
+def open_reader(object filename, str format=None, size_t threads=1, bint mmap=False, ReadFilter read_filter=None):
+    """Opens a SeqReader for the file. If no format is given then it is determined from
+    the file's content: FASTA, FASTQ, SAM, or otherwise one sequence per line.
+
+    Args:
+        filename: The path of the (optionally gzip or BGZF compressed) file.
+        format: One of the READERS keys, or None to detect it.
+        threads: The number of threads for inflating BGZF input.
+        mmap: Memory map uncompressed input rather than reading it through a buffer.
+        read_filter: A ReadFilter to trim and filter reads as they are streamed.
+    """
+
+    cdef SeqReader reader
+
+    if format is None:
+        format = detect_format(filename)
+    try:
+        cls = READERS[format]
+    except KeyError:
+        raise ValueError(f"Unsupported sequence format: {format!r}. Expected one of {list(READERS)}.")
+
+    reader = cls(filename, threads, mmap)
+    reader.read_filter = read_filter
+    return reader
+
+
+def detect_format(object filename):
+    """Determines the sequence format of a file from its first line(s)."""
+
+    if _detect_format(filename) == FMT_PLAIN:
+        f = open(filename, 'rb')
+    else:
+        f = gzip.open(filename, 'rb')
+
+    with f:
+        first = f.readline(65536)
+        while first and not first.strip():
+            first = f.readline(65536)
+
+    if first.startswith(b">"):
+        return "fasta"
+    if first.startswith(b"@"):
+        # SAM header tags are two letters followed by a tab, e.g. @HD or @SQ
+        return "sam" if first[3:4] == b"\t" and first[1:3].isalpha() else "fastq"
+    if first.count(b"\t") >= 10:
+        return "sam"
+    return "text"
+
+
+cdef StreamFormat _detect_format(object filename) except *:
+    """Determines whether a file is plain text, gzip, or BGZF from its first 18 bytes."""
+
+    with open(filename, 'rb') as f:
+        magic = f.read(18)
+
+    if magic[:2] != b"\x1f\x8b":
+        return FMT_PLAIN
+    if len(magic) == 18 and magic[3] & 4 and magic[10:14] == b"\x06\x00BC":
+        return FMT_BGZF
+    return FMT_GZIP
+
+
+# === Decompression pipeline ===========================================================
+
+cdef _Stream* _stream_open(char* fname, StreamFormat fmt, size_t n_workers) except NULL:
+    """Opens the file and starts the loader thread, plus inflate workers for BGZF input."""
 
-cdef inline void _read_fastq_short_seqs(char* fname, vector[PyObject *] &out):
     cdef:
-        FILE *cfile = fopen(fname, <char*>"rb")
-        char *line = NULL
-        size_t count = 1
-        size_t l = 0
+        _Stream* s = <_Stream *> malloc(sizeof(_Stream))
+        size_t i
+
+    if s is NULL:
+        raise MemoryError("Error while allocating the decompression pipeline.")
+
+    memset(s, 0, sizeof(_Stream))
+    s.fmt = fmt
+    s.n_chunks = 2 * n_workers + 2 if fmt == FMT_BGZF else 3
+    s.n_workers = n_workers if fmt == FMT_BGZF else 0
 
-    if cfile == NULL:
-        raise Exception(f"{str(fname)}: Something went wrong while reading this file.")
+    if fmt == FMT_GZIP:
+        s.gz = gzopen(fname, "rb")
+        if s.gz is NULL:
+            free(s)
+            PyErr_SetFromErrnoWithFilenameObject(OSError, fname.decode())
+        gzbuffer(s.gz, 1 << 17)
+    else:
+        s.cfile = fopen(fname, "rb")
+        if s.cfile is NULL:
+            free(s)
+            PyErr_SetFromErrnoWithFilenameObject(OSError, fname.decode())
 
-    while getline(&line, &l, cfile) != -1:
-        if count % 2 == 0 and count % 4 != 0:
-            seq = sq._from_chars(line)
-            Py_XINCREF(<PyObject *>seq)
-            out.push_back(<PyObject *>seq)
+    s.chunks = <_Chunk *> malloc(s.n_chunks * sizeof(_Chunk))
+    s.workers = <pthread_t *> malloc(max(s.n_workers, 1) * sizeof(pthread_t))
+    if s.chunks is NULL or s.workers is NULL:
+        _stream_free(s)
+        raise MemoryError("Error while allocating the decompression pipeline.")
 
-        count += 1
-    fclose(cfile)
+    memset(s.chunks, 0, s.n_chunks * sizeof(_Chunk))
+    for i in range(s.n_chunks):
+        s.chunks[i].data = <char *> malloc(STREAM_CHUNK_BYTES)
+        if fmt == FMT_BGZF:
+            s.chunks[i].raw = <unsigned char *> malloc(STREAM_CHUNK_BYTES)
+        if s.chunks[i].data is NULL or (fmt == FMT_BGZF and s.chunks[i].raw is NULL):
+            _stream_free(s)
+            raise MemoryError("Error while allocating the decompression pipeline.")
 
+    pthread_mutex_init(&s.lock, NULL)
+    pthread_cond_init(&s.cond, NULL)
+
+    if pthread_create(&s.loader, NULL, _loader_main, s) != 0:
+        s.n_workers = 0
+        s.loader_done = True
+        _stream_free(s)
+        raise Exception("Error while starting the decompression thread.")
+
+    for i in range(s.n_workers):
+        if pthread_create(&s.workers[i], NULL, _inflate_main, s) != 0:
+            s.n_workers = i
+            _stream_close(s)
+            raise Exception("Error while starting the decompression threads.")
+
+    return s
+
+
+cdef int _stream_next(_Stream* s, char** data, size_t* size) noexcept nogil:
+    """Releases the previously returned chunk and waits for the next one in file order.
+
+    Returns:
+        1 if a chunk was returned, 0 at the end of the stream, or -1 on error.
+    """
+
+    cdef _Chunk* chunk
+
+    pthread_mutex_lock(&s.lock)
+    if s.drained:
+        pthread_mutex_unlock(&s.lock)
+        return 0
+
+    if s.holding:
+        chunk = &s.chunks[s.n_consumed % s.n_chunks]
+        s.holding = False
+        if chunk.last:
+            s.drained = True
+            pthread_mutex_unlock(&s.lock)
+            return 0
+
+        chunk.state = CHUNK_EMPTY
+        s.n_consumed += 1
+        pthread_cond_broadcast(&s.cond)
+
+    chunk = &s.chunks[s.n_consumed % s.n_chunks]
+    while chunk.state != CHUNK_READY and not s.failed:
+        pthread_cond_wait(&s.cond, &s.lock)
+
+    if s.failed:
+        pthread_mutex_unlock(&s.lock)
+        return -1
+
+    data[0] = chunk.data
+    size[0] = chunk.size
+    s.holding = True
+    pthread_mutex_unlock(&s.lock)
+    return 1
+
+
+cdef void _stream_close(_Stream* s) noexcept nogil:
+    """Stops and joins the pipeline's threads, then releases its resources."""
+
+    cdef size_t i
+
+    pthread_mutex_lock(&s.lock)
+    s.stop = True
+    pthread_cond_broadcast(&s.cond)
+    pthread_mutex_unlock(&s.lock)
+
+    pthread_join(s.loader, NULL)
+    for i in range(s.n_workers):
+        pthread_join(s.workers[i], NULL)
+
+    pthread_mutex_destroy(&s.lock)
+    pthread_cond_destroy(&s.cond)
+    _stream_free(s)
+
+
+cdef void _stream_free(_Stream* s) noexcept nogil:
+    cdef size_t i
+
+    if s.chunks is not NULL:
+        for i in range(s.n_chunks):
+            free(s.chunks[i].data)
+            free(s.chunks[i].raw)
+        free(s.chunks)
+
+    if s.cfile is not NULL: fclose(s.cfile)
+    if s.gz is not NULL: gzclose(s.gz)
+    free(s.workers)
+    free(s)
+
+
+cdef void _stream_fail(_Stream* s, const char* msg) noexcept nogil:
+    """Records the first error. Must be called while holding the lock."""
+
+    if not s.failed:
+        strncpy(s.errmsg, msg, sizeof(s.errmsg) - 1)
+        s.failed = True
+    pthread_cond_broadcast(&s.cond)
+
+
+cdef void* _loader_main(void* arg) noexcept nogil:
+    """Reads the file into the chunk ring in order. Plain and gzip chunks are ready
+    for the consumer immediately, whereas BGZF chunks are handed to the workers."""
 
-cdef inline void _read_fastq_chars(char * fname, vector[char *] &out) nogil:
     cdef:
-        FILE *cfile = fopen(fname, "rb")
-        char *linecpy = NULL
-        char *line = NULL
-        size_t count = 1
-        size_t l = 0
+        _Stream* s = <_Stream *> arg
+        _Chunk* chunk
+        const char* err = NULL
+        size_t k = 0
+        bint last = False
+        int n
+
+    while not last:
+        chunk = &s.chunks[k % s.n_chunks]
+
+        pthread_mutex_lock(&s.lock)
+        while chunk.state != CHUNK_EMPTY and not s.stop:
+            pthread_cond_wait(&s.cond, &s.lock)
+        if s.stop:
+            pthread_mutex_unlock(&s.lock)
+            break
+        pthread_mutex_unlock(&s.lock)
+
+        if s.fmt == FMT_PLAIN:
+            chunk.size = fread(chunk.data, 1, STREAM_CHUNK_BYTES, s.cfile)
+            last = chunk.size < STREAM_CHUNK_BYTES
+            if ferror(s.cfile): err = "error while reading the file."
+        elif s.fmt == FMT_GZIP:
+            n = gzread(s.gz, chunk.data, STREAM_CHUNK_BYTES)
+            chunk.size = max(n, 0)
+            last = n < <int> STREAM_CHUNK_BYTES
+            if n < 0: err = gzerror(s.gz, &n)
+        else:
+            err = _load_bgzf_blocks(s.cfile, chunk, &last)
+
+        pthread_mutex_lock(&s.lock)
+        chunk.last = last
+        chunk.state = CHUNK_LOADED if s.fmt == FMT_BGZF else CHUNK_READY
+        s.n_loaded = k + 1
+        if err is not NULL:
+            _stream_fail(s, err)
+            last = True
+        s.loader_done = last
+        pthread_cond_broadcast(&s.cond)
+        pthread_mutex_unlock(&s.lock)
+        k += 1
+
+    pthread_mutex_lock(&s.lock)
+    s.loader_done = True
+    pthread_cond_broadcast(&s.cond)
+    pthread_mutex_unlock(&s.lock)
+    return NULL
+
+
+cdef void* _inflate_main(void* arg) noexcept nogil:
+    """Claims loaded BGZF chunks in order and inflates their blocks."""
+
+    cdef:
+        _Stream* s = <_Stream *> arg
+        _Chunk* chunk
+        const char* err
+        z_stream strm
+
+    memset(&strm, 0, sizeof(z_stream))
+    if inflateInit2(&strm, -15) != Z_OK:
+        pthread_mutex_lock(&s.lock)
+        _stream_fail(s, "error while initializing zlib.")
+        pthread_mutex_unlock(&s.lock)
+        return NULL
+
+    while True:
+        pthread_mutex_lock(&s.lock)
+        while not s.stop and s.n_taken >= s.n_loaded and not s.loader_done:
+            pthread_cond_wait(&s.cond, &s.lock)
+
+        if s.stop or s.n_taken >= s.n_loaded:
+            pthread_mutex_unlock(&s.lock)
+            break
+
+        chunk = &s.chunks[s.n_taken % s.n_chunks]
+        s.n_taken += 1
+        pthread_mutex_unlock(&s.lock)
+
+        err = _inflate_bgzf_blocks(&strm, chunk)
+
+        pthread_mutex_lock(&s.lock)
+        chunk.state = CHUNK_READY
+        if err is not NULL:
+            _stream_fail(s, err)
+        pthread_cond_broadcast(&s.cond)
+        pthread_mutex_unlock(&s.lock)
+
+    inflateEnd(&strm)
+    return NULL
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef const char* _load_bgzf_blocks(FILE* cfile, _Chunk* chunk, bint* last) noexcept nogil:
+    """Reads up to BGZF_BLOCKS_PER_CHUNK whole blocks into the chunk's raw buffer.
+    The BSIZE field of each block's BC subfield gives its total size."""
+
+    cdef:
+        unsigned char* block
+        size_t offset = 0
+        size_t xlen, bsize, n, i
+
+    chunk.n_blocks = 0
+    chunk.size = 0
+
+    while chunk.n_blocks < BGZF_BLOCKS_PER_CHUNK:
+        block = chunk.raw + offset
+        n = fread(block, 1, 12, cfile)
+        if n != 12:
+            if ferror(cfile): return "error while reading the file."
+            last[0] = True
+            if n != 0: return "truncated BGZF block."
+            return NULL
+
+        if block[0] != 31 or block[1] != 139 or block[2] != 8 or not block[3] & 4:
+            return "invalid BGZF block header."
+
+        xlen = block[10] | (block[11] << 8)
+        if fread(block + 12, 1, xlen, cfile) != xlen:
+            return "truncated BGZF block."
+
+        bsize = 0
+        i = 12
+        while i + 4 <= 12 + xlen:
+            if block[i] == b'B' and block[i + 1] == b'C' and block[i + 2] == 2:
+                bsize = (block[i + 4] | (block[i + 5] << 8)) + 1
+            i += 4 + (block[i + 2] | (block[i + 3] << 8))
+
+        if bsize < 12 + xlen + 8 or bsize > BGZF_MAX_BLOCK:
+            return "invalid BGZF block size."
+        if fread(block + 12 + xlen, 1, bsize - 12 - xlen, cfile) != bsize - 12 - xlen:
+            return "truncated BGZF block."
+
+        offset += bsize
+        chunk.block_ends[chunk.n_blocks] = offset
+        chunk.n_blocks += 1
+
+    return NULL
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef const char* _inflate_bgzf_blocks(z_stream* strm, _Chunk* chunk) noexcept nogil:
+    """Inflates each of the chunk's raw BGZF blocks into its data buffer, verifying
+    the decompressed size and CRC32 recorded in each block's footer."""
+
+    cdef:
+        unsigned char* block
+        unsigned char* footer
+        size_t start = 0
+        size_t xlen, isize, crc, i
+
+    chunk.size = 0
+    for i in range(chunk.n_blocks):
+        block = chunk.raw + start
+        footer = chunk.raw + chunk.block_ends[i] - 8
+        xlen = block[10] | (block[11] << 8)
+        crc = footer[0] | (footer[1] << 8) | (footer[2] << 16) | (<size_t> footer[3] << 24)
+        isize = footer[4] | (footer[5] << 8) | (footer[6] << 16) | (<size_t> footer[7] << 24)
+
+        if isize > BGZF_MAX_BLOCK:
+            return "invalid BGZF block size."
+
+        inflateReset(strm)
+        strm.next_in = block + 12 + xlen
+        strm.avail_in = footer - strm.next_in
+        strm.next_out = <unsigned char *> chunk.data + chunk.size
+        strm.avail_out = STREAM_CHUNK_BYTES - chunk.size
+
+        if inflate(strm, Z_FINISH) != Z_STREAM_END or \
+                strm.next_out - <unsigned char *> chunk.data - chunk.size != isize:
+            return "corrupt BGZF block."
+        if crc32(0, <unsigned char *> chunk.data + chunk.size, isize) != crc:
+            return "BGZF block failed CRC check."
+
+        chunk.size += isize
+        start = chunk.block_ends[i]
+
+    return NULL
+
+
+# === Parallel packing =================================================================
+
+cdef _pack_reads_parallel(SeqReader reader, size_t n_threads, object sink, pack_sink add):
+    """Reads are packed by n_threads workers in rounds. While one round is being
+    packed, the previous round's packed reads are passed to add(sink, jobs, n_jobs)."""
+
+    cdef:
+        _PackJob* jobs = <_PackJob *> calloc(2 * n_threads, sizeof(_PackJob))
+        _PackJob* batch
+        _PackJob* prev = NULL
+        size_t n_batch, n_prev = 0
+        size_t rnd = 0
+
+    if jobs is NULL:
+        raise MemoryError("Error while allocating packing jobs.")
+
+    try:
+        while True:
+            batch = jobs + (rnd % 2) * n_threads
+            n_batch = _fill_pack_jobs(reader, batch, n_threads)
+            with nogil:
+                _start_pack_jobs(batch, n_batch)
+
+            try:
+                if prev is not NULL:
+                    add(sink, prev, n_prev)
+            finally:
+                with nogil:
+                    _join_pack_jobs(batch, n_batch)
+
+            if n_batch == 0: break
+            prev, n_prev = batch, n_batch
+            rnd += 1
+    finally:
+        _free_pack_jobs(jobs, 2 * n_threads)
+        free(jobs)
+
+
+cdef size_t _fill_pack_jobs(SeqReader reader, _PackJob* jobs, size_t n_jobs) except? 0:
+    """Distributes up to PACK_JOB_READS reads to each job, in file order.
+
+    Returns:
+        The number of jobs that received reads.
+    """
+
+    cdef:
+        _PackJob* job
+        char* seq
+        char* grown
+        size_t length, i
+
+    for i in range(n_jobs):
+        job = &jobs[i]
+        job.n_reads = job.text_size = 0
+        job.n_bad = 0
+
+        if job.starts is NULL:
+            job.starts = <size_t *> malloc((PACK_JOB_READS + 1) * sizeof(size_t))
+            if job.starts is NULL:
+                raise MemoryError("Error while allocating a packing job.")
+
+        while job.n_reads < PACK_JOB_READS and reader.next_seq(&seq, &length):
+            if job.text_size + length > job.text_cap:
+                grown = <char *> realloc(job.text, max(job.text_cap * 2, job.text_size + length, 1 << 20))
+                if grown is NULL:
+                    raise MemoryError("Error while allocating a packing job.")
+                job.text_cap = max(job.text_cap * 2, job.text_size + length, 1 << 20)
+                job.text = grown
+
+            memcpy(job.text + job.text_size, seq, length)
+            job.starts[job.n_reads] = job.text_size
+            job.text_size += length
+            job.n_reads += 1
+
+        job.starts[job.n_reads] = job.text_size
+        if job.n_reads == 0:
+            return i
+
+    return n_jobs
+
+
+cdef void* _pack_job_main(void* arg) noexcept nogil:
+    """Packs each of the job's reads into consecutive blocks. Packing stops at the
+    first read that is too long or contains an unsupported base."""
+
+    cdef:
+        _PackJob* job = <_PackJob *> arg
+        size_t n_words = 0
+        uint64_t* words
+        size_t length, i
+
+    for i in range(job.n_reads):
+        n_words += _nt_len_to_block_num(job.starts[i + 1] - job.starts[i])
+
+    if n_words > job.words_cap:
+        free(job.words)
+        job.words = <uint64_t *> malloc(n_words * sizeof(uint64_t))
+        job.words_cap = n_words if job.words is not NULL else 0
+        if job.words is NULL:
+            job.no_memory = True
+            return NULL
+
+    words = job.words
+    for i in range(job.n_reads):
+        length = job.starts[i + 1] - job.starts[i]
+        if length > sq.MAX_VAR_NT or not _pack_bytes_array(words, <uint8_t *> job.text + job.starts[i], length):
+            job.n_bad = i
+            return NULL
+        words += _nt_len_to_block_num(length)
+
+    job.n_bad = job.n_reads
+    return NULL
+
+
+cdef void _start_pack_jobs(_PackJob* jobs, size_t n_jobs) noexcept nogil:
+    """Starts a worker thread for each job. Jobs are packed on the calling
+    thread if a worker can't be started."""
+
+    cdef size_t i
+
+    for i in range(n_jobs):
+        jobs[i].no_memory = False
+        jobs[i].running = pthread_create(&jobs[i].thread, NULL, _pack_job_main, &jobs[i]) == 0
+        if not jobs[i].running:
+            _pack_job_main(&jobs[i])
+
+
+cdef void _join_pack_jobs(_PackJob* jobs, size_t n_jobs) noexcept nogil:
+    cdef size_t i
+
+    for i in range(n_jobs):
+        if jobs[i].running:
+            pthread_join(jobs[i].thread, NULL)
+            jobs[i].running = False
 
-    if cfile == NULL:
-        raise Exception(f"{str(fname)}: Something went wrong while reading this file.")
 
-    while getline(&line, &l, cfile) != -1:
-        if count % 2 == 0 and count % 4 != 0:
-            linecpy = strdup(line)
-            out.push_back(linecpy)
+cdef void _free_pack_jobs(_PackJob* jobs, size_t n_jobs) noexcept nogil:
+    cdef size_t i
 
-        count += 1
-    fclose(cfile)
\ No newline at end of file
+    for i in range(n_jobs):
+        free(jobs[i].text)
+        free(jobs[i].starts)
+        free(jobs[i].words)
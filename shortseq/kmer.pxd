@@ -0,0 +1,34 @@
+from cpython.mem cimport PyMem_Malloc, PyMem_Realloc, PyMem_Free
+from libc.string cimport memcpy
+
+from .short_seq cimport pack, _new, _from_packed, _packed_blocks
+from .short_seq_64 cimport MAX_64_NT
+from .short_seq_var cimport MAX_VAR_NT
+from .counter cimport PackedCounter, _Slot, _load_counts, COUNT_OVERFLOW
+from .fast_read cimport *
+from .util cimport *
+
+"""
+K-mers are extracted as uint64 codes in the same 2-bit encoding as ShortSeq64, i.e.
+the code of a k-mer is the packed block of the equivalent ShortSeq. Codes are rolled
+forward one base at a time, along with the code of the reverse complement, so that
+canonical codes cost no more than forward codes.
+"""
+
+cdef class KmerCounter(PackedCounter):
+    cdef readonly size_t k
+
+    cdef int _add_kmers(self, uint64_t* blocks, size_t length) except -1
+
+
+cdef class _KmerArray:
+    cdef uint64_t* _codes
+    cdef size_t _size
+    cdef size_t _cap
+    cdef size_t k
+    cdef bint canonical
+
+    cdef int _add_kmers(self, uint64_t* blocks, size_t length) except -1
+
+
+cdef size_t _extract_kmers(uint64_t* blocks, size_t length, size_t k, bint canonical, uint64_t* out) noexcept nogil
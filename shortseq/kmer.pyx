@@ -0,0 +1,288 @@
+# cython: language_level = 3, language=c++, profile=False, linetrace=False
+
+import numpy as np
+
+from .fast_read import open_reader
+
+
+def kmers(object seq, size_t k, bint canonical=False):
+    """Returns the codes of the sequence's overlapping k-mers, in order.
+
+    Args:
+        seq: A str, bytes, or ShortSeq.
+        k: The k-mer length, up to 32.
+        canonical: If True, each k-mer is reported as whichever of it and its
+            reverse complement comes first alphabetically.
+
+    Returns:
+        A NumPy uint64 array of len(seq) - k + 1 codes (empty if the sequence is
+        shorter than k). Codes can be converted to ShortSeqs with decode_kmer().
+    """
+
+    cdef uint64_t[::1] view
+    cdef uint64_t* blocks
+    cdef size_t length
+
+    _check_k(k)
+    seq = pack(seq)
+    blocks = _packed_blocks(seq, &length)
+
+    out = np.empty(length - k + 1 if length >= k else 0, dtype=np.uint64)
+    if length >= k:
+        view = out
+        _extract_kmers(blocks, length, k, canonical, &view[0])
+
+    return out
+
+
+def kmers_from_file(object filename, size_t k, bint canonical=False, str format=None, size_t threads=1, bint mmap=False):
+    """Returns the codes of every k-mer in a sequence file as a single NumPy uint64 array,
+    in file order. Reads are packed and their k-mers extracted without creating ShortSeqs.
+    See read_and_count() for the remaining arguments."""
+
+    cdef _KmerArray out = _KmerArray(k, canonical)
+
+    _scan_file(out, open_reader(filename, format, threads, mmap), threads)
+    return out.to_numpy()
+
+
+def count_kmers(object filename, size_t k, bint canonical=False, str format=None, size_t threads=1, bint mmap=False):
+    """Counts the k-mers of every read in a sequence file into a KmerCounter. No Python
+    objects are allocated per read or per k-mer. See read_and_count() for the remaining arguments."""
+
+    cdef KmerCounter counts = KmerCounter(k, canonical=canonical)
+
+    _scan_file(counts, open_reader(filename, format, threads, mmap), threads)
+    return counts
+
+
+def decode_kmer(uint64_t code, size_t k):
+    """Returns the ShortSeq represented by a k-mer code."""
+
+    _check_k(k)
+    code = _bzhi_u64(code, 2 * k)
+    return _from_packed(&code, k)
+
+
+cdef class KmerCounter(PackedCounter):
+    """Counts k-mers in a native hash table. Each k-mer is held inline as its 2-bit code,
+    so counting allocates no Python objects. Like PackedCounter, it offers a read-only
+    dict-like view with ShortSeq64 keys.
+
+    If canonical is True, each k-mer is counted under whichever of it and its
+    reverse complement comes first alphabetically.
+    """
+
+    def __init__(self, size_t k, source=None, bint canonical=False):
+        _check_k(k)
+        self.k = k
+        self.canonical = canonical
+        if source is not None:
+            self.update(source)
+
+    def update(self, source):
+        """Counts the k-mers of each sequence in source (str, bytes, or ShortSeq), or
+        adds the counts of a mapping of k-mers to counts."""
+
+        cdef uint64_t* blocks
+        cdef size_t length
+
+        if hasattr(source, "items"):
+            for key in source.keys():
+                if len(key) != self.k:
+                    raise Exception(f"Expected a k-mer of length {self.k}, got {key!r}.")
+            PackedCounter.update(self, source)
+        else:
+            for item in source:
+                seq = pack(item)
+                blocks = _packed_blocks(seq, &length)
+                self._add_kmers(blocks, length)
+
+    def to_numpy(self):
+        """Returns the k-mer codes and their counts as a pair of NumPy uint64 arrays."""
+
+        cdef uint64_t[::1] codes_view, counts_view
+        cdef _Slot* slot
+        cdef size_t i, j = 0
+
+        codes = np.empty(self._size, dtype=np.uint64)
+        counts = np.empty(self._size, dtype=np.uint64)
+        codes_view, counts_view = codes, counts
+
+        for i in range(self._capacity):
+            slot = &self._slots[i]
+            if slot.count:
+                codes_view[j] = slot.key
+                if slot.count != COUNT_OVERFLOW:
+                    counts_view[j] = slot.count
+                else:
+                    counts_view[j] = self._count_of(slot)
+                j += 1
+
+        return codes, counts
+
+    @classmethod
+    def load(cls, filename):
+        """Reads counts that were saved with dump(). k is read from the file header, or
+        taken from the stored k-mers if the file was saved by another type of counter."""
+
+        cdef KmerCounter counts = cls.__new__(cls)
+        cdef size_t i
+
+        counts.k = _load_counts(counts, filename)
+        for i in range(counts._capacity):
+            if not counts._slots[i].count: continue
+            if counts.k == 0:
+                counts.k = counts._slots[i].length
+            if counts._slots[i].length != counts.k or counts.k > MAX_64_NT:
+                raise Exception(f"{filename} does not hold k-mers of a single length up to {MAX_64_NT}.")
+
+        _check_k(counts.k)
+        return counts
+
+    def __reduce__(self):
+        return KmerCounter, (self.k, dict(self.items()), self.canonical)
+
+    def __repr__(self):
+        return f"<KmerCounter (k={self.k}): {self._size} unique k-mers>"
+
+    cdef int _add_kmers(self, uint64_t* blocks, size_t length) except -1:
+        cdef uint64_t codes[1024]      # Enough for the k-mers of MAX_VAR_NT bases
+        cdef size_t n, i
+
+        _check_k(self.k)
+        # Forward codes are extracted because _add() canonicalizes keys in canonical mode
+        n = _extract_kmers(blocks, length, self.k, False, codes)
+        for i in range(n):
+            self._add(&codes[i], self.k, 1)
+
+        return 0
+
+
+cdef class _KmerArray:
+    """A growable buffer of k-mer codes, for kmers_from_file()."""
+
+    def __cinit__(self, size_t k, bint canonical):
+        _check_k(k)
+        self.k = k
+        self.canonical = canonical
+        self._cap = 1024
+        self._codes = <uint64_t *> PyMem_Malloc(self._cap * sizeof(uint64_t))
+        if self._codes is NULL:
+            raise MemoryError("Error while allocating k-mer storage.")
+
+    cdef int _add_kmers(self, uint64_t* blocks, size_t length) except -1:
+        cdef size_t cap
+        cdef uint64_t* grown
+
+        if length < self.k:
+            return 0
+
+        if self._size + length > self._cap:
+            cap = max(self._cap * 2, self._size + length)
+            grown = <uint64_t *> PyMem_Realloc(self._codes, cap * sizeof(uint64_t))
+            if grown is NULL:
+                raise MemoryError("Error while growing k-mer storage.")
+            self._codes = grown
+            self._cap = cap
+
+        self._size += _extract_kmers(blocks, length, self.k, self.canonical, self._codes + self._size)
+        return 0
+
+    def to_numpy(self):
+        cdef uint64_t[::1] view
+
+        out = np.empty(self._size, dtype=np.uint64)
+        if self._size:
+            view = out
+            memcpy(&view[0], self._codes, self._size * sizeof(uint64_t))
+
+        return out
+
+    def __dealloc__(self):
+        PyMem_Free(self._codes)
+
+
+cdef size_t _extract_kmers(uint64_t* blocks, size_t length, size_t k, bint canonical, uint64_t* out) noexcept nogil:
+    """Writes the codes of the sequence's length - k + 1 k-mers to out and returns their number.
+
+    Each base enters the forward code at its top and the reverse complement's code at
+    its bottom, so both are updated with a shift and an OR per base.
+    """
+
+    cdef:
+        uint64_t mask = _bzhi_u64(~0ULL, 2 * k)
+        size_t top = 2 * (k - 1)
+        uint64_t fwd = 0, rev = 0, base
+        size_t i, n = 0
+
+    if k == 0 or k > MAX_64_NT or length < k:
+        return 0
+
+    for i in range(length):
+        base = (blocks[i >> 5] >> ((i & 31) * 2)) & 0b11
+        fwd = (fwd >> 2) | (base << top)
+        rev = ((rev << 2) | (base ^ 0b10)) & mask
+
+        if i + 1 >= k:
+            out[n] = rev if canonical and _lex_cmp_block(rev, fwd) < 0 else fwd
+            n += 1
+
+    return n
+
+
+cdef inline int _check_k(size_t k) except -1:
+    if k == 0 or k > MAX_64_NT:
+        raise Exception(f"k must be between 1 and {MAX_64_NT} (got {k}).")
+    return 0
+
+
+cdef _scan_file(object sink, SeqReader reader, size_t n_threads):
+    """Packs each read and passes its blocks to sink, a KmerCounter or _KmerArray.
+    With more than one thread, reads are packed in rounds by worker threads while the
+    previous round's k-mers are extracted."""
+
+    cdef:
+        uint64_t blocks[32]            # Enough for MAX_VAR_NT bases
+        char* seqchars
+        size_t length
+
+    if n_threads <= 1:
+        while reader.next_seq(&seqchars, &length):
+            if length > MAX_VAR_NT or not _pack_bytes_array(blocks, <uint8_t *> seqchars, length):
+                # Repeat with the regular constructor to raise the appropriate exception
+                _new(seqchars, length)
+                raise Exception("Something went wrong while packing a sequence.")
+            _sink_add(sink, blocks, length)
+        return
+
+    _pack_reads_parallel(reader, n_threads, sink, _sink_add_pack_jobs)
+
+
+cdef _sink_add_pack_jobs(object sink, _PackJob* jobs, size_t n_jobs):
+    cdef:
+        _PackJob* job
+        uint64_t* words
+        size_t length, i, j
+
+    for j in range(n_jobs):
+        job = &jobs[j]
+        if job.no_memory:
+            raise MemoryError("Error while allocating packed blocks.")
+
+        words = job.words
+        for i in range(job.n_reads):
+            length = job.starts[i + 1] - job.starts[i]
+            if i == job.n_bad:
+                # Repeat with the regular constructor to raise the appropriate exception
+                _new(job.text + job.starts[i], length)
+                raise Exception("Something went wrong while packing a sequence.")
+
+            _sink_add(sink, words, length)
+            words += _nt_len_to_block_num(length)
+
+
+cdef inline int _sink_add(object sink, uint64_t* blocks, size_t length) except -1:
+    if type(sink) is _KmerArray:
+        return (<_KmerArray> sink)._add_kmers(blocks, length)
+    return (<KmerCounter> sink)._add_kmers(blocks, length)
@@ -1,7 +1,9 @@
 from cpython.bytes cimport PyBytes_AsString, PyBytes_Check
 from cpython.unicode cimport PyUnicode_DATA, PyUnicode_GET_LENGTH, PyUnicode_Check
 
-from libc.string cimport memcpy
+from cpython.ref cimport Py_INCREF, Py_DECREF
+from cpython.tuple cimport PyTuple_GET_ITEM
+from libc.string cimport memcpy, memcmp, memset
 
 from .short_seq_var cimport *
 from .short_seq_192 cimport *
@@ -9,10 +11,45 @@ from .short_seq_64 cimport *
 from .util cimport *
 
 """
-Singleton values
+Singleton values. Every sequence of up to SINGLETON_NT bases is preallocated, in order of
+length and then packed value, so these are returned without allocating.
 """
 
 cdef ShortSeq64 empty
+cdef tuple _singletons
+
+cdef enum:
+    SINGLETON_NT = 4
+
+
+"""
+Intern pool. An optional, bounded cache of constructed ShortSeqs, consulted whenever
+a sequence longer than SINGLETON_NT is constructed so that repeated sequences share
+one object. Entries are grouped into buckets of INTERN_WAYS by hash. Each entry counts
+its hits, and a miss in a full bucket evicts the entry with the fewest hits and halves
+the others, so frequently seen sequences stay pooled while stale ones age out.
+"""
+
+cdef enum:
+    INTERN_WAYS = 4
+
+ctypedef struct _InternEntry:
+    PyObject* seq                      # Strong reference, or NULL if the entry is free
+    Py_hash_t hash
+    uint64_t hits
+
+cdef class InternPool:
+    cdef _InternEntry* _entries
+    cdef size_t _n_buckets
+    cdef readonly size_t capacity
+    cdef readonly size_t size
+    cdef readonly size_t n_lookups
+    cdef readonly size_t n_hits
+    cdef readonly size_t n_evictions
+
+    cdef object _get(self, uint64_t* blocks, size_t length)
+
+cdef InternPool _intern_pool
 
 
 """
@@ -24,6 +61,12 @@ cdef object _from_py_str(str seq_str)
 cdef object _from_py_bytes(bytes seq_bytes)
 cdef object _from_chars(char* sequence)
 cdef object _new(char* sequence, size_t length)
+cdef object _from_packed(uint64_t* packed, size_t length)
+cdef uint64_t* _packed_blocks(object seq, size_t* length)
+cdef object _revcomp(uint64_t* packed, size_t length)
+cdef object _canonical(object seq)
 
 cdef ShortSeq64 _subscript(uint64_t packed, size_t offset)
-cdef object _slice(uint64_t* packed, size_t offset, size_t slice_len)
\ No newline at end of file
+cdef object _slice(uint64_t* packed, size_t offset, size_t slice_len)
+cdef object _build_slice(uint64_t* packed, size_t offset, size_t slice_len)
+cdef object _singleton(uint64_t packed, size_t length)
@@ -5,8 +5,24 @@ from cython.operator cimport dereference as deref
 
 # Singleton Values
 cdef ShortSeq64 empty = ShortSeq64.__new__(ShortSeq64)
-# Generate 1-, 2-, and 3-mer singletons table
-# kmers = ["".join(x) for n in range(1, 4) for x in itertools.product(*(["ATGC"] * n))]
+
+cdef tuple _init_singletons():
+    cdef ShortSeq64 seq
+    cdef list out = [empty]
+    cdef size_t length
+    cdef uint64_t packed
+
+    for length in range(1, SINGLETON_NT + 1):
+        for packed in range(1ULL << (2 * length)):
+            seq = ShortSeq64.__new__(ShortSeq64)
+            seq._packed = packed
+            seq._length = <uint8_t> length
+            out.append(seq)
+
+    return tuple(out)
+
+cdef tuple _singletons = _init_singletons()
+cdef InternPool _intern_pool = None
 
 # === Python constructors ===============================================================
 
@@ -52,8 +68,15 @@ cdef inline object _from_chars(char* sequence):
     return _new(sequence, length)
 
 cdef inline object _new(char* sequence, size_t length):
+    cdef uint64_t blocks[32]           # Enough for MAX_VAR_NT bases
+
     if length == 0:
         return empty
+    elif length <= SINGLETON_NT:
+        return _singleton(_marshall_bytes_64(<uint8_t *> sequence, <uint8_t> length), length)
+    elif _intern_pool is not None and length <= MAX_VAR_NT:
+        _marshall_bytes_array(blocks, <uint8_t *> sequence, length)
+        return _intern_pool._get(blocks, length)
     elif length <= MAX_64_NT:
         out64 = ShortSeq64.__new__(ShortSeq64)
         length = <uint8_t> length
@@ -73,6 +96,55 @@ cdef inline object _new(char* sequence, size_t length):
     else:
         raise Exception(f"Sequences longer than {MAX_VAR_NT} bases are not supported.")
 
+cdef inline object _from_packed(uint64_t* packed, size_t length):
+    """Constructs a new ShortSeq from blocks that have already been packed,
+    e.g. by a nogil worker. The blocks are copied, not borrowed."""
+
+    if length == 0:
+        return empty
+    else:
+        return _slice(packed, 0, length)
+
+
+cdef uint64_t* _packed_blocks(object seq, size_t* length):
+    """Returns a pointer to the blocks of a ShortSeq, which must outlive its use."""
+
+    if type(seq) is ShortSeq64:
+        length[0] = (<ShortSeq64> seq)._length
+        return &(<ShortSeq64> seq)._packed
+    elif type(seq) is ShortSeq192:
+        length[0] = (<ShortSeq192> seq)._length
+        return (<ShortSeq192> seq)._packed
+    else:
+        length[0] = (<ShortSeqVar> seq)._length
+        return (<ShortSeqVar> seq)._packed
+
+
+
+cdef object _revcomp(uint64_t* packed, size_t length):
+    """Constructs a new ShortSeq holding the reverse complement of a packed sequence."""
+
+    cdef uint64_t rc[32]               # Enough for MAX_VAR_NT bases
+
+    if length == 0:
+        return empty
+
+    _revcomp_blocks(rc, packed, length)
+    return _from_packed(rc, length)
+
+
+cdef object _canonical(object seq):
+    """Returns the ShortSeq or its reverse complement, whichever comes first alphabetically.
+    The original object is returned if it is already canonical."""
+
+    cdef uint64_t rc[32]
+    cdef uint64_t* blocks
+    cdef size_t length
+
+    blocks = _packed_blocks(seq, &length)
+    if _canonical_blocks(blocks, length, rc) == blocks:
+        return seq
+    return _from_packed(rc, length)
 
 # todo: refactor to take bit offset rather than nt offset, for consistency
 cdef inline ShortSeq64 _subscript(uint64_t packed, size_t offset):
@@ -85,10 +157,13 @@ cdef inline ShortSeq64 _subscript(uint64_t packed, size_t offset):
             The offset in bits of the encoded base.
     """
 
-    cdef ShortSeq64 out = ShortSeq64.__new__(ShortSeq64)
-    out._packed = (packed >> offset) & 0b11
-    out._length = 1
-    return out
+    return <ShortSeq64> PyTuple_GET_ITEM(_singletons, 1 + ((packed >> offset) & 0b11))
+
+
+cdef inline object _singleton(uint64_t packed, size_t length):
+    """Returns the preallocated ShortSeq64 for a sequence of up to SINGLETON_NT bases."""
+
+    return <object> PyTuple_GET_ITEM(_singletons, (((1ULL << (2 * length)) - 1) // 3) + packed)
 
 
 cdef inline object _slice(uint64_t* packed, size_t offset, size_t slice_len_nts):
@@ -104,8 +179,29 @@ cdef inline object _slice(uint64_t* packed, size_t offset, size_t slice_len_nts)
         A new ShortSeq object containing the specified slice. The 
         type of the returned object depends on the length of the 
         slice and may not match the type of the original ShortSeq.
+        Short slices are singletons, and others may come from the
+        intern pool if one is set.
     """
 
+    cdef uint64_t blocks[32]           # Enough for MAX_VAR_NT bases
+    cdef uint64_t block
+
+    if slice_len_nts <= SINGLETON_NT:
+        if offset + slice_len_nts * 2 > 64:
+            block = (packed[0] >> offset) | (packed[1] << (64 - offset))
+        else:
+            block = packed[0] >> offset
+        return _singleton(_bzhi_u64(block, slice_len_nts * 2), slice_len_nts)
+    elif _intern_pool is not None and slice_len_nts <= MAX_VAR_NT:
+        _shift_copy_trim(blocks, packed, slice_len_nts * 2, offset)
+        return _intern_pool._get(blocks, slice_len_nts)
+
+    return _build_slice(packed, offset, slice_len_nts)
+
+
+cdef object _build_slice(uint64_t* packed, size_t offset, size_t slice_len_nts):
+    """Constructs a new ShortSeq object from a slice, bypassing singletons and the intern pool."""
+
     if slice_len_nts <= MAX_64_NT:
         return _slice_to_ShortSeq64(packed, offset, slice_len_nts)
     elif slice_len_nts <= MAX_192_NT:
@@ -182,7 +278,7 @@ cdef ShortSeqVar _slice_to_ShortSeqVar(uint64_t* packed, size_t offset, size_t s
     cdef:
         ShortSeqVar outvar = ShortSeqVar.__new__(ShortSeqVar)
         size_t n_blocks = _nt_len_to_block_num(slice_len_nts)
-        uint64_t* result = <llstr> PyObject_Calloc(n_blocks, sizeof(uint64_t))
+        uint64_t* result = _alloc_var_blocks(n_blocks)
         size_t slice_len_bits = slice_len_nts * 2
 
     if result is NULL:
@@ -191,7 +287,7 @@ cdef ShortSeqVar _slice_to_ShortSeqVar(uint64_t* packed, size_t offset, size_t s
     try:
         _shift_copy_trim(result, packed, slice_len_bits, offset)
     except Exception as e:
-        PyObject_Free(result)
+        _free_var_blocks(result, n_blocks)
         raise e
 
     outvar._packed = result
@@ -236,3 +332,157 @@ cdef inline void _shift_copy_trim(uint64_t* dst, uint64_t* src, size_t slice_len
     if tail:
         # Trim the final block to the correct length
         dst[n_blocks_dst - 1] = _bzhi_u64(dst[n_blocks_dst - 1], tail)
+
+
+# === Intern pool =======================================================================
+
+cdef class InternPool:
+    """A bounded pool of ShortSeqs that lets repeated sequences share a single object.
+
+    Once set with set_intern_pool(), the pool is consulted whenever a ShortSeq longer
+    than SINGLETON_NT bases is constructed, whether by pack(), slicing, or the file
+    readers and counters. The new sequence is packed on the stack and, if an equal
+    sequence is pooled, that object is returned instead of allocating a new one.
+    Sequences of up to SINGLETON_NT bases are always shared, without a pool.
+
+    The pool holds up to capacity sequences (rounded up to a power of two). When it is
+    full, eviction favors the sequences with the fewest recent hits, so the pool
+    suits libraries dominated by a modest number of highly repeated sequences.
+
+    Args:
+        capacity: The maximum number of pooled sequences.
+    """
+
+    def __cinit__(self, size_t capacity=65536):
+        cdef size_t n_buckets = 1
+
+        while n_buckets * INTERN_WAYS < capacity:
+            n_buckets *= 2
+
+        self._entries = <_InternEntry *> PyObject_Calloc(n_buckets * INTERN_WAYS, sizeof(_InternEntry))
+        if self._entries is NULL:
+            raise MemoryError("Error while allocating the intern pool.")
+
+        self._n_buckets = n_buckets
+        self.capacity = n_buckets * INTERN_WAYS
+
+    def stats(self):
+        """Returns the pool's size and its lookups, hits, hit rate, and evictions since it was created."""
+
+        return {
+            "capacity": self.capacity,
+            "size": self.size,
+            "lookups": self.n_lookups,
+            "hits": self.n_hits,
+            "hit_rate": self.n_hits / self.n_lookups if self.n_lookups else 0.0,
+            "evictions": self.n_evictions,
+        }
+
+    def clear(self):
+        """Releases every pooled sequence. Statistics are kept."""
+
+        cdef size_t i
+
+        for i in range(self.capacity):
+            if self._entries[i].seq is not NULL:
+                Py_DECREF(<object> self._entries[i].seq)
+        memset(self._entries, 0, self.capacity * sizeof(_InternEntry))
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, object seq):
+        """Returns whether a sequence (str, bytes, or ShortSeq) equal to seq is pooled.
+        Unlike construction, the lookup neither pools seq nor updates statistics."""
+
+        cdef uint64_t stack_blocks[32]     # Enough for MAX_VAR_NT bases
+        cdef uint64_t* blocks = stack_blocks
+        cdef uint64_t* pooled
+        cdef _InternEntry* bucket
+        cdef size_t length, pooled_len, n_blocks, i
+        cdef Py_hash_t seq_hash
+
+        if PyUnicode_Check(seq):
+            seq = (<str> seq).encode()
+        if PyBytes_Check(seq):
+            length = len(<bytes> seq)
+            if length > MAX_VAR_NT or not _pack_bytes_array(stack_blocks, <uint8_t *> PyBytes_AsString(seq), length):
+                return False
+        else:
+            blocks = _packed_blocks(seq, &length)
+
+        n_blocks = _nt_len_to_block_num(length)
+        seq_hash = _hash_blocks(blocks, n_blocks, length)
+        bucket = &self._entries[(<size_t> seq_hash & (self._n_buckets - 1)) * INTERN_WAYS]
+        for i in range(INTERN_WAYS):
+            if bucket[i].seq is not NULL and bucket[i].hash == seq_hash:
+                pooled = _packed_blocks(<object> bucket[i].seq, &pooled_len)
+                if pooled_len == length and memcmp(pooled, blocks, n_blocks * sizeof(uint64_t)) == 0:
+                    return True
+
+        return False
+
+    def __repr__(self):
+        return f"<InternPool: {self.size} of {self.capacity} sequences, {self.n_hits} hits in {self.n_lookups} lookups>"
+
+    def __dealloc__(self):
+        if self._entries is not NULL:
+            self.clear()
+            PyObject_Free(self._entries)
+
+    cdef object _get(self, uint64_t* blocks, size_t length):
+        """Returns the pooled ShortSeq equal to the packed sequence, pooling a new one on a miss."""
+
+        cdef:
+            size_t n_blocks = _nt_len_to_block_num(length)
+            Py_hash_t seq_hash = _hash_blocks(blocks, n_blocks, length)
+            _InternEntry* bucket = &self._entries[(<size_t> seq_hash & (self._n_buckets - 1)) * INTERN_WAYS]
+            _InternEntry* victim = bucket
+            uint64_t* pooled
+            size_t pooled_len, i
+
+        self.n_lookups += 1
+        for i in range(INTERN_WAYS):
+            if bucket[i].seq is NULL:
+                victim = &bucket[i]
+                continue
+            if bucket[i].hash == seq_hash:
+                pooled = _packed_blocks(<object> bucket[i].seq, &pooled_len)
+                if pooled_len == length and memcmp(pooled, blocks, n_blocks * sizeof(uint64_t)) == 0:
+                    bucket[i].hits += 1
+                    self.n_hits += 1
+                    return <object> bucket[i].seq
+            if victim.seq is not NULL and bucket[i].hits < victim.hits:
+                victim = &bucket[i]
+
+        seq = _build_slice(blocks, 0, length)
+
+        if victim.seq is not NULL:
+            for i in range(INTERN_WAYS):
+                bucket[i].hits >>= 1
+            Py_DECREF(<object> victim.seq)
+            self.n_evictions += 1
+            self.size -= 1
+
+        Py_INCREF(seq)
+        victim.seq = <PyObject *> seq
+        victim.hash = seq_hash
+        victim.hits = 0
+        self.size += 1
+        return seq
+
+
+def set_intern_pool(InternPool pool):
+    """Sets the InternPool consulted when ShortSeqs are constructed, or disables interning
+    if pool is None. Returns the previous pool, if any."""
+
+    global _intern_pool
+    previous, _intern_pool = _intern_pool, pool
+    return previous
+
+
+def get_intern_pool():
+    """Returns the InternPool in use, or None if interning is disabled."""
+
+    return _intern_pool
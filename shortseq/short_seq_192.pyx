@@ -1,6 +1,7 @@
 # cython: language_level=3, language=c++, profile=False, linetrace=False
 
 cimport cython
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_FromStringAndSize
 
 """ MEASURED ON PYTHON 3.10
 ShortSeq192: packs sequences up to 96 bases in length
@@ -24,10 +25,19 @@ MAX_192_NT = 96
 """Used to export these constants to Python space"""
 def get_domain_192(): return MIN_192_NT, MAX_192_NT
 
+def _restore_192(bytes blocks, size_t length):
+    """Reconstructs a ShortSeq192 from its packed blocks when unpickling."""
+
+    if not MIN_192_NT <= length <= MAX_192_NT or Py_SIZE(blocks) != _nt_len_to_block_num(length) * sizeof(uint64_t):
+        raise Exception(f"Invalid ShortSeq192 state (length {length}, {Py_SIZE(blocks)} bytes)")
+
+    return _from_packed(<uint64_t *> PyBytes_AS_STRING(blocks), length)
+
+@cython.freelist(256)
 cdef class ShortSeq192:
 
     def __hash__(self):
-        return self._packed[0]
+        return _hash_blocks(self._packed, _nt_len_to_block_num(self._length), self._length)
 
     def __len__(self):
         return self._length
@@ -90,8 +100,22 @@ cdef class ShortSeq192:
 
         return pop_cnt
 
+    def revcomp(self):
+        """Returns the reverse complement of the sequence."""
+
+        return _revcomp(self._packed, self._length)
+
+    def canonical(self):
+        """Returns the sequence or its reverse complement, whichever comes first alphabetically."""
+
+        return _canonical(self)
+
     def __str__(self):
-        return _unmarshall_bytes_192(self._packed, self._length)
+        return _unmarshall_str(self._packed, self._length)
+
+    def __reduce__(self):
+        cdef size_t n_bytes = _nt_len_to_block_num(self._length) * sizeof(uint64_t)
+        return _restore_192, (PyBytes_FromStringAndSize(<char *> self._packed, n_bytes), self._length)
 
     def __repr__(self):
         return f"<ShortSeq192 ({self._length} nt): {self}>"
@@ -108,25 +132,6 @@ cdef inline void _marshall_bytes_192(ShortSeq192 out, uint8_t* sequence, uint8_t
     out._length = length
 
 
-@cython.wraparound(False)
-@cython.cdivision(True)
-@cython.boundscheck(False)
-cdef inline unicode _unmarshall_bytes_192(uint64_t* enc_seq, uint8_t length):
-    cdef size_t rem = length
-    cdef uint64_t block
-    cdef uint8_t i, o, offset
-
-    for i in range(_nt_len_to_block_num(length)):
-        block = enc_seq[i]
-        offset = i * 32
-        for o in range(offset, offset + min(32, rem)):
-            out_ascii_buffer_96[o] = charmap[block & 0b11]
-            block >>= 2
-        rem -= 32
-
-    return PyUnicode_DecodeASCII(out_ascii_buffer_96, length, NULL)
-
-
 cdef inline ShortSeq64 _subscript_192(uint64_t* enc_seq, size_t index):
     """Returns a ShortSeq64 representing the specified base from the encoded sequence."""
 
@@ -5,9 +5,6 @@ from .short_seq cimport *
 cdef size_t MIN_64_NT
 cdef size_t MAX_64_NT
 
-# Reusable buffer for unmarshalling
-cdef char out_ascii_buffer_32[32]
-
 cdef class ShortSeq64:                 # 16 bytes (PyObject_HEAD)
     cdef uint64_t _packed              # 8 bytes
     cdef uint8_t _length               # 1 byte
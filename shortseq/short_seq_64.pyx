@@ -30,10 +30,24 @@ MAX_64_NT = 32
 """Used to export these constants to Python space"""
 def get_domain_64(): return MIN_64_NT, MAX_64_NT
 
+def _restore_64(uint64_t packed, uint8_t length):
+    """Reconstructs a ShortSeq64 from its packed block when unpickling."""
+
+    if length > MAX_64_NT:
+        raise Exception(f"Invalid ShortSeq64 length: {length}")
+    if length == 0:
+        return empty
+
+    cdef ShortSeq64 out = ShortSeq64.__new__(ShortSeq64)
+    out._packed = _bzhi_u64(packed, length * 2)
+    out._length = length
+    return out
+
+@cython.freelist(1024)
 cdef class ShortSeq64:
 
-    def __hash__(self) -> uint64_t:
-        return self._packed
+    def __hash__(self):
+        return _hash_blocks(&self._packed, 1, self._length)
 
     def __len__(self):
         return self._length
@@ -83,8 +97,21 @@ cdef class ShortSeq64:
         comp = ((comp >> 1) | comp) & 0x5555555555555555LL  # Some bases XOR to 0x3; collapse these inplace to 0x1
         return _popcnt64(comp)
 
+    def revcomp(self):
+        """Returns the reverse complement of the sequence."""
+
+        return _revcomp(&self._packed, self._length)
+
+    def canonical(self):
+        """Returns the sequence or its reverse complement, whichever comes first alphabetically."""
+
+        return _canonical(self)
+
     def __str__(self):
-        return _unmarshall_bytes_64(self._packed, self._length)
+        return _unmarshall_str(&self._packed, self._length)
+
+    def __reduce__(self):
+        return _restore_64, (self._packed, self._length)
 
     def __repr__(self):
         return f"<ShortSeq64 ({self._length} nt): {self}>"
@@ -108,19 +135,6 @@ cdef inline uint64_t _marshall_bytes_64(uint8_t* sequence, uint8_t length) nogil
     return hashed
 
 
-@cython.wraparound(False)
-@cython.cdivision(True)
-@cython.boundscheck(False)
-cdef inline unicode _unmarshall_bytes_64(uint64_t enc_seq, size_t length):
-    cdef uint8_t i
-
-    for i in range(length):
-        out_ascii_buffer_32[i] = charmap[enc_seq & 0b11]
-        enc_seq >>= 2
-
-    return PyUnicode_DecodeASCII(out_ascii_buffer_32, length, NULL)
-
-
 cdef inline ShortSeq64 _subscript_64(uint64_t enc_seq, size_t index):
     """Returns a new ShortSeq64 object representing a single base."""
 
@@ -0,0 +1,34 @@
+from cpython.mem cimport PyMem_Malloc, PyMem_Realloc, PyMem_Free
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_Check, PyBytes_FromStringAndSize
+from libc.stdlib cimport calloc, free
+from libc.stdint cimport uint16_t
+
+from .short_seq cimport pack, _new, _from_packed, _packed_blocks
+from .short_seq_var cimport MAX_VAR_NT
+from .fast_read cimport *
+from .util cimport *
+
+"""
+ShortSeqArray holds many sequences in a single contiguous buffer of packed blocks.
+Each sequence starts on a block boundary, and its position in the buffer is
+recorded in an index of block offsets and lengths.
+"""
+
+cdef class ShortSeqArray:
+    cdef uint64_t* _blocks
+    cdef size_t _n_blocks
+    cdef size_t _blocks_cap
+    cdef uint64_t* _offsets            # Block offset of each sequence
+    cdef uint16_t* _lengths            # Length of each sequence in nucleotides
+    cdef size_t _size
+    cdef size_t _index_cap
+    cdef Py_ssize_t _exports           # Number of active buffer exports
+    cdef Py_ssize_t _buf_shape
+    cdef Py_ssize_t _buf_stride
+
+    cdef int _append_blocks(self, uint64_t* blocks, size_t length) except -1
+    cdef int _append_chars(self, char* sequence, size_t length) except -1
+    cdef int _reserve(self, size_t n_seqs, size_t n_blocks) except -1
+    cdef uint64_t* _seq_at(self, size_t i, size_t* length) noexcept nogil
+    cdef _read_seqs(self, SeqReader reader)
+    cdef _append_pack_jobs(self, _PackJob* jobs, size_t n_jobs)
@@ -0,0 +1,343 @@
+# cython: language_level = 3, language=c++, profile=False, linetrace=False
+
+import numpy as np
+
+from .fast_read import open_reader
+
+from cpython.buffer cimport PyBUF_WRITABLE, PyBUF_FORMAT, PyBUF_ND, PyBUF_STRIDES
+from libc.string cimport memcpy
+
+
+def _restore_array(bytes blocks, bytes lengths):
+    """Reconstructs a ShortSeqArray from its packed blocks and lengths when unpickling."""
+
+    cdef ShortSeqArray out = ShortSeqArray.__new__(ShortSeqArray)
+    cdef size_t size = Py_SIZE(lengths) // sizeof(uint16_t)
+    cdef uint16_t* lens = <uint16_t *> PyBytes_AS_STRING(lengths)
+    cdef size_t n_blocks = 0, i
+
+    for i in range(size):
+        if lens[i] > MAX_VAR_NT:
+            raise Exception(f"Invalid ShortSeqArray state (sequence {i} has length {lens[i]})")
+        n_blocks += _nt_len_to_block_num(lens[i])
+
+    if n_blocks * sizeof(uint64_t) != <size_t> Py_SIZE(blocks):
+        raise Exception("Invalid ShortSeqArray state (lengths don't match the packed blocks)")
+
+    out._reserve(size, n_blocks)
+    memcpy(out._blocks, PyBytes_AS_STRING(blocks), Py_SIZE(blocks))
+    memcpy(out._lengths, lens, size * sizeof(uint16_t))
+
+    for i in range(size):
+        out._offsets[i] = out._n_blocks
+        out._n_blocks += _nt_len_to_block_num(lens[i])
+
+    out._size = size
+    return out
+
+
+cdef class ShortSeqArray:
+    """A compact, append-only sequence of ShortSeqs. All sequences are held in one
+    contiguous buffer of packed blocks, so memory usage is about 2 bits per base plus
+    10 bytes of index per sequence rather than one Python object per sequence.
+
+    Indexing returns a new ShortSeq constructed from the packed blocks, and slicing
+    returns a new ShortSeqArray. The packed blocks are exposed through the buffer
+    protocol as a read-only, one-dimensional array of uint64, and the index is
+    available through the offsets and lengths properties.
+    """
+
+    def __cinit__(self):
+        self._blocks_cap = 64
+        self._index_cap = 16
+        self._blocks = <uint64_t *> PyMem_Malloc(self._blocks_cap * sizeof(uint64_t))
+        self._offsets = <uint64_t *> PyMem_Malloc(self._index_cap * sizeof(uint64_t))
+        self._lengths = <uint16_t *> PyMem_Malloc(self._index_cap * sizeof(uint16_t))
+
+        if self._blocks is NULL or self._offsets is NULL or self._lengths is NULL:
+            raise MemoryError("Error while allocating a ShortSeqArray.")
+
+    def __init__(self, source=None):
+        if source is not None:
+            self.extend(source)
+
+    @classmethod
+    def from_fastq(cls, object filename, size_t threads=1, bint mmap=False):
+        """Reads the sequences of a plain, gzip, or BGZF compressed FASTQ file into a new
+        ShortSeqArray. With more than one thread, reads are packed in parallel. With mmap,
+        an uncompressed file is memory mapped and scanned in place."""
+
+        return cls.from_file(filename, "fastq", threads, mmap)
+
+    @classmethod
+    def from_file(cls, object filename, str format=None, size_t threads=1, bint mmap=False):
+        """Reads the sequences of a FASTQ, FASTA, SAM, or one-sequence-per-line text file
+        into a new ShortSeqArray. The format is detected from the file's content unless
+        specified. See from_fastq() for the remaining arguments."""
+
+        cdef ShortSeqArray out = cls()
+        cdef SeqReader reader = open_reader(filename, format, threads, mmap)
+
+        if threads > 1:
+            _pack_reads_parallel(reader, threads, out, _append_pack_jobs_to)
+        else:
+            out._read_seqs(reader)
+
+        return out
+
+    def append(self, seq):
+        """Appends a sequence, which may be a str, bytes, or ShortSeq."""
+
+        cdef uint64_t* blocks
+        cdef size_t length
+
+        if PyBytes_Check(seq):
+            self._append_chars(PyBytes_AS_STRING(seq), Py_SIZE(seq))
+            return
+
+        seq = pack(seq)
+        blocks = _packed_blocks(seq, &length)
+        self._append_blocks(blocks, length)
+
+    def extend(self, source):
+        """Appends each sequence in an iterable of str, bytes, or ShortSeqs."""
+
+        cdef ShortSeqArray other
+        cdef size_t i, n, length
+        cdef uint64_t* blocks
+
+        if isinstance(source, ShortSeqArray):
+            # Reserve up front so that blocks remain valid when extending with self
+            other = <ShortSeqArray> source
+            n = other._size
+            self._reserve(n, other._n_blocks)
+            for i in range(n):
+                blocks = other._seq_at(i, &length)
+                self._append_blocks(blocks, length)
+            return
+
+        for seq in source:
+            self.append(seq)
+
+    @property
+    def lengths(self):
+        """A NumPy array of the length of each sequence."""
+
+        out = np.empty(self._size, dtype=np.uint16)
+        cdef uint16_t[::1] view = out
+        if self._size:
+            memcpy(&view[0], self._lengths, self._size * sizeof(uint16_t))
+        return out
+
+    @property
+    def offsets(self):
+        """A NumPy array of the offset of each sequence's first block in the buffer."""
+
+        out = np.empty(self._size, dtype=np.uint64)
+        cdef uint64_t[::1] view = out
+        if self._size:
+            memcpy(&view[0], self._offsets, self._size * sizeof(uint64_t))
+        return out
+
+    @property
+    def nbytes(self):
+        """The number of bytes occupied by packed blocks."""
+
+        return self._n_blocks * sizeof(uint64_t)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, item):
+        cdef Py_ssize_t index, start, stop, step
+        cdef ShortSeqArray out
+        cdef uint64_t* blocks
+        cdef size_t length
+
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self._size)
+            out = ShortSeqArray.__new__(ShortSeqArray)
+            for index in range(start, stop, step):
+                blocks = self._seq_at(index, &length)
+                out._append_blocks(blocks, length)
+            return out
+
+        index = item
+        if index < 0:
+            index += self._size
+        if index < 0 or index >= <Py_ssize_t> self._size:
+            raise IndexError("ShortSeqArray index out of range")
+
+        blocks = self._seq_at(index, &length)
+        return _from_packed(blocks, length)
+
+    def __iter__(self):
+        cdef uint64_t* blocks
+        cdef size_t length
+        cdef size_t i = 0
+
+        while i < self._size:
+            blocks = self._seq_at(i, &length)
+            yield _from_packed(blocks, length)
+            i += 1
+
+    def __eq__(self, other):
+        if not isinstance(other, ShortSeqArray):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+    def __getbuffer__(self, Py_buffer* buffer, int flags):
+        if flags & PyBUF_WRITABLE:
+            raise BufferError("ShortSeqArray buffers are read-only.")
+
+        self._buf_shape = self._n_blocks
+        self._buf_stride = sizeof(uint64_t)
+
+        buffer.buf = self._blocks
+        buffer.obj = self
+        buffer.len = self._n_blocks * sizeof(uint64_t)
+        buffer.readonly = 1
+        buffer.itemsize = sizeof(uint64_t)
+        buffer.format = NULL
+        if flags & PyBUF_FORMAT:
+            buffer.format = b"Q"
+        buffer.ndim = 1
+        buffer.shape = &self._buf_shape if flags & PyBUF_ND else NULL
+        buffer.strides = &self._buf_stride if flags & PyBUF_STRIDES == PyBUF_STRIDES else NULL
+        buffer.suboffsets = NULL
+        buffer.internal = NULL
+        self._exports += 1
+
+    def __releasebuffer__(self, Py_buffer* buffer):
+        self._exports -= 1
+
+    def __repr__(self):
+        return f"<ShortSeqArray: {self._size} sequences>"
+
+    def __reduce__(self):
+        lengths = PyBytes_FromStringAndSize(<char *> self._lengths, self._size * sizeof(uint16_t))
+        return _restore_array, (bytes(self), lengths)
+
+    def __sizeof__(self):
+        return sizeof(ShortSeqArray) + \
+               self._blocks_cap * sizeof(uint64_t) + \
+               self._index_cap * (sizeof(uint64_t) + sizeof(uint16_t))
+
+    def __dealloc__(self):
+        PyMem_Free(self._blocks)
+        PyMem_Free(self._offsets)
+        PyMem_Free(self._lengths)
+
+    cdef int _reserve(self, size_t n_seqs, size_t n_blocks) except -1:
+        """Grows the buffer and index, if necessary, to fit the given number of additional
+        sequences and blocks. Growing is refused while the buffer is exported."""
+
+        cdef size_t blocks_cap = self._blocks_cap
+        cdef size_t index_cap = self._index_cap
+        cdef void* grown
+
+        while self._n_blocks + n_blocks > blocks_cap: blocks_cap *= 2
+        while self._size + n_seqs > index_cap: index_cap *= 2
+        if blocks_cap == self._blocks_cap and index_cap == self._index_cap:
+            return 0
+
+        if self._exports:
+            raise BufferError("Existing exports of data: ShortSeqArray cannot be re-sized")
+
+        if blocks_cap != self._blocks_cap:
+            grown = PyMem_Realloc(self._blocks, blocks_cap * sizeof(uint64_t))
+            if grown is NULL:
+                raise MemoryError("Error while growing ShortSeqArray blocks.")
+            self._blocks = <uint64_t *> grown
+            self._blocks_cap = blocks_cap
+
+        if index_cap != self._index_cap:
+            grown = PyMem_Realloc(self._offsets, index_cap * sizeof(uint64_t))
+            if grown is NULL:
+                raise MemoryError("Error while growing ShortSeqArray index.")
+            self._offsets = <uint64_t *> grown
+
+            grown = PyMem_Realloc(self._lengths, index_cap * sizeof(uint16_t))
+            if grown is NULL:
+                raise MemoryError("Error while growing ShortSeqArray index.")
+            self._lengths = <uint16_t *> grown
+            self._index_cap = index_cap
+
+        return 0
+
+    cdef int _append_blocks(self, uint64_t* blocks, size_t length) except -1:
+        cdef size_t n_blocks = _nt_len_to_block_num(length)
+
+        self._reserve(1, n_blocks)
+        memcpy(self._blocks + self._n_blocks, blocks, n_blocks * sizeof(uint64_t))
+        self._offsets[self._size] = self._n_blocks
+        self._lengths[self._size] = <uint16_t> length
+        self._n_blocks += n_blocks
+        self._size += 1
+        return 0
+
+    cdef int _append_chars(self, char* sequence, size_t length) except -1:
+        """Packs the sequence directly into the buffer without constructing a ShortSeq."""
+
+        if length > MAX_VAR_NT:
+            raise Exception(f"Sequences longer than {MAX_VAR_NT} bases are not supported.")
+
+        self._reserve(1, _nt_len_to_block_num(length))
+        if not _pack_bytes_array(self._blocks + self._n_blocks, <uint8_t *> sequence, length):
+            # Repeat with the regular constructor to raise the appropriate exception
+            _new(sequence, length)
+            raise Exception("Something went wrong while packing a sequence.")
+
+        self._offsets[self._size] = self._n_blocks
+        self._lengths[self._size] = <uint16_t> length
+        self._n_blocks += _nt_len_to_block_num(length)
+        self._size += 1
+        return 0
+
+    cdef inline uint64_t* _seq_at(self, size_t i, size_t* length) noexcept nogil:
+        length[0] = self._lengths[i]
+        return self._blocks + self._offsets[i]
+
+    cdef _read_seqs(self, SeqReader reader):
+        cdef char* seqchars
+        cdef size_t length
+
+        while reader.next_seq(&seqchars, &length):
+            self._append_chars(seqchars, length)
+
+    cdef _append_pack_jobs(self, _PackJob* jobs, size_t n_jobs):
+        cdef:
+            _PackJob* job
+            uint64_t* words
+            size_t length, n_blocks, i, j
+
+        for j in range(n_jobs):
+            job = &jobs[j]
+            if job.no_memory:
+                raise MemoryError("Error while allocating packed blocks.")
+
+            if job.n_bad < job.n_reads:
+                # Repeat with the regular constructor to raise the appropriate exception
+                i = job.n_bad
+                _new(job.text + job.starts[i], job.starts[i + 1] - job.starts[i])
+                raise Exception("Something went wrong while packing a sequence.")
+
+            n_blocks = 0
+            for i in range(job.n_reads):
+                n_blocks += _nt_len_to_block_num(job.starts[i + 1] - job.starts[i])
+
+            self._reserve(job.n_reads, n_blocks)
+            memcpy(self._blocks + self._n_blocks, job.words, n_blocks * sizeof(uint64_t))
+
+            for i in range(job.n_reads):
+                length = job.starts[i + 1] - job.starts[i]
+                self._offsets[self._size] = self._n_blocks
+                self._lengths[self._size] = <uint16_t> length
+                self._n_blocks += _nt_len_to_block_num(length)
+                self._size += 1
+
+
+cdef _append_pack_jobs_to(object arr, _PackJob* jobs, size_t n_jobs):
+    return (<ShortSeqArray> arr)._append_pack_jobs(jobs, n_jobs)
@@ -2,18 +2,22 @@ from .util cimport *
 from .short_seq cimport *
 
 from libc.string cimport memcmp
+from cpython.mem cimport PyObject_Malloc
 
 # Constants
 cdef size_t MAX_VAR_NT
 cdef size_t MIN_VAR_NT
 cdef size_t MAX_REPR_LEN
 
-# Reusable buffer for unmarshalling
-cdef char out_ascii_buffer_var[1024]
-
 cdef class ShortSeqVar:                # 16 bytes (PyObject_HEAD)
     cdef uint64_t* _packed             # 8 bytes (pointer)
     cdef size_t _length                # 8 bytes
                                        # Total: 32 bytes + heap allocation
 
 cdef uint64_t* _marshall_bytes_var(uint8_t* seq_bytes, size_t length)
+cdef uint64_t* _alloc_var_blocks(size_t n_blocks) noexcept
+cdef void _free_var_blocks(uint64_t* blocks, size_t n_blocks) noexcept
+
+cdef enum:
+    VAR_POOL_CLASSES = 33              # Block counts 0 through 32 (MAX_VAR_NT bases)
+    VAR_POOL_DEPTH = 256               # Arrays kept per block count
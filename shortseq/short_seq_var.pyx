@@ -1,8 +1,7 @@
 # cython: language_level = 3, language=c++, profile=False, linetrace=False
 
 cimport cython
-
-from cython.operator cimport dereference as deref
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_FromStringAndSize
 
 # Importable constants
 MIN_VAR_NT = 97
@@ -12,9 +11,18 @@ MAX_REPR_LEN = 75
 """Used to export these constants to Python space"""
 def get_domain_var(): return MIN_VAR_NT, MAX_VAR_NT
 
+def _restore_var(bytes blocks, size_t length):
+    """Reconstructs a ShortSeqVar from its packed blocks when unpickling."""
+
+    if not MIN_VAR_NT <= length <= MAX_VAR_NT or Py_SIZE(blocks) != _nt_len_to_block_num(length) * sizeof(uint64_t):
+        raise Exception(f"Invalid ShortSeqVar state (length {length}, {Py_SIZE(blocks)} bytes)")
+
+    return _from_packed(<uint64_t *> PyBytes_AS_STRING(blocks), length)
+
+@cython.freelist(256)
 cdef class ShortSeqVar:
     def __hash__(self):
-        return deref(self._packed)
+        return _hash_blocks(self._packed, _nt_len_to_block_num(self._length), self._length)
 
     def __len__(self):
         return self._length
@@ -58,8 +66,22 @@ cdef class ShortSeqVar:
         else:
             raise TypeError(f"Invalid index type: {type(item)}")
 
+    def revcomp(self):
+        """Returns the reverse complement of the sequence."""
+
+        return _revcomp(self._packed, self._length)
+
+    def canonical(self):
+        """Returns the sequence or its reverse complement, whichever comes first alphabetically."""
+
+        return _canonical(self)
+
     def __str__(self):
-        return _unmarshall_bytes_var(self._packed, self._length)
+        return _unmarshall_str(self._packed, self._length)
+
+    def __reduce__(self):
+        cdef size_t n_bytes = _nt_len_to_block_num(self._length) * sizeof(uint64_t)
+        return _restore_var, (PyBytes_FromStringAndSize(<char *> self._packed, n_bytes), self._length)
 
     def __xor__(self, ShortSeqVar other):
         if self._length != other._length:
@@ -85,51 +107,67 @@ cdef class ShortSeqVar:
 
     def __repr__(self):
         # Truncates the sequence to MAX_REPR_LEN characters to avoid overwhelming the debugger
-        cdef unicode trunc_seq = _unmarshall_bytes_var(self._packed, MAX_REPR_LEN)
+        cdef unicode trunc_seq = _unmarshall_str(self._packed, MAX_REPR_LEN)
         return f"<ShortSeqVar ({self._length} nt): {trunc_seq} ... >"
 
     def __dealloc__(self):
         if self._packed is not NULL:
-            PyObject_Free(<void *>self._packed)
+            _free_var_blocks(self._packed, _nt_len_to_block_num(self._length))
 
 
-@cython.wraparound(False)
-@cython.boundscheck(False)
-cdef inline unicode _unmarshall_bytes_var(uint64_t* enc_seq, size_t length, size_t start_block=0, size_t offset=0):
+cdef uint64_t* _marshall_bytes_var(uint8_t* seq_bytes, size_t length):
     cdef:
-        uint64_t block
-        size_t blocks_spanned = _nt_len_to_block_num(length) + 1
-        size_t hi = min(length, (64 - offset) // 2)
-        size_t rem = length
-        size_t lo = 0
-        size_t i, j
+        size_t n_blocks = _nt_len_to_block_num(length)
+        uint64_t* hash_arr = _alloc_var_blocks(n_blocks)
+
+    if hash_arr is NULL:
+        raise MemoryError(f"Error while allocating new ShortSeq of length {length}.")
 
-    for i in range(start_block, start_block + blocks_spanned):
-        block = enc_seq[i]
-        if i == start_block and offset:
-            block >>= offset
+    try:
+        _marshall_bytes_array(hash_arr, seq_bytes, length)
+    except Exception:
+        _free_var_blocks(hash_arr, n_blocks)
+        raise
 
-        for j in range(lo, hi):
-            out_ascii_buffer_var[j] = charmap[block & 0b11]
-            block >>= 2
+    return hash_arr
 
-        rem -= hi - lo
-        lo = hi
-        hi += min(rem, NT_PER_BLOCK)
 
-    return PyUnicode_DecodeASCII(out_ascii_buffer_var, length, NULL)
+"""
+Block pool. Freed block arrays are kept in a small stack per block count and handed to
+the next sequence of the same size, so that churning through ShortSeqVars (e.g. when
+counting repeated reads) rarely reaches the allocator. Every block is written when a
+sequence is packed or sliced, so reused arrays aren't cleared. The pool is only used
+while holding the GIL.
+"""
 
+cdef uint64_t* _var_pool[VAR_POOL_CLASSES][VAR_POOL_DEPTH]
+cdef size_t _var_pool_size[VAR_POOL_CLASSES]
 
-cdef uint64_t* _marshall_bytes_var(uint8_t* seq_bytes, size_t length):
-    cdef:
-        size_t n_blocks = _nt_len_to_block_num(length)
-        uint64_t* hash_arr = <llstr>PyObject_Calloc(n_blocks, sizeof(uint64_t))
 
-    if hash_arr is NULL:
-        raise MemoryError(f"Error while allocating new ShortSeq of length {length}.")
+cdef uint64_t* _alloc_var_blocks(size_t n_blocks) noexcept:
+    """Returns an uninitialized array of n_blocks (up to 32) blocks, or NULL if out of memory."""
 
-    _marshall_bytes_array(hash_arr, seq_bytes, length)
-    return hash_arr
+    if _var_pool_size[n_blocks]:
+        _var_pool_size[n_blocks] -= 1
+        return _var_pool[n_blocks][_var_pool_size[n_blocks]]
+
+    return <uint64_t *> PyObject_Malloc(n_blocks * sizeof(uint64_t))
+
+
+cdef void _free_var_blocks(uint64_t* blocks, size_t n_blocks) noexcept:
+    """Returns an array from _alloc_var_blocks() to the pool, or to the allocator if the pool is full."""
+
+    if _var_pool_size[n_blocks] < VAR_POOL_DEPTH:
+        _var_pool[n_blocks][_var_pool_size[n_blocks]] = blocks
+        _var_pool_size[n_blocks] += 1
+    else:
+        PyObject_Free(blocks)
+
+
+def var_pool_info():
+    """Returns the number of pooled block arrays by block count."""
+
+    return {n: _var_pool_size[n] for n in range(VAR_POOL_CLASSES) if _var_pool_size[n]}
 
 
 cdef inline ShortSeq64 _subscript_var(uint64_t* enc_seq, size_t index):
@@ -1,6 +1,8 @@
 import os
 import gzip
 import inspect
+import tempfile
+import tracemalloc
 import unittest
 import numpy as np
 import matplotlib as mpl
@@ -9,19 +11,22 @@ import matplotlib.pyplot as plt
 
 # umi_tools changes backend upon import
 from umi_tools._dedup_umi import edit_distance
+from umi_tools.network import UMIClusterer
 mpl.use(default_backend)
 
 from scipy.spatial.distance import hamming
 from typing import Dict, List, Iterable
 from pympler.asizeof import asizeof
-from collections import defaultdict
+from collections import defaultdict, Counter
 from datetime import datetime
 from random import randint
-from timeit import timeit
+from timeit import timeit, repeat
+from sys import getsizeof as sizeof
 from glob import glob
 
 import shortseq as sq
-from util import rand_sequence, sorted_natural
+from shortseq.umi import cluster_directional
+from util import rand_sequence, sorted_natural, levenshtein, write_fastq
 
 import warnings
 warnings.filterwarnings("error")
@@ -60,9 +65,11 @@ class MemoryBenchmarks(unittest.TestCase):
         mem_un = {}
         mem_by = {}
         mem_gz = {}
+        mem_ar = {}
 
         for length, seqs in self.data.items():
             mem_sq[length] = asizeof(sq.pack(seqs[0]))
+            mem_ar[length] = (sizeof(sq.ShortSeqArray(seqs * 1000)) - sizeof(sq.ShortSeqArray())) / (len(seqs) * 1000)
             mem_np[length] = asizeof(np.char.asarray(seqs[0], itemsize=1))
             mem_un[length] = asizeof(str(seqs[0]))
             mem_by[length] = asizeof(seqs[0])
@@ -70,6 +77,7 @@ class MemoryBenchmarks(unittest.TestCase):
 
         results = {
             'ShortSeq':   mem_sq.values(),
+            'ShortSeqArray (per seq)': mem_ar.values(),
             'NumPy':      mem_np.values(),
             'PyUnicode':  mem_un.values(),
             'PyBytes':    mem_by.values(),
@@ -78,6 +86,48 @@ class MemoryBenchmarks(unittest.TestCase):
 
         save_and_plot(results, title, lab_x, lab_y)
 
+    def test_counter_mem_per_entry(self):
+        """Memory usage per unique sequence of each counter type, measured with tracemalloc
+        while the counter is built. ShortSeqCounter holds a ShortSeq object and a dict entry
+        for each sequence, whereas PackedCounter holds packed blocks in native slots."""
+
+        n_unique = 100000
+        title = "Counter Memory per Unique Sequence"
+        lab_x = "Sequence Length"
+        lab_y = "Bytes per Entry"
+
+        mem_sc, mem_pc = {}, {}
+
+        for length in [16, 32, 64, 128, 256, 512]:
+            reads = [rand_sequence(length, as_bytes=True) for _ in range(n_unique)]
+            mem_sc[length] = traced_bytes(lambda: sq.ShortSeqCounter(reads)) / n_unique
+            mem_pc[length] = traced_bytes(lambda: sq.PackedCounter(reads)) / n_unique
+
+        results = {
+            'ShortSeqCounter':  mem_sc.values(),
+            'PackedCounter':    mem_pc.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y)
+
+
+    def test_construction_mem_per_seq(self):
+        """Memory held per ShortSeq when many are constructed and kept, measured with tracemalloc.
+        This includes allocator overhead for each object and, for ShortSeqVar, its blocks."""
+
+        n_seqs = 20000
+        title = "Memory per Constructed ShortSeq"
+        lab_x = "Sequence Length"
+        lab_y = "Bytes per Sequence"
+
+        mem_sq = {}
+
+        for length in (16, 32, 64, 128, 192, 256, 512, 1024):
+            seqs = [rand_sequence(length, as_bytes=True) for _ in range(n_seqs)]
+            mem_sq[length] = (traced_bytes(lambda: [sq.pack(seq) for seq in seqs]) - sizeof([None] * n_seqs)) / n_seqs
+
+        save_and_plot({'ShortSeq': mem_sq.values()}, title, lab_x, lab_y)
+
 
 class TimeBenchmarks(unittest.TestCase):
 
@@ -164,6 +214,394 @@ class TimeBenchmarks(unittest.TestCase):
 
         save_and_plot(results, title, lab_x, lab_y, log_scale=True)
 
+    def test_levenshtein_distance(self):
+        """Compares sq.edit_distance(), with and without a band, against the textbook
+        dynamic programming algorithm for pairs of sequences that differ by a few indels."""
+
+        samples = 10
+        title = "Levenshtein Distance Calculation"
+        lab_x = "Sequence Length"
+        lab_y = "Average Time (seconds)"
+
+        times_sq, times_band, times_py = {}, {}, {}
+
+        for length in [16, 32, 64, 128, 256, 512, 1024]:
+            a = rand_sequence(length)
+            b = a[:length // 2] + a[length // 2 + 1:] + "A"
+            sq_a, sq_b = sq.pack(a), sq.pack(b)
+
+            times_sq[length] = timeit(lambda: sq.edit_distance(sq_a, sq_b), number=samples) / samples
+            times_band[length] = timeit(lambda: sq.edit_distance(sq_a, sq_b, 4), number=samples) / samples
+            times_py[length] = timeit(lambda: levenshtein(a, b), number=1)
+
+        results = {
+            'edit_distance()':              times_sq.values(),
+            'edit_distance(max_dist=4)':    times_band.values(),
+            'PyUnicode (DP)':               times_py.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y, log_scale=True)
+
+    def test_hamming_one_vs_many(self):
+        """Compares sq.hamming_many() with the per-pair __xor__ path for one query against many
+        sequences of the same length, as when searching a barcode whitelist."""
+
+        n_seqs, samples = 10000, 5
+        title = "One-vs-Many Hamming Distance"
+        lab_x = "Sequence Length"
+        lab_y = "Average Time (seconds)"
+
+        times_pair, times_many, times_thread = {}, {}, {}
+
+        for length in [8, 16, 32, 64, 128, 256, 512, 1024]:
+            sq_seqs = [sq.pack(rand_sequence(length)) for _ in range(n_seqs)]
+            arr = sq.ShortSeqArray(sq_seqs)
+            query = sq_seqs[0]
+
+            times_pair[length] = timeit(lambda: [query ^ seq for seq in sq_seqs], number=samples) / samples
+            times_many[length] = timeit(lambda: sq.hamming_many(query, arr), number=samples) / samples
+            times_thread[length] = timeit(lambda: sq.hamming_many(query, arr, threads=4), number=samples) / samples
+
+        results = {
+            'Per-pair __xor__':             times_pair.values(),
+            'hamming_many()':               times_many.values(),
+            'hamming_many(threads=4)':      times_thread.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y, log_scale=True)
+
+    def test_hamming_all_vs_all(self):
+        """Compares sq.hamming_matrix() with the per-pair __xor__ path for all pairs of 12 nt UMIs."""
+
+        samples = 3
+        title = "All-vs-All Hamming Distance (12 nt)"
+        lab_x = "Number of Sequences"
+        lab_y = "Average Time (seconds)"
+
+        times_pair, times_matrix = {}, {}
+
+        for n_seqs in [100, 200, 400, 800, 1600]:
+            sq_seqs = [sq.pack(rand_sequence(12)) for _ in range(n_seqs)]
+            arr = sq.ShortSeqArray(sq_seqs)
+
+            times_pair[n_seqs] = timeit(lambda: [[a ^ b for b in sq_seqs] for a in sq_seqs], number=samples) / samples
+            times_matrix[n_seqs] = timeit(lambda: sq.hamming_matrix(arr), number=samples) / samples
+
+        results = {
+            'Per-pair __xor__':     times_pair.values(),
+            'hamming_matrix()':     times_matrix.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y, log_scale=True)
+
+    def test_hamming_index_lookup(self):
+        """Compares HammingIndex.neighbors() with a linear scan of the whitelist for 16 nt barcodes."""
+
+        n_queries, max_dist = 100, 2
+        title = "Whitelist Lookup within Hamming Distance 2 (16 nt)"
+        lab_x = "Whitelist Size"
+        lab_y = "Average Time per Query (seconds)"
+
+        times_scan, times_within, times_index = {}, {}, {}
+
+        for n_seqs in [1000, 10000, 100000, 1000000]:
+            whitelist = [sq.pack(rand_sequence(16)) for _ in range(n_seqs)]
+            queries = [whitelist[randint(0, n_seqs - 1)] for _ in range(n_queries)]
+            arr = sq.ShortSeqArray(whitelist)
+            index = sq.HammingIndex(whitelist, max_dist)
+
+            times_scan[n_seqs] = timeit(lambda: [[w for w in whitelist if q ^ w <= max_dist] for q in queries], number=1) / n_queries
+            times_within[n_seqs] = timeit(lambda: [sq.within(q, arr, max_dist) for q in queries], number=1) / n_queries
+            times_index[n_seqs] = timeit(lambda: [index.neighbors(q) for q in queries], number=1) / n_queries
+
+        results = {
+            'Linear scan (__xor__)':    times_scan.values(),
+            'within()':                 times_within.values(),
+            'HammingIndex.neighbors()': times_index.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y, log_scale=True)
+
+    def test_fastq_read_modes(self):
+        """Compares streaming an uncompressed FASTQ file through the read buffer with memory
+        mapping it and scanning records in place. Reads are counted natively so that reading
+        dominates the measurement."""
+
+        samples = 3
+        title = "Uncompressed FASTQ Read Throughput (100 nt reads)"
+        lab_x = "Number of Reads"
+        lab_y = "Reads per Second"
+
+        rate_stream, rate_mmap = {}, {}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for n_reads in [10 ** 4, 10 ** 5, 10 ** 6]:
+                fastq = write_fastq(os.path.join(tmpdir, f"{n_reads}.fq"), [rand_sequence(100)] * n_reads)
+                stream = timeit(lambda: sq.read_and_count_fastq(fastq, native=True), number=samples) / samples
+                mapped = timeit(lambda: sq.read_and_count_fastq(fastq, native=True, mmap=True), number=samples) / samples
+
+                rate_stream[n_reads] = n_reads / stream
+                rate_mmap[n_reads] = n_reads / mapped
+
+        results = {
+            'Streamed':         rate_stream.values(),
+            'Memory mapped':    rate_mmap.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y)
+
+    def test_counting_prefix_sharing(self):
+        """Measures counting throughput for reads that share their first 32 bases, as is typical of
+        amplicon and adapter-heavy libraries. Before hashing took every block into account, these
+        reads all collided into a single hash bucket and counting time grew quadratically."""
+
+        n_unique, n_repeats, samples = 5000, 4, 3
+        title = "Counting Throughput for Reads Sharing a 32 nt Prefix"
+        lab_x = "Sequence Length"
+        lab_y = "Reads per Second"
+
+        prefix = rand_sequence(sq.MAX_64_NT, as_bytes=True)
+        lengths = range(sq.MIN_192_NT, sq.MAX_VAR_NT + 1, 32)
+        rate_sq, rate_pc, rate_py = {}, {}, {}
+
+        for length in lengths:
+            uniques = [prefix + rand_sequence(length - len(prefix), as_bytes=True) for _ in range(n_unique)]
+            reads = uniques * n_repeats
+
+            rate_sq[length] = len(reads) / (timeit(lambda: sq.ShortSeqCounter(reads), number=samples) / samples)
+            rate_pc[length] = len(reads) / (timeit(lambda: sq.PackedCounter(reads), number=samples) / samples)
+            rate_py[length] = len(reads) / (timeit(lambda: Counter(reads), number=samples) / samples)
+
+        results = {
+            'ShortSeqCounter':          rate_sq.values(),
+            'PackedCounter':            rate_pc.values(),
+            'Counter (PyBytes)':        rate_py.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y)
+
+    def test_directional_clustering(self):
+        """Compares cluster_directional() with UMI-tools' directional UMIClusterer on 10 nt UMIs
+        at a single position. Each true UMI is accompanied by a few single-base errors."""
+
+        samples = 3
+        title = "Directional UMI Clustering"
+        lab_x = "Unique UMIs"
+        lab_y = "Average Time (seconds)"
+
+        sizes = [100, 1000, 5000, 20000]
+        times_sq, times_um = {}, {}
+        clusterer = UMIClusterer(cluster_method="directional")
+
+        for size in sizes:
+            counts = {}
+            while len(counts) < size:
+                umi = rand_sequence(10)
+                counts[umi] = randint(10, 100)
+                for _ in range(randint(0, 3)):
+                    i = randint(0, 9)
+                    error = umi[:i] + "ACGT"[randint(0, 3)] + umi[i + 1:]
+                    counts.setdefault(error, randint(1, 3))
+
+            um_counts = {umi.encode(): n for umi, n in counts.items()}
+            times_sq[size] = timeit(lambda: cluster_directional(counts), number=samples) / samples
+            times_um[size] = timeit(lambda: clusterer(um_counts, threshold=1), number=samples) / samples
+
+        results = {
+            'ShortSeq':  times_sq.values(),
+            'UMI-tools': times_um.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y, log_scale=True)
+
+    def test_counts_export(self):
+        """Measures the rate at which counts are written to a TSV file, natively and
+        by formatting each str(seq) with a Python loop."""
+
+        samples = 3
+        title = "Counts Table Export Throughput"
+        lab_x = "Sequence Length"
+        lab_y = "Entries per Second"
+
+        lengths = [22, 50, 100, 150, 300]
+        rate_native, rate_py = {}, {}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir, "counts.tsv")
+            for length in lengths:
+                counts = sq.ShortSeqCounter([rand_sequence(length, as_bytes=True) for _ in range(200000)])
+
+                def py_export():
+                    with open(outfile, 'w') as f:
+                        for seq, n in counts.items():
+                            f.write(f"{seq}\t{n}\n")
+
+                rate_native[length] = len(counts) / (timeit(lambda: counts.to_tsv(outfile), number=samples) / samples)
+                rate_py[length] = len(counts) / (timeit(py_export, number=samples) / samples)
+
+        results = {
+            'ShortSeqCounter.to_tsv()': rate_native.values(),
+            'Python loop':              rate_py.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y)
+
+    def test_counter_merge(self):
+        """Measures the rate at which per-lane counters are merged with ShortSeqCounter.merge(),
+        which passes each key's precomputed hash to the dict, and with a Python loop."""
+
+        samples = 3
+        title = "Counter Merge Throughput"
+        lab_x = "Sequence Length"
+        lab_y = "Entries per Second"
+
+        lengths = [22, 50, 100, 150, 300]
+        rate_merge, rate_py = {}, {}
+
+        for length in lengths:
+            pool = [rand_sequence(length, as_bytes=True) for _ in range(200000)]
+            lanes = [sq.ShortSeqCounter(pool[i * 50000:i * 50000 + 100000]) for i in range(3)]
+            n_entries = sum(len(lane) for lane in lanes)
+
+            def py_merge():
+                out = sq.ShortSeqCounter()
+                for lane in lanes:
+                    for seq, n in lane.items():
+                        out[seq] = out.get(seq, 0) + n
+
+            rate_merge[length] = n_entries / (timeit(lambda: sq.ShortSeqCounter().merge(*lanes), number=samples) / samples)
+            rate_py[length] = n_entries / (timeit(py_merge, number=samples) / samples)
+
+        results = {
+            'ShortSeqCounter.merge()': rate_merge.values(),
+            'Python loop':             rate_py.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y)
+
+    def test_kmer_counting(self):
+        """Measures k-mer counting throughput from packed reads, compared to counting
+        each k-mer as a ShortSeq slice or as a str slice with a Counter."""
+
+        n_reads, read_len, samples = 2000, 150, 3
+        title = "K-mer Counting Throughput by k (150 nt reads)"
+        lab_x = "k"
+        lab_y = "K-mers per Second"
+
+        reads = [rand_sequence(read_len) for _ in range(n_reads)]
+        packed = [sq.pack(r) for r in reads]
+        rate_kc, rate_slice, rate_py = {}, {}, {}
+
+        for k in (11, 15, 21, 27, 31):
+            n_kmers = n_reads * (read_len - k + 1)
+            slice_kmers = lambda: Counter(s[i:i+k] for s in packed for i in range(read_len - k + 1))
+
+            rate_kc[k] = n_kmers / (timeit(lambda: sq.KmerCounter(k, packed), number=samples) / samples)
+            rate_slice[k] = n_kmers / (timeit(slice_kmers, number=samples) / samples)
+            rate_py[k] = n_kmers / (timeit(lambda: Counter(r[i:i+k] for r in reads for i in range(read_len - k + 1)),
+                                           number=samples) / samples)
+
+        results = {
+            'KmerCounter':              rate_kc.values(),
+            'Counter (ShortSeq slices)': rate_slice.values(),
+            'Counter (PyUnicode)':      rate_py.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y)
+
+    def test_construction_churn(self):
+        """Measures construction throughput when each ShortSeq is discarded right away, as when
+        counting repeated reads, versus when every ShortSeq is kept. Discarded objects are
+        recycled by the type freelists, and ShortSeqVar blocks by the block pool."""
+
+        n_seqs, samples = 20000, 5
+        title = "Construction Throughput (Discarded vs. Kept)"
+        lab_x = "Sequence Length"
+        lab_y = "Sequences per Second"
+
+        rate_churn, rate_kept = {}, {}
+
+        for length in (16, 32, 64, 128, 192, 256, 512, 1024):
+            seqs = [rand_sequence(length, as_bytes=True) for _ in range(n_seqs)]
+
+            def churn():
+                for seq in seqs: sq.pack(seq)
+
+            rate_churn[length] = n_seqs / (min(repeat(churn, number=1, repeat=samples)))
+            rate_kept[length] = n_seqs / (min(repeat(lambda: [sq.pack(seq) for seq in seqs], number=1, repeat=samples)))
+
+        results = {
+            'Discarded': rate_churn.values(),
+            'Kept':      rate_kept.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y)
+
+    def test_interned_construction(self):
+        """Measures construction time and the memory held by the constructed ShortSeqs for a
+        small-RNA-like library, in which a few thousand sequences make up most reads, with and
+        without an intern pool. The pool's hit rate is plotted alongside."""
+
+        n_reads, n_unique = 200000, 5000
+        title = "Construction With an Intern Pool (Zipf-Distributed Reads)"
+        lab_x = "Pool Capacity"
+        lab_y = "Relative to No Pool"
+
+        unique = [rand_sequence(randint(18, 30), as_bytes=True) for _ in range(n_unique)]
+        weights = 1 / np.arange(1, n_unique + 1)
+        reads = [unique[i] for i in np.random.choice(n_unique, n_reads, p=weights / weights.sum())]
+        construct = lambda: [sq.pack(r) for r in reads]
+
+        base_time = min(repeat(construct, number=1, repeat=3))
+        base_mem = traced_bytes(construct)
+        rel_time, rel_mem, hit_rate = {}, {}, {}
+
+        for capacity in (1024, 4096, 16384):
+            pool = sq.InternPool(capacity)
+            sq.set_intern_pool(pool)
+            try:
+                rel_time[capacity] = min(repeat(construct, number=1, repeat=3)) / base_time
+                rel_mem[capacity] = traced_bytes(construct) / base_mem
+            finally:
+                sq.set_intern_pool(None)
+            hit_rate[capacity] = pool.stats()["hit_rate"]
+
+        results = {
+            'Time':     rel_time.values(),
+            'Memory':   rel_mem.values(),
+            'Hit Rate': hit_rate.values(),
+        }
+
+        save_and_plot(results, title, lab_x, lab_y)
+
+    def test_kernel_variants(self):
+        """Measures construction and decoding throughput with each kernel variant supported by this CPU."""
+
+        n_seqs, samples = 20000, 5
+        title = "Pack and Decode Throughput by Kernel Variant"
+        lab_x = "Sequence Length"
+        lab_y = "Sequences per Second"
+
+        lengths = (32, 64, 128, 256, 512, 1024)
+        seqs = {length: [rand_sequence(length, as_bytes=True) for _ in range(n_seqs)] for length in lengths}
+        results = {}
+        active = sq.get_kernels()
+
+        try:
+            for name in sq.available_kernels():
+                sq.set_kernels(name)
+                rate_pack, rate_decode = {}, {}
+                for length in lengths:
+                    packed = sq.ShortSeqArray(seqs[length])
+                    rate_pack[length] = n_seqs / min(repeat(lambda: [sq.pack(seq) for seq in seqs[length]], number=1, repeat=samples))
+                    rate_decode[length] = n_seqs / min(repeat(lambda: sq.to_strings(packed), number=1, repeat=samples))
+                results[f"Pack ({name})"] = rate_pack.values()
+                results[f"Decode ({name})"] = rate_decode.values()
+        finally:
+            sq.set_kernels(active)
+
+        save_and_plot(results, title, lab_x, lab_y)
+
 
 class ReplotTests(unittest.TestCase):
     ...
@@ -192,6 +630,18 @@ class ReplotTests(unittest.TestCase):
 # === HELPER FUNCTIONS ========================================================
 
 
+def traced_bytes(constructor) -> int:
+    """Returns the number of bytes held by the object that constructor() returns."""
+
+    tracemalloc.start()
+    obj = constructor()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    del obj
+    return size
+
+
 def make_data(min_len=0, max_len=1024, n_samples=10) -> DataSet:
     """Generate a dictionary of random sequences of varying lengths, with n_samples per length."""
 
@@ -1,12 +1,19 @@
 import unittest
+import tempfile
 import sys
+import os
+import pickle
+import gzip
+
+import numpy as np
 
 from random import randint
 
 import shortseq as sq
-from shortseq import ShortSeq64, ShortSeq192, ShortSeqVar
+from shortseq import ShortSeq64, ShortSeq192, ShortSeqVar, ShortSeqCounter, PackedCounter, ShortSeqArray, read_and_count_fastq
 from shortseq import MIN_VAR_NT, MAX_VAR_NT, MIN_64_NT, MAX_64_NT, MIN_192_NT, MAX_192_NT
-from shortseq.tests.util import rand_sequence, print_var_seq_pext_chunks
+from shortseq.fast_read import SeqReader
+from shortseq.tests.util import rand_sequence, print_var_seq_pext_chunks, write_fastq, levenshtein
 
 
 if __name__ == '__main__':
@@ -29,6 +36,62 @@ class ShortSeqFixedWidthTests(unittest.TestCase):
         self.assertEqual(seq_b, "")             # __eq__ with bytes argument
         self.assertEqual(seq_u, "")             # __eq__ with str argument
 
+    """Are sequences of up to 4 bases singletons, whether packed, sliced, or subscripted?"""
+
+    def test_short_singletons(self):
+        long_seq = sq.pack("TTTTT" + "ACGT" * 30)
+
+        for length in range(1, 5):
+            sample = rand_sequence(length)
+            seq = sq.pack(sample)
+            self.assertIs(seq, sq.pack(sample.encode()))
+            self.assertEqual(str(seq), sample)
+            for i in (0, 30, 61):                   # Within and across block boundaries
+                self.assertIs(long_seq[i:i+length], sq.pack(str(long_seq)[i:i+length]))
+
+        self.assertIs(long_seq[5], sq.pack("A"))
+        self.assertIsNot(sq.pack("ACGTA"), sq.pack("ACGTA"))
+
+    """Does the intern pool share repeated sequences, evict within its capacity, and report hits?"""
+
+    def test_intern_pool(self):
+        samples = [rand_sequence(length) for length in (5, 32, 64, 150, MAX_VAR_NT)]
+        pool = sq.InternPool(capacity=16)
+        self.assertIsNone(sq.set_intern_pool(pool))
+
+        # Which entries stay resident depends on their hashes, so identity is only
+        # asserted for sequences that the pool reports as resident
+        try:
+            for sample in samples:
+                seq = sq.pack(sample)
+                self.assertIn(sample, pool)
+                self.assertIn(seq, pool)
+                self.assertIs(sq.pack(sample.encode()), seq)
+            self.assertGreaterEqual(pool.n_hits, len(samples))
+
+            longer = sq.pack("A" + samples[3])
+            sliced = longer[1:]
+            self.assertIn(samples[3], pool)
+            self.assertIs(sq.pack(samples[3]), sliced)
+
+            inserted = samples + ["A" + samples[3]]
+            self.assertEqual(len(pool), sum(s in pool for s in inserted))
+            for sample in inserted:
+                if sample in pool:
+                    self.assertIs(sq.pack(sample), sq.pack(sample))
+            self.assertNotIn(rand_sequence(40), pool)
+
+            for _ in range(200):
+                sq.pack(rand_sequence(40))
+            self.assertLessEqual(len(pool), pool.capacity)
+            self.assertGreater(pool.n_evictions, 0)
+            self.assertEqual(str(sq.pack(samples[4])), samples[4])
+        finally:
+            self.assertIs(sq.set_intern_pool(None), pool)
+
+        self.assertIsNone(sq.get_intern_pool())
+        self.assertIsNot(sq.pack(samples[1]), sq.pack(samples[1]))
+
     """Can ShortSeqs encode and decode all valid bases from str object inputs?"""
 
     def test_single_base_str(self):
@@ -165,6 +228,61 @@ class ShortSeqFixedWidthTests(unittest.TestCase):
 
             self.assertEqual(sq.pack(a) ^ sq.pack(b), str_ham(a, b))
 
+    """Do hashes depend on every block and on length, and agree with ShortSeqCounter?"""
+
+    def test_hash(self):
+        prefix = rand_sequence(MAX_64_NT)
+        shared = [prefix + rand_sequence(length) for length in (1, 32, 64, 100, 500) for _ in range(20)]
+        poly_a = ["A" * length for length in range(1, MAX_VAR_NT)]
+
+        for samples in (shared, poly_a):
+            seqs = [sq.pack(s) for s in samples]
+            self.assertEqual(len({hash(s) for s in seqs}), len(set(samples)))
+            self.assertTrue(all(hash(s) == hash(sq.pack(t)) for s, t in zip(seqs, samples)))
+
+        # The packed value of this sequence is all ones, i.e. -1 as a signed hash
+        all_g = "G" * MAX_64_NT
+        counts = ShortSeqCounter([all_g.encode()] * 3 + [s.encode() for s in shared])
+        self.assertEqual(counts[sq.pack(all_g)], 3)
+        self.assertEqual(len(counts), len(set(shared)) + 1)
+
+    """Do ShortSeqs of every subtype survive pickling with their packed blocks intact?"""
+
+    def test_pickle(self):
+        samples = [rand_sequence(length) for length in (0, 1, MAX_64_NT, MIN_192_NT, MAX_192_NT, MIN_VAR_NT, MAX_VAR_NT)]
+        seqs = [sq.pack(s) for s in samples]
+
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            restored = pickle.loads(pickle.dumps(seqs, protocol))
+            self.assertListEqual(restored, seqs)
+            self.assertListEqual([type(s) for s in restored], [type(s) for s in seqs])
+            self.assertListEqual([hash(s) for s in restored], [hash(s) for s in seqs])
+            self.assertIs(restored[0], sq.pack(""))
+
+        # Packed blocks are smaller than the decoded sequence
+        self.assertLess(len(pickle.dumps(seqs[-1])), len(pickle.dumps(samples[-1])) // 3)
+
+    """Are reverse complements and canonical forms computed correctly for every subtype?"""
+
+    def test_revcomp_canonical(self):
+        complement = str.maketrans("ACGT", "TGCA")
+        lengths = list(range(0, 100)) + [MAX_192_NT, MIN_VAR_NT, 500, MAX_VAR_NT - 1, MAX_VAR_NT]
+
+        for length in lengths:
+            sample = rand_sequence(length)
+            rc = sample.translate(complement)[::-1]
+            seq = sq.pack(sample)
+
+            self.assertEqual(seq.revcomp(), rc)
+            self.assertIs(type(seq.revcomp()), type(seq))
+            self.assertEqual(seq.revcomp().revcomp(), seq)
+            self.assertEqual(seq.canonical(), min(sample, rc))
+            self.assertEqual(hash(seq.revcomp()), hash(sq.pack(rc)))
+
+        palindrome = sq.pack("ACGT")
+        self.assertIs(palindrome.canonical(), palindrome)
+        self.assertIs(sq.pack("").revcomp(), sq.pack(""))
+
     """Do zero-length slices return singleton empty ShortSeqs?"""
 
     def test_zero_length_slice(self):
@@ -269,6 +387,24 @@ class ShortSeqVarTests(unittest.TestCase):
         with self.assertRaisesRegex(Exception, r"(.*)longer than 1024 bases(.*)"):
             sq.pack(exc_seq)
 
+    """Are pooled blocks fully rewritten when a freed ShortSeqVar's storage is reused,
+    including after a failed construction?"""
+
+    def test_block_reuse(self):
+        for length in (MIN_VAR_NT, 200, 513, MAX_VAR_NT):
+            for _ in range(300):
+                sq.pack("G" * length)                       # All bits set, then freed to the pool
+
+            with self.assertRaisesRegex(Exception, "Unsupported base character"):
+                sq.pack("A" * (length - 1) + "N")
+
+            samples = [rand_sequence(length) for _ in range(300)]
+            seqs = [sq.pack(s) for s in samples]
+            slices = [s[1:] for s in seqs]
+            self.assertEqual([str(s) for s in seqs], samples)
+            self.assertEqual([str(s) for s in slices], [s[1:] for s in samples])
+            self.assertEqual(seqs, [sq.pack(s) for s in samples])
+
     """Checks that randomly generated sequences encode and decode correctly
     for the entire valid range of lengths."""
 
@@ -513,3 +649,759 @@ class ShortSeqVarTests(unittest.TestCase):
                     print_var_seq_pext_chunks(sample + prob)
                     print(f"Failed at length {length + 1} with {prob}")
                     raise e
+
+
+class ShortSeqCounterTests(unittest.TestCase):
+    """These tests address sequence counting (ShortSeqCounter and read_and_count_fastq)"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def tmp_path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    """Does read_and_count_fastq() count reads of every ShortSeq subtype in a single pass?"""
+
+    def test_read_and_count_fastq(self):
+        samples = [rand_sequence(length) for length in (0, 1, 32, 33, 96, 97, MAX_VAR_NT)]
+        reads = [s for i, s in enumerate(samples) for _ in range(i + 1)]
+        fastq = write_fastq(self.tmp_path("basic.fq"), reads)
+
+        counts = read_and_count_fastq(fastq)
+
+        self.assertIsInstance(counts, ShortSeqCounter)
+        self.assertEqual(counts, {sq.pack(s): i + 1 for i, s in enumerate(samples)})
+
+    """Are plain, gzip, and BGZF compressed FASTQ files counted correctly, with and without parallel packing?"""
+
+    def test_read_and_count_compressed_fastq(self):
+        samples = [rand_sequence(randint(1, 150)) for _ in range(1000)]
+        reads = [samples[randint(0, len(samples) - 1)] for _ in range(20000)]
+        expected = {}
+        for read in reads:
+            seq = sq.pack(read)
+            expected[seq] = expected.get(seq, 0) + 1
+
+        for compression in (None, "gzip", "bgzf"):
+            fastq = write_fastq(self.tmp_path(f"reads.fq.{compression}"), reads, compression)
+            for threads in (1, 4):
+                with self.subTest(compression=compression, threads=threads):
+                    self.assertEqual(read_and_count_fastq(fastq, threads), expected)
+
+    """Are corrupt compressed FASTQ files reported?"""
+
+    def test_read_and_count_corrupt_bgzf(self):
+        fastq = write_fastq(self.tmp_path("corrupt.fq.bgzf"), ["ATGC"] * 10000, "bgzf")
+        with open(fastq, 'r+b') as f:
+            f.seek(40)
+            f.write(b"\x00" * 16)
+
+        with self.assertRaisesRegex(Exception, "BGZF"):
+            read_and_count_fastq(fastq, 2)
+
+    """Do memory mapped FASTQ files produce the same counts as streamed files, including edge cases?"""
+
+    def test_read_and_count_fastq_mmap(self):
+        reads = [rand_sequence(randint(0, 200)) for _ in range(20000)]
+        fastq = write_fastq(self.tmp_path("mapped.fq"), reads)
+        expected = read_and_count_fastq(fastq)
+
+        for threads in (1, 3):
+            with self.subTest(threads=threads):
+                self.assertEqual(read_and_count_fastq(fastq, threads, mmap=True), expected)
+                self.assertEqual(read_and_count_fastq(fastq, threads, native=True, mmap=True), expected)
+
+        # CRLF line endings and a final record without a trailing newline
+        crlf = self.tmp_path("crlf.fq")
+        with open(crlf, 'wb') as f:
+            f.write(b"@r1\r\nATGC\r\n+\r\nIIII\r\n@r2\r\nGGA\r\n+\r\nIII")
+        self.assertEqual(read_and_count_fastq(crlf, mmap=True), {sq.pack("ATGC"): 1, sq.pack("GGA"): 1})
+
+        empty = self.tmp_path("empty.fq")
+        open(empty, 'w').close()
+        self.assertEqual(read_and_count_fastq(empty, mmap=True), {})
+
+        # Compressed files are streamed regardless
+        gz = write_fastq(self.tmp_path("mapped.fq.gz"), reads, "gzip")
+        self.assertEqual(read_and_count_fastq(gz, mmap=True), expected)
+
+    """Does the native PackedCounter engine produce the same counts as ShortSeqCounter?"""
+
+    def test_read_and_count_fastq_native(self):
+        samples = [rand_sequence(randint(0, MAX_VAR_NT)) for _ in range(5000)]
+        reads = [samples[randint(0, len(samples) - 1)] for _ in range(40000)]
+        fastq = write_fastq(self.tmp_path("native.fq"), reads)
+        expected = read_and_count_fastq(fastq)
+
+        for threads in (1, 3):
+            with self.subTest(threads=threads):
+                counts = read_and_count_fastq(fastq, threads, native=True)
+                self.assertIsInstance(counts, PackedCounter)
+                self.assertEqual(counts, expected)
+                self.assertEqual(counts.to_counter(), expected)
+                self.assertEqual(counts.total(), len(reads))
+
+        with self.assertRaisesRegex(Exception, "Unsupported base character"):
+            PackedCounter([b"ATGC", b"ATGN"])
+
+    """Are a sequence and its reverse complement counted together in canonical mode?"""
+
+    def test_read_and_count_canonical(self):
+        complement = str.maketrans("ACGT", "TGCA")
+        samples = [rand_sequence(randint(1, 150)) for _ in range(500)]
+        reads = [s if randint(0, 1) else s.translate(complement)[::-1] for s in samples for _ in range(3)]
+        fastq = write_fastq(self.tmp_path("canonical.fq"), reads)
+
+        expected = {}
+        for read in reads:
+            key = sq.pack(min(read, read.translate(complement)[::-1]))
+            expected[key] = expected.get(key, 0) + 1
+
+        for native in (False, True):
+            for threads in (1, 3):
+                with self.subTest(native=native, threads=threads):
+                    counts = read_and_count_fastq(fastq, threads, native=native, canonical=True)
+                    self.assertTrue(counts.canonical)
+                    self.assertEqual(counts, expected)
+                    self.assertTrue(pickle.loads(pickle.dumps(counts)).canonical)
+
+                    counts.dump(self.tmp_path("canonical.bin"))
+                    loaded = type(counts).load(self.tmp_path("canonical.bin"))
+                    self.assertTrue(loaded.canonical)
+                    self.assertEqual(loaded, expected)
+
+    """Are counts exported to TSV, FASTA, and NumPy arrays, in iteration order and sorted by count?"""
+
+    def test_counter_export(self):
+        counts = ShortSeqCounter()
+        for length in (0, 1, MAX_64_NT, MIN_192_NT, MAX_192_NT, MIN_VAR_NT, MAX_VAR_NT):
+            for _ in range(3):
+                counts[sq.pack(rand_sequence(length))] = randint(1, 5)
+
+        by_count = sorted(counts.items(), key=lambda kv: -kv[1])
+        tsv, fasta = self.tmp_path("counts.tsv"), self.tmp_path("counts.fa")
+
+        for sort, expected in ((False, list(counts.items())), (True, by_count)):
+            for threads in (1, 3):
+                with self.subTest(sort=sort, threads=threads):
+                    counts.to_tsv(tsv, sort, threads)
+                    counts.to_fasta(fasta, sort, threads)
+                    with open(tsv) as t, open(fasta) as f:
+                        self.assertEqual(t.read(), "".join(f"{seq}\t{n}\n" for seq, n in expected))
+                        self.assertEqual(f.read(), "".join(f">{i}_count={n}\n{seq}\n" for i, (seq, n) in enumerate(expected)))
+
+            words, lengths, totals = counts.to_numpy(sort)
+            self.assertListEqual(lengths.tolist(), [len(seq) for seq, _ in expected])
+            self.assertListEqual(totals.tolist(), [n for _, n in expected])
+            self.assertEqual(len(words), sum((len(seq) + 31) // 32 for seq, _ in expected))
+
+    """Does PackedCounter behave like a read-only dict of ShortSeqs to counts?"""
+
+    def test_packed_counter_mapping(self):
+        counts = PackedCounter([b"ATGC"] * 3 + ["A" * 100] * 2 + [sq.pack("A" * 40)])
+        counts.update({"ATGC": 2})
+
+        self.assertEqual(len(counts), 3)
+        self.assertEqual(counts["ATGC"], 5)
+        self.assertEqual(counts[sq.pack("A" * 100)], 2)
+        self.assertEqual(counts.get("GGGG", 0), 0)
+        self.assertIn(b"A" * 40, counts)
+        self.assertNotIn("A" * 41, counts)
+        self.assertEqual(sorted(counts.values()), [1, 2, 5])
+        self.assertEqual({str(seq) for seq in counts}, {"ATGC", "A" * 100, "A" * 40})
+        self.assertTrue(all(type(seq) in (ShortSeq64, ShortSeq192, ShortSeqVar) for seq in counts.keys()))
+
+        with self.assertRaises(KeyError):
+            _ = counts["GGGG"]
+
+    """Are counts beyond the range of a slot's uint32 preserved?"""
+
+    def test_packed_counter_count_overflow(self):
+        counts = PackedCounter({"ATGC": 2 ** 32 - 2, "A" * 40: 2 ** 40})
+        counts.update(["ATGC", "ATGC"])
+        counts.update({"A" * 40: 1})
+
+        self.assertEqual(counts["ATGC"], 2 ** 32)
+        self.assertEqual(counts["A" * 40], 2 ** 40 + 1)
+        self.assertEqual(counts.total(), 2 ** 32 + 2 ** 40 + 1)
+        self.assertEqual(counts.to_counter(), {sq.pack("ATGC"): 2 ** 32, sq.pack("A" * 40): 2 ** 40 + 1})
+
+    """Are counts from every counter type and mapping added by merge() and +?"""
+
+    def test_merge(self):
+        samples = [rand_sequence(randint(0, MAX_VAR_NT)) for _ in range(300)]
+        left = [samples[randint(0, 299)] for _ in range(2000)]
+        right = [samples[randint(0, 299)] for _ in range(2000)]
+
+        expected = {}
+        for read in left + right:
+            expected[sq.pack(read)] = expected.get(sq.pack(read), 0) + 1
+
+        a, b = ShortSeqCounter([s.encode() for s in left]), ShortSeqCounter([s.encode() for s in right])
+        self.assertEqual(a + b, expected)
+        self.assertEqual(ShortSeqCounter().merge(a, PackedCounter(right)), expected)
+        self.assertEqual(ShortSeqCounter().merge(a, {s: n for s, n in PackedCounter(right).items()}), expected)
+        self.assertEqual(PackedCounter(left).merge(PackedCounter(right)), expected)
+        self.assertEqual(PackedCounter().merge(a, b), expected)
+
+        a += a
+        self.assertEqual(a, {seq: 2 * n for seq, n in ShortSeqCounter([s.encode() for s in left]).items()})
+
+        big = PackedCounter({"ATGC": 2 ** 32 - 1})
+        self.assertEqual(ShortSeqCounter().merge(big, big)[sq.pack("ATGC")], 2 ** 33 - 2)
+        self.assertEqual(PackedCounter().merge(big, big)["ATGC"], 2 ** 33 - 2)
+
+        with self.assertRaises(TypeError):
+            ShortSeqCounter().merge(["ATGC"])
+
+    """Does ShardedCounter partition keys among its shards, and count and merge like the other counters?"""
+
+    def test_read_and_count_sharded(self):
+        complement = str.maketrans("ACGT", "TGCA")
+        samples = [rand_sequence(randint(1, MAX_VAR_NT)) for _ in range(2000)]
+        reads = [samples[randint(0, len(samples) - 1)] for _ in range(20000)]
+        fastq = write_fastq(self.tmp_path("sharded.fq"), reads)
+
+        for canonical in (False, True):
+            expected = {}
+            for read in reads:
+                key = sq.pack(min(read, read.translate(complement)[::-1]) if canonical else read)
+                expected[key] = expected.get(key, 0) + 1
+
+            for native in (False, True):
+                for threads in (1, 3):
+                    with self.subTest(canonical=canonical, native=native, threads=threads):
+                        counts = sq.read_and_count(fastq, "fastq", threads, native, canonical=canonical, shards=5)
+                        self.assertIsInstance(counts, sq.ShardedCounter)
+                        self.assertEqual(len(counts.shards), 5)
+                        self.assertEqual(counts, expected)
+                        self.assertEqual(counts.to_counter(), expected)
+                        self.assertEqual(pickle.loads(pickle.dumps(counts)), expected)
+                        for i, shard in enumerate(counts.shards):
+                            self.assertTrue(all(counts.shard_of(seq) == i for seq in shard))
+
+        halves = sq.ShardedCounter(5), sq.ShardedCounter(5, native=True)
+        halves[0].update(reads[:10000])
+        halves[1].update(reads[10000:])
+        self.assertEqual(halves[0].merge(halves[1]), read_and_count_fastq(fastq))
+        self.assertEqual(sq.ShardedCounter(3).merge(halves[0]), read_and_count_fastq(fastq))
+
+    """Do counts survive dump() and load() in both counter types, and pickling?"""
+
+    def test_dump_load(self):
+        seqs = [rand_sequence(randint(0, MAX_VAR_NT)) for _ in range(3000)] + ["", "A" * MAX_64_NT]
+        counts = ShortSeqCounter()
+        for i, seq in enumerate(seqs):
+            counts[sq.pack(seq)] = i * 2 ** 33 + 1
+
+        path = self.tmp_path("counts.bin")
+        counts.dump(path)
+        self.assertEqual(ShortSeqCounter.load(path), counts)
+        self.assertEqual(PackedCounter.load(path), counts)
+        self.assertFalse(PackedCounter.load(path).canonical)
+
+        native = PackedCounter.load(path)
+        native.dump(path)
+        self.assertEqual(ShortSeqCounter.load(path), counts)
+
+        self.assertEqual(pickle.loads(pickle.dumps(counts)), counts)
+        self.assertIs(type(pickle.loads(pickle.dumps(counts))), ShortSeqCounter)
+        self.assertEqual(pickle.loads(pickle.dumps(native)), counts)
+
+        ShortSeqCounter().dump(path)
+        self.assertEqual(ShortSeqCounter.load(path), {})
+
+    """Are truncated and foreign files rejected by load()?"""
+
+    def test_load_errors(self):
+        path = self.tmp_path("counts.bin")
+        ShortSeqCounter([rand_sequence(50).encode() for _ in range(100)]).dump(path)
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:-8])
+        with self.assertRaisesRegex(Exception, "truncated or corrupt"):
+            ShortSeqCounter.load(path)
+
+        with open(path, 'wb') as f:
+            f.write(b"@read1\nATGC\n+\nIIII\n" * 4)
+        with self.assertRaisesRegex(Exception, "not a ShortSeq counts file"):
+            PackedCounter.load(path)
+
+        # Version field as written by a machine with the other byte order
+        with open(path, 'wb') as f:
+            f.write(data[:8] + data[8:12][::-1] + data[12:])
+        with self.assertRaisesRegex(Exception, "different byte order"):
+            ShortSeqCounter.load(path)
+
+    """Are unsupported bases and excessive lengths reported when reads are packed in parallel?"""
+
+    def test_read_and_count_fastq_parallel_errors(self):
+        reads = [rand_sequence(50) for _ in range(40000)]
+        problems = {"Unsupported base character": "N", "longer than 1024 bases": "A" * (MAX_VAR_NT + 1)}
+
+        for msg, prob in problems.items():
+            fastq = write_fastq(self.tmp_path("bad.fq"), reads[:35000] + [prob] + reads[35000:])
+            with self.assertRaisesRegex(Exception, msg):
+                read_and_count_fastq(fastq, 3)
+
+    """Are malformed and missing FASTQ files reported?"""
+
+    def test_read_and_count_fastq_errors(self):
+        with self.assertRaises(FileNotFoundError):
+            read_and_count_fastq(self.tmp_path("missing.fq"))
+
+        truncated = self.tmp_path("truncated.fq")
+        with open(truncated, 'w') as f:
+            f.write("@read1\nATGC\n")
+
+        with self.assertRaisesRegex(Exception, "truncated record"):
+            read_and_count_fastq(truncated)
+
+    """Are FASTA (including wrapped and compressed), SAM, and one-per-line text files detected and counted?"""
+
+    def test_read_and_count_other_formats(self):
+        samples = [rand_sequence(length) for length in (1, 32, 33, 96, 97, 200, MAX_VAR_NT)]
+        reads = [s for i, s in enumerate(samples) for _ in range(i + 1)]
+        expected = {sq.pack(s): i + 1 for i, s in enumerate(samples)}
+
+        fasta = "".join(f">read{i} desc\n" + "\n".join(r[j:j+60] for j in range(0, len(r), 60)) + "\n"
+                        for i, r in enumerate(reads))
+        sam = "@HD\tVN:1.6\n@SQ\tSN:chr1\tLN:5000\n" + "".join(
+            f"read{i}\t{flag}\tchr1\t1\t60\t{len(r)}M\t*\t0\t0\t{r}\t*\n"
+            for i, r in enumerate(reads) for flag in (0, 256))              # Secondary alignments are skipped
+        sam += "unmapped\t4\t*\t0\t0\t*\t*\t0\t0\t*\t*\n"          # SEQ not stored
+        text = "\n".join(reads) + "\n\n"
+
+        for fmt, content in (("fasta", fasta), ("sam", sam), ("text", text)):
+            path = self.tmp_path(f"reads.{fmt}")
+            with open(path, 'w') as f:
+                f.write(content)
+            with gzip.open(path + ".gz", 'wt') as f:
+                f.write(content)
+
+            for filename in (path, path + ".gz"):
+                self.assertEqual(sq.detect_format(filename), fmt)
+                for threads in (1, 3):
+                    with self.subTest(file=filename, threads=threads):
+                        self.assertEqual(sq.read_and_count(filename, threads=threads), expected)
+                        self.assertEqual(list(ShortSeqArray.from_file(filename, fmt, threads)), reads)
+
+        with self.assertRaisesRegex(Exception, "expected a FASTA header"):
+            sq.read_and_count(self.tmp_path("reads.text"), "fasta")
+        with self.assertRaisesRegex(ValueError, "Unsupported sequence format"):
+            sq.read_and_count(self.tmp_path("reads.text"), "bam")
+        with self.assertRaisesRegex(TypeError, "can't be instantiated directly"):
+            SeqReader(self.tmp_path("reads.text"))
+
+    """Are adapters trimmed, and reads filtered by length and quality, as they are counted?"""
+
+    def test_read_and_count_filtered(self):
+        adapter = "TGGAATTCTCGG"
+        insert = rand_sequence(39) + "C"                             # Doesn't end with a prefix of the adapter
+        records = [
+            (insert + adapter + "ACGT", "I" * 56),                   # Full adapter, trimmed
+            (insert + "TGGTATTCTCGG", "I" * 52),                     # One mismatch, trimmed
+            (insert + "TGGA", "I" * 44),                             # Partial adapter at the 3' end, trimmed
+            (insert[:10] + adapter, "I" * 22),                       # Too short once trimmed
+            (insert + insert, "I" * 80),                             # Too long
+            (insert, "I" * 20 + "#" + "I" * 19),                     # A base below min_quality
+            (insert, "5" * 40),                                      # Mean below min_mean_quality
+        ]
+
+        fastq = self.tmp_path("filter.fq")
+        with open(fastq, 'w') as f:
+            f.writelines(f"@read{i}\n{seq}\n+\n{qual}\n" for i, (seq, qual) in enumerate(records))
+
+        for threads, native in ((1, False), (3, True)):
+            with self.subTest(threads=threads, native=native):
+                rf = sq.ReadFilter(min_length=20, max_length=60, min_quality=10, min_mean_quality=30, adapter=adapter)
+                counts = read_and_count_fastq(fastq, threads, native, read_filter=rf)
+                self.assertEqual(dict(counts), {sq.pack(insert): 3})
+                self.assertEqual(rf.stats(), {"reads": 7, "ambiguous": 0, "trimmed": 4, "too_short": 1, "too_long": 1,
+                                              "low_quality": 1, "low_mean_quality": 1, "passed": 3})
+
+        self.assertEqual(sq.ReadFilter(adapter=adapter).trim(insert + "TGG"), insert)
+        self.assertEqual(sq.ReadFilter(adapter=adapter).trim(insert + "TG"), insert + "TG")
+        fasta = self.tmp_path("filter.fa")
+        with open(fasta, 'w') as f:
+            f.write(f">read0\n{insert}\n")
+        with self.assertRaisesRegex(Exception, "require input with base qualities"):
+            sq.read_and_count(fasta, read_filter=sq.ReadFilter(min_quality=20))
+
+    """Are reads with N and lowercase bases dropped, masked, or split under each policy?"""
+
+    def test_read_and_count_ambiguous(self):
+        a, b = rand_sequence(30), rand_sequence(40)
+        reads = [a + "N" + b, a.lower() + b, "NN" + a + "NNN", b]
+        fastq = write_fastq(self.tmp_path("ambiguous.fq"), reads)
+        expected = {
+            "drop": {sq.pack(b): 1},
+            "mask": {sq.pack(a + "A" + b): 1, sq.pack(a + b): 1, sq.pack("AA" + a + "AAA"): 1, sq.pack(b): 1},
+            "split": {sq.pack(a): 2, sq.pack(b): 2, sq.pack(a + b): 1},
+        }
+
+        for policy, counts in expected.items():
+            for threads in (1, 3):
+                with self.subTest(policy=policy, threads=threads):
+                    rf = sq.ReadFilter(ambiguous=policy)
+                    self.assertEqual(dict(read_and_count_fastq(fastq, threads, read_filter=rf)), counts)
+                    self.assertEqual(rf.n_ambiguous, 3)
+
+        # Ambiguous bases count as adapter mismatches, rather than as the A they are masked with
+        insert = "ACGT" * 5 + "C"
+        fastq = write_fastq(self.tmp_path("ambiguous_adapter.fq"), [insert + "AANAAANAAA"])
+        expected = {
+            "mask": {sq.pack(insert + "AAAAAAA"): 1},
+            "split": {sq.pack(insert + "AA"): 1, sq.pack("AAA"): 1},
+        }
+
+        for policy, counts in expected.items():
+            with self.subTest(policy=policy, adapter=True):
+                rf = sq.ReadFilter(adapter="A" * 10, ambiguous=policy)
+                self.assertEqual(dict(read_and_count_fastq(fastq, read_filter=rf)), counts)
+                self.assertEqual(rf.n_trimmed, 1)
+
+        # A split read that is interrupted by an exception leaves no pieces for the next reader
+        rf = sq.ReadFilter(ambiguous="split")
+        interrupted = write_fastq(self.tmp_path("interrupted.fq"), ["A" * 1100 + "N" + a + "N" + "C" * 40])
+        with self.assertRaises(Exception):
+            read_and_count_fastq(interrupted, read_filter=rf)
+        for threads in (1, 3):
+            counts = read_and_count_fastq(self.tmp_path("ambiguous.fq"), threads, read_filter=rf)
+            self.assertEqual(dict(counts), {sq.pack(a): 2, sq.pack(b): 2, sq.pack(a + b): 1})
+
+        with self.assertRaisesRegex(Exception, "Unsupported base character"):
+            read_and_count_fastq(fastq)
+        with self.assertRaisesRegex(ValueError, "Unsupported ambiguous base policy"):
+            sq.ReadFilter(ambiguous="skip")
+
+
+class ShortSeqArrayTests(unittest.TestCase):
+    """These tests address contiguous storage of many sequences (ShortSeqArray)"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def tmp_path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    """Can sequences of every ShortSeq subtype be stored and retrieved by index, slice, and iteration?"""
+
+    def test_indexing(self):
+        seqs = [rand_sequence(length) for length in [0, 1, 32, 33, 64, 65, MAX_192_NT, MIN_VAR_NT, MAX_VAR_NT]]
+        arr = ShortSeqArray(seqs[:3])
+        arr.extend(seq.encode() for seq in seqs[3:6])
+        arr.extend(ShortSeqArray(sq.pack(seq) for seq in seqs[6:]))
+
+        self.assertEqual(len(arr), len(seqs))
+        self.assertListEqual([str(seq) for seq in arr], seqs)
+        self.assertListEqual([str(arr[i]) for i in range(-len(seqs), 0)], seqs)
+        self.assertListEqual([str(seq) for seq in arr[1::3]], seqs[1::3])
+        self.assertListEqual(arr.lengths.tolist(), [len(seq) for seq in seqs])
+        self.assertIs(arr[0], sq.pack(""))
+
+        with self.assertRaises(IndexError):
+            _ = arr[len(seqs)]
+
+        arr.extend(arr)
+        self.assertListEqual([str(seq) for seq in arr], seqs * 2)
+
+    """Are the packed blocks exposed through the buffer protocol?"""
+
+    def test_buffer_protocol(self):
+        seqs = [rand_sequence(randint(0, 200)) for _ in range(100)]
+        arr = ShortSeqArray(seqs)
+        blocks = np.frombuffer(arr, dtype=np.uint64)
+
+        self.assertEqual(blocks.nbytes, arr.nbytes)
+        self.assertEqual(memoryview(arr).format, "Q")
+        self.assertTrue(memoryview(arr).readonly)
+
+        for seq, offset, length in zip(seqs, arr.offsets, arr.lengths):
+            expected = sq.pack(seq)
+            n_blocks = (length + 31) // 32
+            self.assertEqual(bytes(blocks[offset:offset + n_blocks]), bytes(ShortSeqArray([expected])))
+
+        with memoryview(arr):
+            with self.assertRaises(BufferError):
+                arr.extend(seqs * 10)
+
+    """Does a ShortSeqArray survive pickling?"""
+
+    def test_pickle(self):
+        arr = ShortSeqArray(rand_sequence(randint(0, 300)) for _ in range(1000))
+        restored = pickle.loads(pickle.dumps(arr))
+
+        self.assertEqual(restored, arr)
+        self.assertListEqual(restored.offsets.tolist(), arr.offsets.tolist())
+        self.assertEqual(pickle.loads(pickle.dumps(ShortSeqArray())), ShortSeqArray())
+
+    """Can FASTQ files be read into a ShortSeqArray, serially and in parallel?"""
+
+    def test_from_fastq(self):
+        seqs = [rand_sequence(randint(0, 300)) for _ in range(40000)]
+        fastq = write_fastq(self.tmp_path("reads.fq.gz"), seqs, "bgzf")
+
+        for threads in [1, 3]:
+            arr = ShortSeqArray.from_fastq(fastq, threads)
+            self.assertListEqual([str(seq) for seq in arr], seqs)
+
+        bad = write_fastq(self.tmp_path("bad.fq"), seqs[:30000] + ["N"] + seqs[30000:])
+        with self.assertRaisesRegex(Exception, "Unsupported base character"):
+            ShortSeqArray.from_fastq(bad, 3)
+
+    """Are sequences decoded in bulk, in parallel, to strings and to FASTA?"""
+
+    def test_to_strings_write_fasta(self):
+        samples = [rand_sequence(randint(0, MAX_VAR_NT)) for _ in range(3000)]
+        arr = ShortSeqArray(samples)
+
+        for threads in (1, 4):
+            self.assertListEqual(sq.to_strings(arr, threads), samples)
+            self.assertListEqual(sq.to_strings([sq.pack(s) for s in samples], threads), samples)
+
+            sq.write_fasta(arr, self.tmp_path("seqs.fa"), threads)
+            self.assertListEqual(list(ShortSeqArray.from_file(self.tmp_path("seqs.fa"), "fasta")), samples)
+
+        counts = ShortSeqCounter([s.encode() for s in samples[:3]] * 2)
+        sq.write_fasta(counts, self.tmp_path("counts.fa"), 2)
+        with open(self.tmp_path("counts.fa")) as f:
+            self.assertEqual(f.read(), "".join(f">{i}_count=2\n{s}\n" for i, s in enumerate(samples[:3])))
+
+        # The array is pinned only while it is being decoded
+        self.assertListEqual(sq.to_strings(arr[:0]), [])
+        arr.append("ATGC")
+        self.assertEqual(sq.to_strings(arr)[-1], "ATGC")
+
+
+class BulkDistanceTests(unittest.TestCase):
+    """These tests address the bulk Hamming distance kernels (hamming_many, hamming_matrix, within)"""
+
+    """Do the bulk kernels agree with the per-pair __xor__ path for every ShortSeq subtype?"""
+
+    def test_bulk_hamming(self):
+        for length in [1, 12, MAX_64_NT, MIN_192_NT, MAX_192_NT, MIN_VAR_NT, MAX_VAR_NT]:
+            seqs = [sq.pack(rand_sequence(length)) for _ in range(50)]
+            query = seqs[7]
+            expected = [[a ^ b for b in seqs] for a in seqs]
+
+            for threads in [1, 3]:
+                self.assertListEqual(sq.hamming_many(query, seqs, threads).tolist(), expected[7])
+                self.assertListEqual(sq.hamming_matrix(ShortSeqArray(seqs), threads).tolist(), expected)
+                self.assertListEqual(sq.within(str(query), seqs, length // 2, threads).tolist(),
+                                     [i for i, dist in enumerate(expected[7]) if dist <= length // 2])
+
+    """Are sequences of mismatched length reported?"""
+
+    def test_bulk_hamming_length_mismatch(self):
+        with self.assertRaisesRegex(Exception, "sequence 2 has length 3, expected 4"):
+            sq.hamming_many("ATGC", ["ATGC", "ATGG", "ATG"])
+
+        with self.assertRaisesRegex(Exception, "sequence 1 has length 5, expected 4"):
+            sq.hamming_matrix(["ATGC", "ATGCA", "ATGG"], threads=2)
+
+        self.assertEqual(sq.hamming_matrix([]).shape, (0, 0))
+
+    """Does the banded Myers edit distance agree with the textbook algorithm across block and word boundaries?"""
+
+    def test_edit_distance(self):
+        def mutate(seq, n_edits):
+            seq = list(seq)
+            for _ in range(n_edits):
+                pos = randint(0, len(seq))
+                op = randint(0, 2)
+                if op == 0: seq.insert(pos, "ATGC"[randint(0, 3)])
+                elif pos < len(seq) and op == 1: seq[pos] = "ATGC"[randint(0, 3)]
+                elif pos < len(seq): del seq[pos]
+            return "".join(seq)[:MAX_VAR_NT]
+
+        for length in [0, 1, 12, 31, 32, 33, 63, 64, 65, 127, 128, 129, 300]:
+            query = rand_sequence(length)
+            seqs = [mutate(query, randint(0, length // 4 + 1)) for _ in range(10)] + [rand_sequence(randint(0, 200))]
+            expected = [levenshtein(query, seq) for seq in seqs]
+
+            self.assertListEqual([sq.edit_distance(query, sq.pack(seq)) for seq in seqs], expected)
+            self.assertListEqual([sq.edit_distance(seq, query, 3) for seq in seqs], [min(d, 4) for d in expected])
+            self.assertListEqual(sq.edit_distance_many(query, seqs, threads=2).tolist(), expected)
+            self.assertListEqual(sq.edit_distance_many(query, seqs, max_dist=5).tolist(), [min(d, 6) for d in expected])
+
+        self.assertEqual(sq.edit_distance("A" * MAX_VAR_NT, "C" * MAX_VAR_NT), MAX_VAR_NT)
+
+    """Does HammingIndex find exactly the whitelist entries that a linear scan finds?"""
+
+    def test_hamming_index_neighbors(self):
+        whitelist = list({rand_sequence(12) for _ in range(5000)})
+        arr = ShortSeqArray(whitelist)
+        index = sq.HammingIndex(whitelist, max_dist=2)
+
+        for _ in range(200):
+            query = list(whitelist[randint(0, len(whitelist) - 1)])
+            for _ in range(randint(0, 3)):
+                query[randint(0, 11)] = "ATGC"[randint(0, 3)]
+            query = "".join(query)
+
+            for max_dist in [0, 1, 2]:
+                dists = sq.hamming_many(query, arr)
+                found = index.neighbors(query, max_dist)
+                self.assertSetEqual({str(seq) for seq in found}, {whitelist[i] for i in sq.within(query, arr, max_dist)})
+                self.assertListEqual([sq.pack(query) ^ seq for seq in found], sorted(dists[dists <= max_dist].tolist()))
+
+        self.assertListEqual(index.neighbors("ATG"), [])
+        with self.assertRaisesRegex(Exception, "exceeds the max_dist of the index"):
+            index.neighbors(whitelist[0], 3)
+
+    """Are counts corrected to their unique nearest whitelist entry?"""
+
+    def test_hamming_index_correct(self):
+        index = sq.HammingIndex(["AAAAAAAA", "CCCCCCCC", "AAAATTTT"], max_dist=2)
+        counts = ShortSeqCounter()
+        for seq, count in {"AAAAAAAA": 5, "AAAAAAAC": 2, "CCCCCCAA": 1, "AAAATAAA": 3, "GGGGGGGG": 4, "AAAAAAA": 1}.items():
+            counts[sq.pack(seq)] = count
+
+        corrected, uncorrectable = index.correct(counts, max_dist=2)
+        self.assertDictEqual({str(k): v for k, v in corrected.items()}, {"AAAAAAAA": 10, "CCCCCCCC": 1})
+        self.assertDictEqual({str(k): v for k, v in uncorrectable.items()}, {"GGGGGGGG": 4, "AAAAAAA": 1})
+        self.assertEqual(index.nearest("AAAAAAAC", max_dist=0), None)
+
+
+class KmerTests(unittest.TestCase):
+    """These tests address k-mer extraction and counting (kmers, kmers_from_file, KmerCounter)"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    @staticmethod
+    def ref_kmers(seq, k, canonical=False):
+        complement = str.maketrans("ACGT", "TGCA")
+        kmers = [seq[i:i+k] for i in range(len(seq) - k + 1)]
+        return [min(km, km.translate(complement)[::-1]) for km in kmers] if canonical else kmers
+
+    """Do k-mer codes match slices of every ShortSeq subtype, forward and canonical?"""
+
+    def test_kmers(self):
+        for k in (1, 7, 31, 32):
+            for length in (0, k - 1, k, MAX_64_NT, MIN_192_NT, MAX_192_NT, MIN_VAR_NT, MAX_VAR_NT):
+                sample = rand_sequence(length)
+                for canonical in (False, True):
+                    codes = sq.kmers(sample, k, canonical)
+                    self.assertEqual(codes.dtype, np.uint64)
+                    self.assertListEqual([sq.decode_kmer(c, k) for c in codes], self.ref_kmers(sample, k, canonical))
+
+        with self.assertRaisesRegex(Exception, "k must be between 1 and 32"):
+            sq.kmers("ATGC", 33)
+
+    """Are the k-mers of a FASTQ file extracted and counted without slicing, with and without parallel packing?"""
+
+    def test_count_kmers(self):
+        reads = [rand_sequence(randint(0, 150)) for _ in range(2000)]
+        fastq = write_fastq(os.path.join(self.tmpdir.name, "kmers.fq"), reads)
+
+        for canonical in (False, True):
+            expected = {}
+            for read in reads:
+                for kmer in self.ref_kmers(read, 21, canonical):
+                    expected[sq.pack(kmer)] = expected.get(sq.pack(kmer), 0) + 1
+
+            for threads in (1, 3):
+                with self.subTest(canonical=canonical, threads=threads):
+                    counts = sq.count_kmers(fastq, 21, canonical, threads=threads)
+                    self.assertIsInstance(counts, sq.KmerCounter)
+                    self.assertEqual(counts, expected)
+                    self.assertEqual(len(sq.kmers_from_file(fastq, 21, canonical, threads=threads)), counts.total())
+
+                    codes, totals = counts.to_numpy()
+                    self.assertDictEqual({sq.decode_kmer(c, 21): n for c, n in zip(codes, totals)}, expected)
+
+        restored = pickle.loads(pickle.dumps(counts))
+        self.assertEqual((restored.k, restored.canonical), (21, True))
+        self.assertEqual(restored, counts)
+
+        dumped = os.path.join(self.tmpdir.name, "kmers.bin")
+        counts.dump(dumped)
+        self.assertEqual(sq.KmerCounter.load(dumped).k, 21)
+        self.assertEqual(sq.KmerCounter.load(dumped), counts)
+
+        # k is stored in the header, so it survives even when there are no k-mers
+        sq.KmerCounter(7).dump(dumped)
+        self.assertEqual(sq.KmerCounter.load(dumped).k, 7)
+        ShortSeqCounter().dump(dumped)
+        with self.assertRaisesRegex(Exception, "k must be between 1 and 32"):
+            sq.KmerCounter.load(dumped)
+
+
+class KernelTests(unittest.TestCase):
+    """These tests address the CPU-specific encoding and decoding kernels (set_kernels)"""
+
+    def setUp(self):
+        self.kernels = sq.get_kernels()
+
+    def tearDown(self):
+        sq.set_kernels(self.kernels)
+
+    """Does every kernel variant supported by this CPU produce the same packed blocks, strings, and errors?"""
+
+    def test_kernel_variants(self):
+        self.assertIn("portable", sq.available_kernels())
+        self.assertIn(sq.get_kernels(), sq.available_kernels())
+
+        lengths = (0, 1, 31, 32, 33, 64, 65, 96, 191, 192, 193, 255, 256, 512, MAX_VAR_NT)
+        samples = [rand_sequence(length) for length in lengths]
+        sq.set_kernels("portable")
+        expected = [sq.pack(sample) for sample in samples]
+
+        for name in sq.available_kernels():
+            with self.subTest(kernels=name):
+                sq.set_kernels(name)
+                self.assertEqual(sq.get_kernels(), name)
+                for sample, reference in zip(samples, expected):
+                    seq = sq.pack(sample.encode())
+                    self.assertEqual(seq, reference)
+                    self.assertEqual(hash(seq), hash(reference))
+                    self.assertEqual(str(reference), sample)
+                    self.assertEqual(seq ^ sq.pack(sample[::-1]), sum(a != b for a, b in zip(sample, sample[::-1])))
+
+                self.assertListEqual(sq.to_strings(ShortSeqArray(samples)), samples)
+                for pos in (0, 31, 32, 200):
+                    with self.assertRaisesRegex(Exception, "Unsupported base character: A*N"):
+                        sq.pack("A" * pos + "N" + "A" * 50)
+
+    """Does every kernel variant accept exactly the same characters, wherever they fall in a block?"""
+
+    def test_kernel_validation(self):
+        def accepted(seq):
+            try:
+                sq.pack(seq)
+                return True
+            except Exception:
+                return False
+
+        sq.set_kernels("portable")
+        expected = [accepted(b"A" * 40 + bytes([c]) + b"A" * 23) for c in range(256)]
+        self.assertEqual(sum(expected), 4 * 4)     # Characters with the low 6 bits of A, C, G, or T
+
+        for name in sq.available_kernels():
+            sq.set_kernels(name)
+            for pos in (0, 15, 16, 31):
+                with self.subTest(kernels=name, pos=pos):
+                    samples = [b"A" * (32 + pos) + bytes([c]) + b"A" * (31 - pos) for c in range(256)]
+                    self.assertListEqual([accepted(s) for s in samples], expected)
+
+        with self.assertRaisesRegex(ValueError, "Unknown kernel variant"):
+            sq.set_kernels("avx512")
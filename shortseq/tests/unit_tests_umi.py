@@ -1,6 +1,13 @@
 import unittest
+import tempfile
+import os
 
+from collections import Counter
+from random import randint
+
+from shortseq import MAX_VAR_NT
 from shortseq.umi import *
+from shortseq.tests.util import rand_sequence, write_fastq
 
 class MyTestCase(unittest.TestCase):
     def test_construct(self):
@@ -19,14 +26,97 @@ class MyTestCase(unittest.TestCase):
         self.assertIsInstance(f_bo.from_bytes(b"ATGC"), UMIboth)
 
     def test_seq_basic(self):
-        #                             remain: GCGTAATA GGGGGTTT CGCTGTGG GGCGGCT
-        # GCGTAATA GGGGGTTT CGCTGTGG GGCGGCTA GCGTAATA GGGGGTTT CGCTGTGG GGCGGCT
-        # seq = b"GCGTAATAGGGGGTTTCGCTGTGGGGCGGCTAGCGTAATAGGGGGTTTCGCTGTGGGGCGGCT"
-        # UMIFactory(len_5p=5).from_bytes(seq)
-
-        # GCGTAATA GGGGGTTT CGCTGTGG GGCGGCTA G
+        # UMI: GCGTA | Insert: ATAGGGGGTTTCGCTGTGGGGCGGC | UMI: TAG
         seq = b"GCGTAATAGGGGGTTTCGCTGTGGGGCGGCTAG"
-        UMIFactory(len_5p=5).from_bytes(seq)
+        umi = UMIFactory(len_5p=5, len_3p=3).from_bytes(seq)
+
+        self.assertEqual(umi.umi_5p, "GCGTA")
+        self.assertEqual(umi.umi_3p, "TAG")
+        self.assertEqual(umi.insert, "ATAGGGGGTTTCGCTGTGGGGCGGC")
+        self.assertEqual(str(umi), "ATAGGGGGTTTCGCTGTGGGGCGGC")
+        self.assertEqual(len(umi), 25)
+
+        self.assertIsNone(UMIFactory(len_5p=5).from_bytes(seq).umi_3p)
+        self.assertIsNone(UMIFactory(len_3p=3).from_bytes(seq).umi_5p)
+
+    """Are UMIs of up to 14 bases and inserts of up to MAX_VAR_NT bases supported?"""
+
+    def test_max_lengths(self):
+        factory = UMIFactory(len_5p=14, len_3p=14)
+        for length in (0, 1, 32, 33, 64, 65, MAX_VAR_NT):
+            with self.subTest(length=length):
+                seq = rand_sequence(length + 28)
+                umi = factory.from_bytes(seq.encode())
+                self.assertEqual(umi.umi_5p, seq[:14])
+                self.assertEqual(umi.umi_3p, seq[-14:])
+                self.assertEqual(str(umi), seq[14:-14])
+
+        with self.assertRaisesRegex(Exception, "not supported"):
+            UMIFactory(len_5p=15)
+        with self.assertRaisesRegex(Exception, "not supported"):
+            factory.from_bytes(b"A" * (MAX_VAR_NT + 29))
+        with self.assertRaisesRegex(Exception, "shorter than its UMIs"):
+            factory.from_bytes(b"A" * 27)
+        with self.assertRaisesRegex(Exception, "Unsupported base character"):
+            factory.from_bytes(b"N" * 30)
+
+    """Are reads equal and hashed alike only if their type, UMIs, and insert match?"""
+
+    def test_eq_hash(self):
+        factory = UMIFactory(len_5p=4, len_3p=4)
+        a = factory.from_bytes(b"ACGT" + b"T" * 100 + b"GGGG")
+
+        self.assertEqual(a, factory.from_bytes(b"ACGT" + b"T" * 100 + b"GGGG"))
+        self.assertEqual(hash(a), hash(factory.from_bytes(b"ACGT" + b"T" * 100 + b"GGGG")))
+        self.assertNotEqual(a, factory.from_bytes(b"ACGA" + b"T" * 100 + b"GGGG"))
+        self.assertNotEqual(a, factory.from_bytes(b"ACGT" + b"T" * 100 + b"GGGA"))
+        self.assertNotEqual(a, factory.from_bytes(b"ACGT" + b"T" * 99 + b"AGGGG"))
+        self.assertNotEqual(a, UMIFactory(len_5p=4).from_bytes(b"ACGT" + b"T" * 100 + b"GGGG"))
+
+    """Does dedup_fastq() count each unique (UMI, insert) combination?"""
+
+    def test_dedup_fastq(self):
+        umis = [rand_sequence(8) for _ in range(20)]
+        inserts = [rand_sequence(randint(0, 300)) for _ in range(20)]
+        reads = [umis[randint(0, 19)] + inserts[randint(0, 19)] + umis[randint(0, 19)] for _ in range(5000)]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fastq = write_fastq(os.path.join(tmpdir, "umi.fq"), reads)
+            counts = dedup_fastq(fastq, 8, 8)
+
+        self.assertTrue(all(type(umi) is UMIboth for umi in counts))
+        self.assertEqual({f"{u.umi_5p}{u}{u.umi_3p}": n for u, n in counts.items()}, Counter(reads))
+
+
+    """Does directional clustering collapse UMIs one substitution away from a UMI of at least twice the count?"""
+
+    def test_cluster_directional(self):
+        counts = {"ACGT": 100, "ACGA": 40, "ACCA": 10, "TTTT": 5, "TTTA": 4, "GGGG": 1}
+        clusters = cluster_directional(counts)
+
+        self.assertEqual([sorted(c) for c in clusters], [["ACCA", "ACGA", "ACGT"], ["TTTT"], ["TTTA"], ["GGGG"]])
+        self.assertEqual([c[0] for c in clusters], ["ACGT", "TTTT", "TTTA", "GGGG"])
+        self.assertEqual(len(cluster_directional(counts, ratio=3)), 5)
+
+        # Large groups find neighbors by hashing rather than by comparing all pairs
+        many = {f"{i:012b}".replace("0", "A").replace("1", "C"): 1000 for i in range(0, 4096, 3)}
+        many.update({umi[:-1] + "G": 1 for umi in list(many)})
+        self.assertEqual(len(cluster_directional(many)), 4096 // 3 + 1)
+
+        with self.assertRaisesRegex(Exception, "not supported"):
+            cluster_directional({"A" * 33: 1})
+
+    """Does dedup_fastq() cluster UMIs per insert in directional mode?"""
+
+    def test_dedup_fastq_directional(self):
+        reads = ["ACGTAA" + "TTTTTTTT"] * 10 + ["ACGTAT" + "TTTTTTTT"] * 2 + ["ACGTAT" + "GGGGGGGG"] * 2
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fastq = write_fastq(os.path.join(tmpdir, "umi.fq"), reads)
+            counts = dedup_fastq(fastq, len_5p=6, directional=True)
+
+        self.assertEqual({(str(u.umi_5p), str(u)): n for u, n in counts.items()},
+                         {("ACGTAA", "TTTTTTTT"): 12, ("ACGTAT", "GGGGGGGG"): 2})
 
 
 if __name__ == '__main__':
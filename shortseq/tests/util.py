@@ -1,5 +1,8 @@
 import random
+import struct
+import gzip
 import math
+import zlib
 import re
 
 
@@ -25,6 +28,19 @@ def print_var_seq_pext_chunks(seq):
     print(" -> ".join(out))
 
 
+def levenshtein(a, b):
+    """Returns the edit distance between two strings using the textbook dynamic programming algorithm"""
+
+    prev = list(range(len(b) + 1))
+    for i, a_nt in enumerate(a, 1):
+        curr = [i] + [0] * len(b)
+        for j, b_nt in enumerate(b, 1):
+            curr[j] = min(prev[j] + 1, curr[j - 1] + 1, prev[j - 1] + (a_nt != b_nt))
+        prev = curr
+
+    return prev[-1]
+
+
 def rand_sequence(min_length=None, max_length=None, as_bytes=False):
     """Returns a randomly generated sequence of the specified type, with a length in the specified range"""
 
@@ -40,6 +56,36 @@ def rand_sequence(min_length=None, max_length=None, as_bytes=False):
     return seq.encode() if as_bytes else seq
 
 
+def write_fastq(path, seqs, compression=None):
+    """Writes the given str sequences as FASTQ records with placeholder headers and quality scores.
+    The file can optionally be compressed as "gzip" or "bgzf"."""
+
+    records = "".join(f"@read{i}\n{seq}\n+\n{'I' * len(seq)}\n" for i, seq in enumerate(seqs)).encode()
+
+    if compression == "gzip":
+        records = gzip.compress(records)
+    elif compression == "bgzf":
+        records = bgzf_compress(records)
+
+    with open(path, 'wb') as f:
+        f.write(records)
+
+    return path
+
+
+def bgzf_compress(data, block_size=0xff00):
+    """Compresses data as a series of BGZF blocks, terminated by the standard empty EOF block"""
+
+    def block(payload):
+        deflater = zlib.compressobj(6, zlib.DEFLATED, -15)
+        cdata = deflater.compress(payload) + deflater.flush()
+        header = struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+        return header + cdata + struct.pack("<II", zlib.crc32(payload), len(payload))
+
+    blocks = [block(data[i:i + block_size]) for i in range(0, len(data), block_size)]
+    return b"".join(blocks) + block(b"")
+
+
 def sorted_natural(lines, key=None, reverse=False):
     """Sorts alphanumeric strings with entire numbers considered in the sorting order,
     rather than the default behavior which is to sort by the individual ASCII values
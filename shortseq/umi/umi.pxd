@@ -1,45 +1,47 @@
 from shortseq.util cimport *
+from shortseq.short_seq cimport pack, _from_packed, _packed_blocks
+from shortseq.short_seq_64 cimport ShortSeq64, MAX_64_NT
+from shortseq.short_seq_var cimport _marshall_bytes_var, _free_var_blocks, MAX_VAR_NT
+from shortseq.counter cimport _PyDict_GetItem_KnownHash, _PyDict_SetItem_KnownHash
+from shortseq.fast_read cimport SeqReader
+from cpython.bytes cimport PyBytes_AS_STRING
 from cpython.mem cimport PyObject_Calloc, PyObject_Free
-from cpython.exc cimport PyErr_NoMemory
-from libc.math cimport ceil, floor
+from cpython.exc cimport PyErr_Occurred
+from cpython.object cimport PyTypeObject, Py_TYPE
+from libc.stdint cimport uint16_t
+from libc.stdlib cimport malloc, calloc, free, qsort
+from libc.string cimport memcmp, memset
 
 # This is a function pointer typedef for _factory_* methods
 # This allows us to use dynamic dispatch in C space rather than slow Python
-ctypedef object (*factory_method)(UMIFactory self, char* read, uint8_t length)
+ctypedef object (*factory_method)(UMIFactory self, char* read, size_t length)
 
 cdef class UMIFactory:
     cdef factory_method _factory
-    cdef uint8_t len_5p
-    cdef uint8_t len_3p
+    cdef readonly uint8_t len_5p
+    cdef readonly uint8_t len_3p
 
     cpdef object from_bytes(self, bytes read)
-    cdef inline object from_chars(self, char* read)
-    cdef inline object _factory_5p(self, char * read, uint8_t length)
-    cdef inline object _factory_3p(self, char * read, uint8_t length)
-    cdef inline object _factory_both(self, char * read, uint8_t length)
-
-# For encoding the seq field
-cdef uint64_t* _marshall_bytes_256(uint8_t* seq_bytes, uint8_t length)
+    cdef object from_chars(self, char* read, size_t length)
+    cdef object _factory_5p(self, char* read, size_t length)
+    cdef object _factory_3p(self, char* read, size_t length)
+    cdef object _factory_both(self, char* read, size_t length)
+    cdef int _fill(self, UMI obj, char* read, size_t length) except -1
 
 # For encoding each umi field
-cdef uint32_t pext_mask_32 = 0x06060606
-cdef uint32_t _marshall_bytes_32(uint8_t* seq_bytes, uint8_t length)
-
-# Reusable buffer for unmarshalling
-cdef char out_ascii_buffer_128[128]
+cdef size_t MAX_UMI_NT
+cdef uint32_t _marshall_bytes_32(uint8_t* seq_bytes, uint8_t length) except 0
 
 """
 ============================================================================
-!!! TODO (maybe). After writing the implementation... might be a better way.
->>> For now, the length is indicated by the `length` attribute <<<
 
-Seq:
-    Encoded length: Lower 8 bits of the first uint64_t indicate length
-    Max length: 252 bases (28 bases at seq[0]; 32 bases at seq[1:6])
+Seq (the insert between UMIs):
+    Packed into uint64_t blocks, exactly like ShortSeqVar, by _marshall_bytes_var()
+    Max length: MAX_VAR_NT bases, indicated by the `seq_len` attribute
 
-                uint64_t                    uint64_t       uint64_t
-    |--------------------------------| ==> |--------| ==> |--------| ==> ...
-    |-- NT Bases -----------|-length-|     |NT Bases|     |NT Bases|
+                uint64_t       uint64_t       uint64_t
+    |--------| ==> |--------| ==> |--------| ==> ...
+    |NT Bases|     |NT Bases|     |NT Bases|
 
 ============================================================================
 
@@ -50,15 +52,17 @@ UMI (each):
          uint32_t
     |----------------|
     |NT Bases |length|
-    
+
 ============================================================================
 """
 
 cdef class UMI:               # 16 bytes (PyObject head)
     cdef uint32_t umi[2]      # 8 bytes arr (fixed)
     cdef uint64_t *seq        # 8 bytes ptr (~stretchy~) + heap allocation
-    cdef uint8_t seq_len      # 1 byte (for now, may eventually encode)
-                              # Total: 33 bytes PLUS heap
+    cdef uint16_t seq_len     # 2 bytes (up to MAX_VAR_NT)
+                              # Total: 34 bytes PLUS heap
+
+    cdef Py_hash_t _hash(self) noexcept
 
 cdef class UMI5p(UMI):
     pass
@@ -67,4 +71,28 @@ cdef class UMI3p(UMI):
     pass
 
 cdef class UMIboth(UMI):
-    pass
\ No newline at end of file
+    pass
+
+
+"""
+Directional clustering. Each UMI is a node whose bases (5' then 3') are concatenated
+into a single integer. Nodes are sorted so that those sharing an insert are adjacent,
+in descending order of count. Within small groups, a node's neighbors at Hamming distance 1
+are found by popcount against every other node. Larger groups instead look up each of the
+node's single-base substitutions in a hash table of the group's nodes.
+"""
+
+ctypedef struct _UMINode:
+    PyObject* key                      # Borrowed reference to the UMI or sequence
+    uint64_t bases                     # 2 bits per base, first base lowest
+    uint64_t count
+    Py_hash_t group_hash               # Hash of the insert
+    PyTypeObject* type                 # The UMI subtype, or NULL for plain sequences
+    uint64_t* seq                      # The insert's packed blocks
+    uint16_t seq_len
+    uint8_t len_5p
+    uint8_t length                     # Total UMI length, in bases
+
+cdef object _cluster_directional(object counts, double ratio)
+cdef int _cluster_nodes(_UMINode* nodes, size_t n_nodes, double ratio, uint32_t* order, size_t* starts,
+                        size_t* n_clusters) noexcept nogil
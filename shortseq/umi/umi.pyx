@@ -1,44 +1,79 @@
 import cython
 import sys
 
-from cython.operator cimport dereference as deref, postincrement as inc
+from shortseq.fast_read import open_reader
+
+MAX_UMI_NT = 14
 
 cdef class UMI:
-    # All UMI subtypes hash by sequence
+    # All UMI subtypes hash by their UMIs and sequence
     # Deduplication then happens naturally via __eq__()
     def __hash__(self):
-        return deref(self.seq)
+        return self._hash()
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return False
+
+        return self.seq_len == (<UMI> other).seq_len and \
+               self.umi[0] == (<UMI> other).umi[0] and \
+               self.umi[1] == (<UMI> other).umi[1] and \
+               (self.seq_len == 0 or
+                memcmp(self.seq, (<UMI> other).seq, _nt_len_to_block_num(self.seq_len) * sizeof(uint64_t)) == 0)
+
+    @property
+    def umi_5p(self):
+        """The 5' UMI as a ShortSeq, or None if this type has no 5' UMI."""
+        return _unmarshall_umi(self.umi[0])
+
+    @property
+    def umi_3p(self):
+        """The 3' UMI as a ShortSeq, or None if this type has no 3' UMI."""
+        return _unmarshall_umi(self.umi[1])
+
+    @property
+    def insert(self):
+        """The sequence between the UMIs as a ShortSeq."""
+        return _from_packed(self.seq, self.seq_len)
+
+    def __len__(self):
+        return self.seq_len
+
+    def __str__(self):
+        return _unmarshall_str(self.seq, self.seq_len)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} ({self.umi_5p or ''}, {self.umi_3p or ''}): {self}>"
+
+    cdef Py_hash_t _hash(self) noexcept:
+        cdef uint64_t mixed = <uint64_t> _hash_blocks(self.seq, _nt_len_to_block_num(self.seq_len), self.seq_len)
+        mixed ^= (<uint64_t> self.umi[1] << 32) | self.umi[0]
+        return _hash_blocks(&mixed, 1, self.seq_len)
 
     def __dealloc__(self):
         if self.seq is not NULL:
-            PyObject_Free(<void *>self.seq)
+            _free_var_blocks(self.seq, _nt_len_to_block_num(self.seq_len))
 
 cdef class UMI5p(UMI):
-    def __eq__(self, UMI5p other):
-        return self.length == other.length and \
-               self.umi[0] == other.umi[0] and \
-               deref(self.seq) == deref(other.seq)
-
-    def __str__(self): return super().__str__()
+    pass
 
 cdef class UMI3p(UMI):
-    def __eq__(self, UMI3p other):
-        return self.length == other.length and \
-               self.umi[1] == other.umi[1] and \
-               deref(self.seq) == deref(other.seq)
+    pass
 
 cdef class UMIboth(UMI):
-    def __eq__(self, UMIboth other):
-        return self.length == other.length and \
-               self.umi[0] == other.umi[0] and \
-               self.umi[1] == other.umi[1] and \
-               deref(self.seq) == deref(other.seq)
+    pass
 
 
 cdef class UMIFactory:
-    def __init__(self, **kwargs):
-        self.len_5p = len_5p = kwargs.get('len_5p', 0)  # Default init arg support is currently still an alpha feature
-        self.len_3p = len_3p = kwargs.get('len_3p', 0)
+    """Splits reads into their UMI(s) and the insert between them. Reads are packed
+    directly from their bytes; UMIs are held inline and the insert on the heap."""
+
+    def __init__(self, size_t len_5p=0, size_t len_3p=0):
+        if len_5p > MAX_UMI_NT or len_3p > MAX_UMI_NT:
+            raise Exception(f"UMIs longer than {MAX_UMI_NT} bases are not supported.")
+
+        self.len_5p = len_5p
+        self.len_3p = len_3p
 
         if len_5p and len_3p:
             self._factory = self._factory_both
@@ -50,88 +85,327 @@ cdef class UMIFactory:
             raise Exception("At least one UMI length is required.")
 
     cpdef object from_bytes(self, bytes read):
-        cdef char* read_chars = deref(<PyBytesObject *> read).ob_sval
-        cdef uint8_t length = Py_SIZE(read_chars)
+        cdef char* read_chars = PyBytes_AS_STRING(read)
+        cdef size_t length = Py_SIZE(read)
         return self._factory(self, read_chars, length)
 
-    cdef inline object from_chars(self, char* read):
-        cdef uint8_t length = strlen(read) - 1  # omit newline char
+    cdef inline object from_chars(self, char* read, size_t length):
         return self._factory(self, read, length)
 
-    cdef inline object _factory_5p(self, char* read, uint8_t length):
+    cdef inline object _factory_5p(self, char* read, size_t length):
         cdef UMI5p obj = UMI5p.__new__(UMI5p)
-        obj.seq = _marshall_bytes_256(<uint8_t *>read, length)
-        obj.umi[0] = 0
+        self._fill(obj, read, length)
         return obj
 
-    cdef inline object _factory_3p(self, char * read, uint8_t length):
+    cdef inline object _factory_3p(self, char * read, size_t length):
         cdef UMI3p obj = UMI3p.__new__(UMI3p)
-        obj.seq = _marshall_bytes_256(<uint8_t *>read, length)
-        obj.umi[1] = 0
+        self._fill(obj, read, length)
         return obj
 
-    cdef inline object _factory_both(self, char * read, uint8_t length):
+    cdef inline object _factory_both(self, char * read, size_t length):
         cdef UMIboth obj = UMIboth.__new__(UMIboth)
-        obj.seq = _marshall_bytes_256(<uint8_t *>read, length)
-        obj.umi[0] = 0
-        obj.umi[1] = 0
+        self._fill(obj, read, length)
         return obj
 
-cdef uint64_t pext_mask_64 = 0x0606060606060606
-cdef inline uint64_t* _marshall_bytes_256(uint8_t* seq_bytes, uint8_t length):
+    cdef inline int _fill(self, UMI obj, char* read, size_t length) except -1:
+        cdef size_t seq_len
+
+        if length < self.len_5p + self.len_3p:
+            raise Exception(f"Read of length {length} is shorter than its UMIs ({self.len_5p} + {self.len_3p} nt).")
+
+        seq_len = length - self.len_5p - self.len_3p
+        if seq_len > MAX_VAR_NT:
+            raise Exception(f"Inserts longer than {MAX_VAR_NT} bases are not supported.")
+
+        if self.len_5p:
+            obj.umi[0] = _marshall_bytes_32(<uint8_t *> read, self.len_5p)
+        if self.len_3p:
+            obj.umi[1] = _marshall_bytes_32(<uint8_t *> read + length - self.len_3p, self.len_3p)
+
+        obj.seq = _marshall_bytes_var(<uint8_t *> read + self.len_5p, seq_len)
+        obj.seq_len = <uint16_t> seq_len
+        return 0
+
+
+def dedup_fastq(object path, size_t len_5p=0, size_t len_3p=0, size_t threads=1, bint mmap=False,
+                bint directional=False, double ratio=2):
+    """Deduplicates the reads of a FASTQ file by their UMI(s) and insert in a single pass.
+    Each read is packed straight from the reader's buffer, so only unique reads are held
+    in memory.
+
+    Args:
+        path: The path to a plain, gzip, or BGZF compressed FASTQ file.
+        len_5p: The length of the UMI at the start of each read, if any.
+        len_3p: The length of the UMI at the end of each read, if any.
+        threads: The number of threads to use for inflating BGZF blocks.
+        mmap: If True, an uncompressed file is memory mapped rather than streamed.
+        directional: If True, UMIs that share an insert are also collapsed by
+            cluster_directional(), so that UMIs arising from sequencing errors are
+            counted with the UMI they arose from.
+        ratio: The count ratio for directional clustering.
+
+    Returns:
+        A dict of each unique UMI object to the number of reads that carried it. With
+        directional clustering, each cluster's most abundant UMI is mapped to the total
+        number of reads in its cluster.
+    """
+
     cdef:
-        uint64_t* sequence = reinterpret_cast[llstr](seq_bytes)
-        uint8_t num_blocks = <uint8_t>ceil(length / 32)
-        uint8_t block_overhang = <uint8_t>ceil((length % 32) / 8)   # In units of pext (
-        uint8_t pext_overhang = length % 8
-        uint8_t i, j
-        uint64_t* hashed = <llstr>PyObject_Calloc(num_blocks, 8)
+        UMIFactory factory = UMIFactory(len_5p, len_3p)
+        SeqReader reader = open_reader(path, "fastq", threads, mmap)
+        dict counts = {}
+        PyObject* oldval
+        Py_hash_t umihash
+        char* seqchars
+        size_t length
+        UMI obj
+
+    while reader.next_seq(&seqchars, &length):
+        obj = <UMI> factory._factory(factory, seqchars, length)
+        umihash = obj._hash()
+        oldval = _PyDict_GetItem_KnownHash(counts, obj, umihash)
+
+        if oldval == NULL:
+            if PyErr_Occurred():
+                raise Exception("Something went wrong while retrieving UMI count.")
+            if _PyDict_SetItem_KnownHash(counts, obj, 1, umihash) < 0:
+                raise Exception("Something went wrong while setting a new UMI count.")
+        else:
+            if _PyDict_SetItem_KnownHash(counts, obj, <object> oldval + 1, umihash) < 0:
+                raise Exception("Something went wrong while setting an incremented UMI count.")
+
+    if directional:
+        return {cluster[0]: sum([counts[umi] for umi in cluster]) for cluster in _cluster_directional(counts, ratio)}
+    return counts
+
+
+def cluster_directional(object counts, double ratio=2):
+    """Clusters UMIs with the directional adjacency method. An edge is drawn from UMI a
+    to UMI b if they differ by a single base and count(a) >= ratio * count(b) - 1. Starting
+    from the most abundant UMI, each cluster holds every UMI that is reachable along these
+    edges and not already in a previous cluster.
+
+    UMIs only cluster with others that share their insert and UMI lengths, so counts from
+    dedup_fastq() are clustered per insert. Distances are taken between packed UMIs by
+    popcount, and in large groups neighbors are found by hashing each single-base
+    substitution rather than by comparing all pairs.
+
+    Args:
+        counts: A mapping of UMI objects, or of UMI sequences (str, bytes, or ShortSeq
+            of up to 32 bases), to their counts.
+        ratio: The count ratio required for an edge. The default matches UMI-tools.
+
+    Returns:
+        A list of clusters, each a list of keys of counts with its most abundant UMI first.
+    """
 
-    if hashed is NULL:
-        PyErr_NoMemory()
-        return NULL
+    return _cluster_directional(counts, ratio)
 
-    if num_blocks > 1:
-        print("bang")
 
-    for i in range(0, length // 8, 4):
-        block = 0LL
-        for j in reversed(range(i, (i + 4))):
-            block = (block << 16) | _pext_u64(sequence[j], pext_mask_64)
+cdef inline uint32_t _marshall_bytes_32(uint8_t* seq_bytes, uint8_t length) except 0:
+    """Encodes a UMI of up to MAX_UMI_NT bases, with its length in the lower 4 bits."""
 
-        hashed[i // 4] = block
+    return <uint32_t> (_marshall_partial_block(seq_bytes, length) << 4) | length
 
-    if block_overhang:
-        i += 4
-        block_idx = i // 4
-        for j in range(i, i + block_overhang):
-            hashed[block_idx] = (hashed[block_idx] << 16) | _pext_u64(sequence[j], pext_mask_64)
 
-    if pext_overhang:
-        # Mask lower n bits (n = 2 * pext_overhang)
-        # This is making me rethink the benefits of using pext for the last lil bit...
-        hashed[block_idx] &= (1 << pext_overhang * 2) - 1
+cdef inline object _unmarshall_umi(uint32_t umi):
+    cdef uint64_t block = umi >> 4
+    return _from_packed(&block, umi & 0xF) if umi else None
 
-    for i in range(num_blocks):
-        printbin(f"Block {i}: ", hashed[i], 64, 2)
 
-    return hashed
+cdef object _cluster_directional(object counts, double ratio):
+    cdef:
+        size_t n_nodes = len(counts)
+        _UMINode* nodes = <_UMINode *> calloc(max(n_nodes, 1), sizeof(_UMINode))
+        uint32_t* order = <uint32_t *> malloc(max(n_nodes, 1) * sizeof(uint32_t))
+        size_t* starts = <size_t *> malloc((n_nodes + 1) * sizeof(size_t))
+        list keys = []
+        size_t n_clusters = 0, i = 0, c
+        _UMINode* node
+        uint64_t* blocks
+        size_t length
+        int status
+        UMI obj
+
+    try:
+        if nodes is NULL or order is NULL or starts is NULL:
+            raise MemoryError("Error while allocating UMI clustering nodes.")
+        if n_nodes >= 0xFFFFFFFF:
+            raise Exception("Too many UMIs to cluster at once.")
+
+        for key, count in counts.items():
+            if count < 1:
+                raise Exception(f"UMI counts must be positive (got {count} for {key!r}).")
+
+            node = &nodes[i]
+            node.count = count
+            if isinstance(key, UMI):
+                obj = <UMI> key
+                node.len_5p = obj.umi[0] & 0xF
+                node.length = node.len_5p + (obj.umi[1] & 0xF)
+                node.bases = (<uint64_t> (obj.umi[1] >> 4) << (2 * node.len_5p)) | (obj.umi[0] >> 4)
+                node.seq, node.seq_len = obj.seq, obj.seq_len
+                node.type = Py_TYPE(key)
+                node.group_hash = _hash_blocks(obj.seq, _nt_len_to_block_num(obj.seq_len), obj.seq_len)
+            else:
+                seq = pack(key)
+                blocks = _packed_blocks(seq, &length)
+                if length > MAX_64_NT:
+                    raise Exception(f"UMIs longer than {MAX_64_NT} bases are not supported (got {key!r}).")
+                node.length = length
+                node.bases = blocks[0] if length else 0
 
-cdef inline uint32_t _marshall_bytes_32(uint8_t* seq_bytes, uint8_t length):
-    cdef uint32_t* sequence = reinterpret_cast[istr](seq_bytes)
-    cdef uint32_t hashed = _pext_u32(sequence[0], pext_mask_32)
+            node.key = <PyObject *> key
+            keys.append(key)               # Keeps keys alive if the mapping creates them on the fly
+            i += 1
 
-    # hashed >>= (16 - length) * 2
-    hashed &= (1 << ((16 - length) * 2)) - 1
-    hashed = (hashed << 4) | length
+        with nogil:
+            status = _cluster_nodes(nodes, n_nodes, ratio, order, starts, &n_clusters)
+        if status < 0:
+            raise MemoryError("Error while allocating UMI clustering tables.")
 
-    return hashed
+        return [[<object> nodes[order[i]].key for i in range(starts[c], starts[c + 1])]
+                for c in range(n_clusters)]
+    finally:
+        free(nodes)
+        free(order)
+        free(starts)
+
+
+cdef int _cluster_nodes(_UMINode* nodes, size_t n_nodes, double ratio, uint32_t* order, size_t* starts,
+                        size_t* n_clusters) noexcept nogil:
+    """Writes the node indices of each cluster to order, and the offset in order at which
+    each cluster starts to starts (plus the end offset). Returns -1 if memory couldn't be
+    allocated."""
 
-cdef inline unicode _unmarshall_bytes_256(uint64_t* enc_seq, uint8_t length):
     cdef:
-        uint8_t full_blocks = <uint8_t> floor(length / 32)
-        uint8_t i, j
+        uint32_t* table = NULL
+        uint8_t* found = <uint8_t *> calloc(max(n_nodes, 1), sizeof(uint8_t))
+        size_t start = 0, stop, mask, head, tail, u, j, pos
+        uint64_t variant, delta
+        Py_ssize_t v
+        bint hashed
+        _UMINode* group
+
+    if found is NULL:
+        return -1
+
+    qsort(nodes, n_nodes, sizeof(_UMINode), _cmp_nodes)
+    n_clusters[0] = 0
+    tail = 0
+
+    while start < n_nodes:
+        stop = start + 1
+        while stop < n_nodes and _cmp_groups(&nodes[start], &nodes[stop]) == 0:
+            stop += 1
+
+        group = nodes + start
+        mask = 1
+        while mask < 2 * (stop - start): mask <<= 1
+        mask -= 1
+
+        # Each node has 3 * length substitutions to look up, versus (stop - start) comparisons
+        hashed = stop - start > 3 * nodes[start].length
+        if hashed:
+            table = <uint32_t *> calloc(mask + 1, sizeof(uint32_t))
+            if table is NULL:
+                free(found)
+                return -1
+            for j in range(stop - start):
+                _table_insert(table, mask, group[j].bases, j)
+
+        for j in range(start, stop):
+            if found[j]: continue
+
+            # Breadth-first search along directed edges from the most abundant unclustered UMI
+            starts[n_clusters[0]] = tail
+            n_clusters[0] += 1
+            found[j] = 1
+            order[tail] = j
+            head, tail = tail, tail + 1
+
+            while head < tail:
+                u = order[head] - start
+                head += 1
+                if not hashed:
+                    for v in range(stop - start):
+                        if (not found[start + v] and _hamming_blocks(&group[u].bases, &group[v].bases, 1) == 1 and
+                                group[u].count + 1 >= ratio * group[v].count):
+                            found[start + v] = 1
+                            order[tail] = start + v
+                            tail += 1
+                    continue
+
+                for pos in range(group[u].length):
+                    for delta in range(1, 4):
+                        variant = group[u].bases ^ (delta << (2 * pos))
+                        v = _table_find(table, mask, group, variant)
+                        if v >= 0 and not found[start + v] and group[u].count + 1 >= ratio * group[v].count:
+                            found[start + v] = 1
+                            order[tail] = start + v
+                            tail += 1
+
+        free(table)
+        table = NULL
+        start = stop
+
+    starts[n_clusters[0]] = tail
+    free(found)
+    return 0
+
+
+cdef inline size_t _mix(uint64_t bases) noexcept nogil:
+    bases ^= bases >> 33
+    bases *= 0xFF51AFD7ED558CCDULL
+    bases ^= bases >> 33
+    return <size_t> bases
+
+
+cdef inline void _table_insert(uint32_t* table, size_t mask, uint64_t bases, size_t index) noexcept nogil:
+    cdef size_t i = _mix(bases) & mask
+
+    while table[i]:
+        i = (i + 1) & mask
+    table[i] = <uint32_t> index + 1
+
+
+cdef inline Py_ssize_t _table_find(uint32_t* table, size_t mask, _UMINode* group, uint64_t bases) noexcept nogil:
+    """Returns the index of the group's node with these bases, or -1."""
+
+    cdef size_t i = _mix(bases) & mask
+
+    while table[i]:
+        if group[table[i] - 1].bases == bases:
+            return table[i] - 1
+        i = (i + 1) & mask
+    return -1
+
+
+cdef int _cmp_groups(const _UMINode* a, const _UMINode* b) noexcept nogil:
+    if a.group_hash != b.group_hash:
+        return -1 if a.group_hash < b.group_hash else 1
+    if a.type != b.type:
+        return -1 if <size_t> a.type < <size_t> b.type else 1
+    if a.len_5p != b.len_5p:
+        return -1 if a.len_5p < b.len_5p else 1
+    if a.length != b.length:
+        return -1 if a.length < b.length else 1
+    if a.seq_len != b.seq_len:
+        return -1 if a.seq_len < b.seq_len else 1
+    if a.seq_len == 0:
+        return 0
+    return memcmp(a.seq, b.seq, _nt_len_to_block_num(a.seq_len) * sizeof(uint64_t))
+
+
+cdef int _cmp_nodes(const void* pa, const void* pb) noexcept nogil:
+    """Orders nodes by group, then by descending count, then by bases."""
+
+    cdef const _UMINode* a = <const _UMINode *> pa
+    cdef const _UMINode* b = <const _UMINode *> pb
+    cdef int cmp = _cmp_groups(a, b)
 
-    for i in range(full_blocks):
-        # for j in range()
-        pass
\ No newline at end of file
+    if cmp:
+        return cmp
+    if a.count != b.count:
+        return -1 if a.count > b.count else 1
+    return (a.bases > b.bases) - (a.bases < b.bases)
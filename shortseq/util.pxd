@@ -1,6 +1,6 @@
 from libc.stdint cimport uint8_t, uint32_t, uint64_t
 from libc.stddef cimport size_t
-from libc.string cimport strlen
+from libc.string cimport strlen, memcpy
 from libc.math cimport ceil
 from libcpp.cast cimport reinterpret_cast
 
@@ -8,7 +8,7 @@ from cpython.mem cimport PyObject_Calloc, PyObject_Free
 from cpython.object cimport Py_SIZE, PyObject
 from cpython.ref cimport Py_XDECREF, Py_XINCREF
 from cpython.slice cimport PySlice_GetIndicesEx, PySlice_AdjustIndices
-from cpython.unicode cimport PyUnicode_DecodeASCII
+from cpython.unicode cimport PyUnicode_DecodeASCII, PyUnicode_New, PyUnicode_DATA
 
 # For Cython, this is necessary when using these types in brackets (reinterpret_cast)
 ctypedef uint64_t* llstr
@@ -39,6 +39,13 @@ portion of the table ends up in a cache line). Supports A,T,U,G,C.
 """
 cdef uint8_t[91] table_91
 
+"""
+This is used for decoding 2-bit form to ASCII four bases at a time. Indices are
+a byte of a packed block, and table values hold the ASCII of its four bases in
+memory order. Built on import from charmap.
+"""
+cdef uint32_t[256] quad_table
+
 """
 Useful for quick access to ob_sval without interacting with the CPython API
 """
@@ -49,26 +56,72 @@ ctypedef struct PyBytesObject:
     char ob_sval[1]
 
 """
-For SIMD operations. 
+Encoding, decoding, and bit manipulation kernels. Each is built in several variants
+(see kernels.h), and the fastest that the CPU supports is selected at import into
+`kernels`, which is shared by every module. Instructions beyond the x86-64 baseline
+(popcnt, pext) are only used once the CPU is known to support them.
 """
-cdef extern from "x86intrin.h" nogil:
-    # SSE4.2
-    uint64_t _popcnt64(uint64_t __X)
-
-    # BMI2
-    uint64_t _pext_u64 (uint64_t __X, uint64_t __Y)
-    uint32_t _pext_u32 (uint32_t __X, uint32_t __Y)
-    uint64_t _bzhi_u64(uint64_t __X, uint32_t __Y)
+cdef extern from "kernels.h" nogil:
+    ctypedef size_t (*encode_kernel "ss_encode_kernel")(uint64_t* dst, uint8_t* src, size_t n_blocks)
+    ctypedef void (*decode_kernel "ss_decode_kernel")(char* dst, uint64_t* blocks, size_t length)
+
+    uint64_t _bzhi_u64 "ss_bzhi_u64" (uint64_t x, uint32_t n)
+    uint64_t _popcnt64_hw "ss_popcnt64_hw" (uint64_t x)
+    uint64_t _popcnt64_sw "ss_popcnt64_sw" (uint64_t x)
+    uint64_t _pext_u64 "ss_pext_u64_hw" (uint64_t x, uint64_t mask)
+    uint64_t _compress_lanes_sw "ss_compress_lanes" (uint64_t x)
+
+ctypedef struct Kernels:
+    const char* name
+    encode_kernel encode               # Validates and encodes full blocks
+    decode_kernel decode
+    bint popcnt                        # The popcnt instruction may be used
+    bint pext                          # The pext instruction may be used (and is fast)
+
+cdef Kernels kernels
+
+cdef inline uint64_t _popcnt64(uint64_t x) noexcept nogil:
+    return _popcnt64_hw(x) if kernels.popcnt else _popcnt64_sw(x)
+
+"""Gathers the low bit of each 2-bit lane of x into its low 32 bits."""
+cdef inline uint64_t _compress_lanes(uint64_t x) noexcept nogil:
+    return _pext_u64(x, 0x5555555555555555ULL) if kernels.pext else _compress_lanes_sw(x)
+
+cdef extern from * nogil:
+    # GCC/Clang builtins
+    uint64_t __builtin_bswap64(uint64_t x)
+    uint32_t __builtin_bswap32(uint32_t x)
+    int __builtin_ctzll(unsigned long long x)
 
 """
-A little bit of hackery to allow fast access to the packed hash field of both
-ShortSeq64 and ShortSeq192, since inheritance and virtual function emulation
-come with a heavy cost in Cython.
+POSIX threads, for native pipelines and kernels that run without the GIL
 """
-ctypedef struct ShortSeqGeneric:
-    PyObject ob_base
-    uint64_t _packed
-
+cdef extern from "<pthread.h>" nogil:
+    ctypedef struct pthread_t:
+        pass
+    ctypedef struct pthread_attr_t:
+        pass
+    ctypedef struct pthread_mutex_t:
+        pass
+    ctypedef struct pthread_mutexattr_t:
+        pass
+    ctypedef struct pthread_cond_t:
+        pass
+    ctypedef struct pthread_condattr_t:
+        pass
+
+    int pthread_create(pthread_t* thread, const pthread_attr_t* attr, void* (*start)(void*) noexcept nogil, void* arg)
+    int pthread_join(pthread_t thread, void** retval)
+
+    int pthread_mutex_init(pthread_mutex_t* mutex, const pthread_mutexattr_t* attr)
+    int pthread_mutex_destroy(pthread_mutex_t* mutex)
+    int pthread_mutex_lock(pthread_mutex_t* mutex)
+    int pthread_mutex_unlock(pthread_mutex_t* mutex)
+
+    int pthread_cond_init(pthread_cond_t* cond, const pthread_condattr_t* attr)
+    int pthread_cond_destroy(pthread_cond_t* cond)
+    int pthread_cond_wait(pthread_cond_t* cond, pthread_mutex_t* mutex)
+    int pthread_cond_broadcast(pthread_cond_t* cond)
 
 cpdef inline printbin(header, value, value_bitwidth, chunk_bitwidth):
     """Convenience function for printing any size integer as zero-padded
@@ -137,6 +190,48 @@ cdef inline bint is_array_equal(uint64_t* a, uint64_t* b, size_t length) nogil:
     return True
 
 
+"""
+Hashes a packed sequence by mixing all of its blocks and its length. Sequences that
+share a long prefix, or that differ only in trailing A's, therefore hash differently.
+Each block is folded in with a multiply-xorshift step, and the result is finalized
+with MurmurHash3's fmix64 so that the low bits used by dict probing are well mixed.
+"""
+cdef inline Py_hash_t _hash_blocks(uint64_t* blocks, size_t n_blocks, size_t length) noexcept nogil:
+    cdef uint64_t h = (length + 1) * 0x9E3779B97F4A7C15ULL
+    cdef size_t i
+
+    for i in range(n_blocks):
+        h = (h ^ blocks[i]) * 0xBF58476D1CE4E5B9ULL
+        h ^= h >> 31
+
+    h ^= h >> 33
+    h *= 0xFF51AFD7ED558CCDULL
+    h ^= h >> 33
+    h *= 0xC4CEB9FE1A85EC53ULL
+    h ^= h >> 33
+
+    # -1 is reserved for errors by tp_hash
+    return -2 if <Py_hash_t> h == -1 else <Py_hash_t> h
+
+
+"""
+Counts mismatched bases between two packed sequences of the same length. Bases
+that differ XOR to 0b01, 0b10, or 0b11, so each 2-bit lane is collapsed into its
+low bit before counting. Unused bits of the final block are always zero.
+"""
+cdef inline size_t _hamming_blocks(uint64_t* a, uint64_t* b, size_t n_blocks) noexcept nogil:
+    cdef uint64_t comp
+    cdef size_t pop_cnt = 0
+    cdef size_t i
+
+    for i in range(n_blocks):
+        comp = a[i] ^ b[i]
+        comp = ((comp >> 1) | comp) & 0x5555555555555555ULL
+        pop_cnt += _popcnt64(comp)
+
+    return pop_cnt
+
+
 """
 Performs euclidean division and remainder and returns the result as a pair.
 This is essentially the C version of Python's divmod function. Note that
@@ -169,3 +264,59 @@ cdef void _marshall_full_blocks(uint64_t* dst, uint8_t* sequence, size_t n_block
 
 """Encodes less than 32 nucleotides into a uint64_t block."""
 cdef uint64_t _marshall_partial_block(uint8_t * sequence, size_t length) nogil
+
+
+"""Encodes a sequence of nucleotides into an existing array of uint64_t blocks without raising.
+Returns False if the sequence contains an unsupported base, in which case dst is incomplete."""
+cdef bint _pack_bytes_array(uint64_t* dst, uint8_t* src, size_t length) noexcept nogil
+
+
+"""
+Reverse complements a single full block. Complementing is an XOR of each base with
+0b10 (A <-> T, C <-> G), and reversal swaps bytes, then nibbles and base pairs in each byte.
+"""
+cdef inline uint64_t _revcomp_block(uint64_t block) noexcept nogil:
+    block = __builtin_bswap64(block)
+    block = ((block >> 4) & 0x0F0F0F0F0F0F0F0FULL) | ((block & 0x0F0F0F0F0F0F0F0FULL) << 4)
+    block = ((block >> 2) & 0x3333333333333333ULL) | ((block & 0x3333333333333333ULL) << 2)
+    return block ^ 0xAAAAAAAAAAAAAAAAULL
+
+
+"""Writes the reverse complement of a packed sequence to dst, which must not overlap src."""
+cdef void _revcomp_blocks(uint64_t* dst, uint64_t* src, size_t length) noexcept nogil
+
+
+"""Compares two packed sequences of the same length in alphabetical (ACGT) order, returning -1, 0, or 1."""
+cdef int _lex_cmp_blocks(uint64_t* a, uint64_t* b, size_t n_blocks) noexcept nogil
+
+
+"""Compares two blocks as above. T (0b10) and G (0b11) trade places to rank bases alphabetically."""
+cdef inline int _lex_cmp_block(uint64_t a, uint64_t b) noexcept nogil:
+    cdef uint64_t x, y
+    cdef size_t pos
+
+    if a == b:
+        return 0
+
+    pos = __builtin_ctzll(a ^ b) & ~1                           # First differing base
+    x = (a >> pos) & 0b11
+    y = (b >> pos) & 0b11
+    return -1 if (x ^ (x >> 1)) < (y ^ (y >> 1)) else 1
+
+
+"""Returns whichever of the sequence and its reverse complement comes first alphabetically.
+The reverse complement is written to scratch, which must hold the sequence's blocks."""
+cdef uint64_t* _canonical_blocks(uint64_t* blocks, size_t length, uint64_t* scratch) noexcept nogil
+
+
+"""Decodes a packed sequence into length ASCII characters at dst. Safe to call without the GIL."""
+cdef void _unmarshall_blocks(char* dst, uint64_t* blocks, size_t length) noexcept nogil
+
+
+"""Decodes a packed sequence directly into a new str, without an intermediate buffer."""
+cdef inline unicode _unmarshall_str(uint64_t* blocks, size_t length):
+    cdef unicode out = PyUnicode_New(length, 127)
+
+    if length:
+        _unmarshall_blocks(<char *> PyUnicode_DATA(out), blocks, length)
+    return out
@@ -1,3 +1,4 @@
+import os
 import cython
 
 @cython.cdivision(True)
@@ -51,6 +52,19 @@ cdef uint8_t[91] table_91 = [
 
 cdef char[4] charmap = [b'A', b'C', b'T', b'G']
 
+cdef uint32_t[256] quad_table
+
+cdef void _init_quad_table():
+    cdef uint8_t* chars
+    cdef size_t i, j
+
+    for i in range(256):
+        chars = <uint8_t *> &quad_table[i]
+        for j in range(4):
+            chars[j] = charmap[(i >> (j * 2)) & 0b11]
+
+_init_quad_table()
+
 """ To create the bloom filter:
 lc_bases = 'atgc'
 uc_bases = 'ATGC'
@@ -101,22 +115,19 @@ cdef inline void _marshall_full_blocks(uint64_t* dst, uint8_t* sequence, size_t
     """Encodes n_blocks of 32 nucleotides into the destination uint64_t array."""
 
     cdef:
-        uint64_t * chunk_iter = reinterpret_cast[llstr](sequence)
+        size_t bad = kernels.encode(dst, sequence, n_blocks)
+        uint64_t * chunk_iter = reinterpret_cast[llstr](sequence + bad * NT_PER_BLOCK)
         cdef char* nonbase_ptr
-        uint64_t block
-        size_t i, j
+        uint64_t chunk
+        size_t j
 
-    for i in range(n_blocks):
-        block = 0ULL
-        for j in reversed(range(4)):
+    if bad < n_blocks:
+        # Report the 8 characters of the block that include the first unsupported base
+        for j in range(4):
             chunk = chunk_iter[j]
-            if not _bloom_filter_64(chunk):
-                nonbase_ptr = reinterpret_cast[cstr](&chunk)
-                raise Exception(f"Unsupported base character: {PyUnicode_DecodeASCII(nonbase_ptr, 8, NULL)}")
-            block = (block << 16) | _pext_u64(chunk, pext_mask_64)
-
-        dst[i] = block
-        chunk_iter += 4
+            if not _bloom_filter_64(chunk): break
+        nonbase_ptr = reinterpret_cast[cstr](&chunk)
+        raise Exception(f"Unsupported base character: {PyUnicode_DecodeASCII(nonbase_ptr, 8, NULL)}")
 
 
 @cython.wraparound(False)
@@ -138,3 +149,195 @@ cdef inline uint64_t _marshall_partial_block(uint8_t * sequence, size_t length)
         block = (block << 2) | table_91[seq_char]
 
     return block
+
+
+@cython.wraparound(False)
+@cython.cdivision(True)
+@cython.boundscheck(False)
+cdef inline bint _pack_bytes_array(uint64_t* dst, uint8_t* src, size_t length) noexcept nogil:
+    """Encodes a sequence of nucleotides into an existing array of uint64_t blocks without raising.
+    This allows sequences to be packed on threads that don't hold the GIL.
+
+    Returns:
+        False if the sequence contains an unsupported base, in which case dst is incomplete.
+    """
+
+    cdef:
+        size_t full_blocks = length // NT_PER_BLOCK
+        size_t rem = length % NT_PER_BLOCK
+        uint64_t block
+        uint8_t seq_char
+        size_t i
+
+    if kernels.encode(dst, src, full_blocks) < full_blocks:
+        return False
+
+    if rem:
+        src += NT_PER_BLOCK * full_blocks
+        block = 0ULL
+        for i in reversed(range(rem)):
+            seq_char = src[i]
+            if not is_base(seq_char):
+                return False
+            block = (block << 2) | table_91[seq_char]
+
+        dst[full_blocks] = block
+
+    return True
+
+
+cdef void _revcomp_blocks(uint64_t* dst, uint64_t* src, size_t length) noexcept nogil:
+    cdef:
+        size_t n_blocks = _nt_len_to_block_num(length)
+        size_t shift = (n_blocks * NT_PER_BLOCK - length) * 2
+        size_t i
+
+    # Reversing whole blocks leaves the final block's padding at the front...
+    for i in range(n_blocks):
+        dst[i] = _revcomp_block(src[n_blocks - 1 - i])
+
+    # ... so shift it out across block boundaries
+    if shift:
+        for i in range(n_blocks - 1):
+            dst[i] = (dst[i] >> shift) | (dst[i + 1] << (64 - shift))
+        dst[n_blocks - 1] >>= shift
+
+
+cdef int _lex_cmp_blocks(uint64_t* a, uint64_t* b, size_t n_blocks) noexcept nogil:
+    cdef size_t i
+
+    for i in range(n_blocks):
+        if a[i] != b[i]:
+            return _lex_cmp_block(a[i], b[i])
+
+    return 0
+
+
+cdef uint64_t* _canonical_blocks(uint64_t* blocks, size_t length, uint64_t* scratch) noexcept nogil:
+    if length == 0:
+        return blocks
+
+    _revcomp_blocks(scratch, blocks, length)
+    if _lex_cmp_blocks(blocks, scratch, _nt_len_to_block_num(length)) <= 0:
+        return blocks
+    return scratch
+
+
+cdef void _unmarshall_blocks(char* dst, uint64_t* blocks, size_t length) noexcept nogil:
+    kernels.decode(dst, blocks, length)
+
+
+cdef void _unmarshall_quads(char* dst, uint64_t* blocks, size_t length) noexcept nogil:
+    """Each byte of a block holds four bases, first base in the low bits, so bytes are
+    decoded in memory order with one table lookup apiece."""
+
+    cdef:
+        uint8_t* src = <uint8_t *> blocks
+        size_t n_quads = length // 4
+        size_t i
+
+    for i in range(n_quads):
+        memcpy(dst + i * 4, &quad_table[src[i]], 4)
+
+    for i in range(n_quads * 4, length):
+        dst[i] = charmap[(src[n_quads] >> ((i % 4) * 2)) & 0b11]
+
+
+"""
+Kernel selection. Variants are listed from slowest to fastest, and the fastest that the
+CPU supports is selected at import unless the SHORTSEQ_KERNELS environment variable names
+another. AMD processors prior to Zen 3 implement pext in microcode, so the avx2 variant
+uses pext only where BMI2 is supported and fast.
+"""
+
+cdef extern from "kernels.h" nogil:
+    size_t ss_encode_portable(uint64_t* dst, uint8_t* src, size_t n_blocks)
+    size_t ss_encode_swar(uint64_t* dst, uint8_t* src, size_t n_blocks)
+    size_t ss_encode_sse42(uint64_t* dst, uint8_t* src, size_t n_blocks)
+    size_t ss_encode_avx2(uint64_t* dst, uint8_t* src, size_t n_blocks)
+    void ss_decode_portable(char* dst, uint64_t* blocks, size_t length)
+    void ss_decode_sse42(char* dst, uint64_t* blocks, size_t length)
+    void ss_decode_avx2(char* dst, uint64_t* blocks, size_t length)
+
+    int ss_cpu_features()
+    enum:
+        SS_CPU_SSE42
+        SS_CPU_POPCNT
+        SS_CPU_AVX2
+        SS_CPU_BMI2
+        SS_CPU_SLOW_PEXT
+
+KERNEL_VARIANTS = ("portable", "swar", "sse4.2", "avx2")
+"""The kernel variants, from slowest to fastest."""
+
+cdef int _cpu = ss_cpu_features()
+cdef Kernels kernels
+
+
+cdef int _required_features(str name):
+    if name == "sse4.2":
+        return SS_CPU_SSE42 | SS_CPU_POPCNT
+    elif name == "avx2":
+        return SS_CPU_SSE42 | SS_CPU_POPCNT | SS_CPU_AVX2
+    return 0
+
+
+def available_kernels():
+    """Returns the names of the kernel variants that this CPU supports."""
+
+    return [name for name in KERNEL_VARIANTS if _cpu & _required_features(name) == _required_features(name)]
+
+
+def cpu_features():
+    """Returns the CPU features that are relevant to kernel selection."""
+
+    return {
+        "sse4.2": bool(_cpu & SS_CPU_SSE42),
+        "popcnt": bool(_cpu & SS_CPU_POPCNT),
+        "avx2": bool(_cpu & SS_CPU_AVX2),
+        "bmi2": bool(_cpu & SS_CPU_BMI2),
+        "slow_pext": bool(_cpu & SS_CPU_SLOW_PEXT),
+    }
+
+
+def get_kernels():
+    """Returns the name of the active kernel variant."""
+
+    return kernels.name.decode()
+
+
+def set_kernels(str name=None):
+    """Selects a kernel variant by name, or the fastest that the CPU supports if name is None.
+    Results are identical for every variant, so this is mainly useful for benchmarking.
+    It shouldn't be called while other threads are packing or decoding sequences."""
+
+    global kernels
+    cdef Kernels k
+
+    if name is None:
+        available = available_kernels()
+        if "avx2" in available:
+            name = "avx2"
+        elif "sse4.2" in available:
+            name = "sse4.2"
+        else:
+            name = "swar"
+    elif name not in KERNEL_VARIANTS:
+        raise ValueError(f"Unknown kernel variant: {name!r}. Expected one of {list(KERNEL_VARIANTS)}.")
+    elif name not in available_kernels():
+        raise ValueError(f"The {name} kernels aren't supported by this CPU.")
+
+    if name == "portable":
+        k = Kernels(b"portable", ss_encode_portable, ss_decode_portable, False, False)
+    elif name == "swar":
+        k = Kernels(b"swar", ss_encode_swar, _unmarshall_quads, False, False)
+    elif name == "sse4.2":
+        k = Kernels(b"sse4.2", ss_encode_sse42, ss_decode_sse42, True, False)
+    else:
+        fast_pext = _cpu & SS_CPU_BMI2 and not _cpu & SS_CPU_SLOW_PEXT
+        k = Kernels(b"avx2", ss_encode_avx2, ss_decode_avx2, True, fast_pext)
+
+    kernels = k
+
+
+set_kernels(os.environ.get("SHORTSEQ_KERNELS") or None)